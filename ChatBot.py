@@ -1,101 +1,591 @@
 # -*- coding: utf-8 -*-
-from openai import OpenAI
-from openai import AuthenticationError
-from myToken import myToken
+import asyncio
+import contextvars
+import json
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from LLMCache import completion_key
+from Metrics import llm_span, record_usage, span
+from RateLimiter import Overloaded, estimate_tokens
+from StructuredOutput import parse_structured, repair_prompt
+from myToken import myToken, MODELSCOPE_BASE_URL, require_token
 
-class ChatBot:
-    """多轮对话机器人类，维护对话上下文"""
-    
-    def __init__(self, api_key, base_url="https://api-inference.modelscope.cn/v1/", 
-                 model="Qwen/Qwen2.5-Coder-32B-Instruct", system_message="You are a helpful assistant."):
+# 非流式调用在线程池中执行，调用方可以在期限到达或对冲请求先返回时不再等待；
+# 线程池由所有 ChatBot 共用（线程按需创建），同一进程中的多个客户端不会各自占用一组线程
+_CALL_EXECUTOR = ThreadPoolExecutor(max_workers=64, thread_name_prefix="llm-call")
+
+def _error_message(e):
+    """调用失败时打印的提示，认证失败时提示检查API key"""
+    openai = sys.modules.get('openai')
+    if openai is not None and isinstance(e, openai.AuthenticationError):
+        return f"认证错误: {e}\n请检查API key是否正确，是否已绑定阿里云账号"
+    return f"发生错误: {e}"
+
+def _remaining(deadline):
+    """距调用期限的剩余时间（秒），已超过期限时抛出 TimeoutError"""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError("模型调用超过期限")
+    return remaining
+
+class Conversation:
+    """单次请求独享的对话上下文，共享ChatBot的客户端，不同请求之间互不干扰"""
+
+    def __init__(self, bot, system_message=None, task=None):
         """
-        初始化聊天机器人
-        
+        初始化对话上下文
+
         Args:
-            api_key: ModelScope Access Token
-            base_url: API基础URL
-            model: 模型名称
-            system_message: 系统提示消息
+            bot: 提供客户端和模型配置的ChatBot实例
+            system_message: 系统提示消息，如果为None则使用bot的默认系统消息
+            task: 任务类型，由bot的路由表决定使用的模型和请求参数；为None时使用默认模型
         """
-        self.client = OpenAI(
-            api_key=api_key,
-            base_url=base_url
-        )
-        self.model = model
+        self.bot = bot
+        self.task = task
         self.messages = [
             {
                 'role': 'system',
-                'content': system_message
+                'content': system_message if system_message is not None else bot.system_message
             }
         ]
-    
-    def chat(self, user_message, stream=True, print_response=True):
+
+    @property
+    def messages(self):
+        """对话历史消息列表"""
+        return self._messages
+
+    @messages.setter
+    def messages(self, value):
+        self._messages = value
+        # 各消息的token数，随历史增长逐条补充；历史被整体替换或修改时重新计算
+        self._token_counts = []
+
+    def _compaction(self):
         """
-        发送消息并获取AI回复
-        
+        历史超出bot的上下文预算时，找出需要折叠的较早消息
+
+        Returns:
+            tuple: (需要折叠的消息, 区间起点, 区间终点)，不需要压缩时返回None
+        """
+        window = self.bot.context_window
+        if window is None:
+            return None
+        counts = self._token_counts
+        counts.extend(window.count(message) for message in self.messages[len(counts):])
+        plan = window.plan(self.messages, counts)
+        if plan is None:
+            return None
+        start, end = plan
+        return self.messages[start:end], start, end
+
+    def _fold(self, start, end, summary):
+        """用摘要替换折叠的消息；没有摘要时丢弃它们（已有的摘要保留）"""
+        window = self.bot.context_window
+        if summary:
+            replacement = [window.summary_message(summary)]
+        elif window.is_summary(self.messages[start]):
+            replacement = [self.messages[start]]
+        else:
+            replacement = []
+        self.messages[start:end] = replacement
+        self._token_counts[start:end] = [window.count(message) for message in replacement]
+
+    def _compact(self):
+        """发送前压缩超出预算的历史，系统消息始终保留；摘要失败时退化为丢弃较早的轮次"""
+        compaction = self._compaction()
+        if compaction is None:
+            return
+        folded, start, end = compaction
+        summary = None
+        if self.bot.context_window.summarize:
+            try:
+                # 失败计入 context.summary 环节的错误数（anotheryou_span_errors_total）
+                with span('context.summary'):
+                    summary = self.bot.complete(self.bot.context_window.summary_request(folded), task='summary')
+            except Exception as e:
+                print(f"对话历史摘要失败，丢弃较早的轮次: {e}")
+        self._fold(start, end, summary)
+
+    def chat(self, user_message, stream=True, print_response=True, use_cache=False, on_delta=None):
+        """
+        发送消息并获取AI回复，回复会追加到本对话的历史中
+
         Args:
             user_message: 用户消息
             stream: 是否使用流式输出
-            print_response: 是否打印回复（流式输出时）
-        
+            print_response: 是否打印回复
+            use_cache: 是否使用bot的补全缓存（仅适用于确定性提示）
+            on_delta: 流式输出时每收到一段内容的回调
+
         Returns:
             str: AI的完整回复内容
         """
         if not user_message or not user_message.strip():
             return ""
-        
+
         # 将用户消息添加到历史
         self.messages.append({
             'role': 'user',
             'content': user_message
         })
+        self._compact()
+
+        assistant_content = self.bot.complete(self.messages, stream=stream, print_response=print_response,
+                                              use_cache=use_cache, on_delta=on_delta, task=self.task)
+
+        # 将AI回答添加到历史，用于下一轮对话
+        if assistant_content:
+            self.messages.append({
+                'role': 'assistant',
+                'content': assistant_content
+            })
+
+        return assistant_content
+
+    def chat_json(self, user_message, schema, use_cache=False, repair_attempts=1):
+        """
+        发送消息并获取符合schema的结构化回复，回复会追加到本对话的历史中
+
+        Args:
+            user_message: 用户消息（应说明期望的JSON格式）
+            schema: 回复需要满足的JSON Schema
+            use_cache: 是否使用bot的补全缓存
+            repair_attempts: 回复不合法时要求模型修正的次数
+
+        Returns:
+            校验后的JSON值
+
+        Raises:
+            ValueError: 修正后仍无法得到合法的结构化回复
+        """
+        self.messages.append({
+            'role': 'user',
+            'content': user_message
+        })
+        self._compact()
+
+        value = self.bot.complete_json(self.messages, schema, use_cache=use_cache, repair_attempts=repair_attempts,
+                                       task=self.task)
+
+        self.messages.append({
+            'role': 'assistant',
+            'content': json.dumps(value, ensure_ascii=False)
+        })
+
+        return value
+
+    def clear_history(self, keep_system=True):
+        """
+        清除对话历史
+
+        Args:
+            keep_system: 是否保留系统消息
+        """
+        if keep_system and self.messages:
+            system_msg = self.messages[0] if self.messages[0]['role'] == 'system' else None
+            self.messages = [system_msg] if system_msg else []
+        else:
+            self.messages = []
+
+    def get_history(self):
+        """
+        获取对话历史
+
+        Returns:
+            list: 对话历史消息列表
+        """
+        return self.messages.copy()
+
+    def set_system_message(self, system_message):
+        """
+        设置系统消息
+
+        Args:
+            system_message: 新的系统消息
+        """
+        if self.messages and self.messages[0]['role'] == 'system':
+            self.messages[0]['content'] = system_message
+        else:
+            self.messages.insert(0, {
+                'role': 'system',
+                'content': system_message
+            })
+        self._token_counts = []
+
+
+class ChatBot:
+    """多轮对话机器人类，维护对话上下文
+
+    客户端是线程安全的，可被多个请求共享；需要并发时每个请求应通过
+    conversation() 创建独立的上下文，或直接调用无状态的 complete()。
+    """
+
+    # openai 中的客户端类名；openai 导入较慢，在首次使用客户端时才导入
+    client_class = 'OpenAI'
+    conversation_class = Conversation
+    
+    def __init__(self, api_key, base_url=MODELSCOPE_BASE_URL + "/v1/", 
+                 model="Qwen/Qwen2.5-Coder-32B-Instruct", system_message="You are a helpful assistant.",
+                 cache=None, limiter=None, routes=None, hedging=None, deadline=120, context_window=None):
+        """
+        初始化聊天机器人
         
+        Args:
+            api_key: ModelScope Access Token，为空时使用环境变量 MODELSCOPE_KEY（在首次调用时才检查）
+            base_url: API基础URL，默认取自环境变量 MODELSCOPE_BASE_URL
+            model: 模型名称
+            system_message: 系统提示消息
+            cache: 补全结果缓存（LLMCache.CompletionCache），为None时不缓存
+            limiter: 上游调用的准入控制（RateLimiter.Limiter），为None时不限制
+            routes: 按任务类型选择模型和请求参数的路由表（ModelRoutes），为None时所有任务都使用 model
+            hedging: 非流式调用的对冲策略（Hedging.HedgePolicy），为None时不发出对冲请求
+            deadline: 单次调用的期限（秒），路由中可按任务覆盖
+            context_window: 多轮对话历史的token预算（ContextWindow），超出时压缩较早的轮次；为None时不限制
+        """
+        self.api_key = api_key
+        self.base_url = base_url
+        self.model = model
+        self.system_message = system_message
+        self.cache = cache
+        self.limiter = limiter
+        self.routes = routes
+        self.hedging = hedging
+        self.deadline = deadline
+        self.context_window = context_window
+        self._conversation = self.conversation_class(self, system_message)
+
+        # 客户端在首次使用时创建，构造 ChatBot 不导入 openai、不检查令牌
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        """模型客户端（线程安全，首次访问时创建）"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    import openai
+                    self._client = getattr(openai, self.client_class)(api_key=require_token(self.api_key),
+                                                                      base_url=self.base_url)
+        return self._client
+
+    def warm_up(self):
+        """
+        创建客户端并预先建立到上游的连接，使导入 openai、DNS解析和TLS握手不计入第一个请求
+
+        上游返回错误状态码也说明连接已建立；只有无法连接时抛出异常
+        """
+        import openai
         try:
+            self.client.with_options(max_retries=0).models.list()
+        except openai.APIStatusError:
+            pass
+
+    @property
+    def messages(self):
+        """默认对话上下文的消息列表（仅供单用户场景如命令行使用）"""
+        return self._conversation.messages
+
+    @messages.setter
+    def messages(self, value):
+        self._conversation.messages = value
+
+    def conversation(self, system_message=None, task=None):
+        """
+        创建一个独立的对话上下文，共享本实例的客户端
+
+        Args:
+            system_message: 系统提示消息，如果为None则使用默认系统消息
+            task: 任务类型（见 ModelRoutes.TASKS），决定使用的模型和请求参数
+
+        Returns:
+            Conversation: 新的对话上下文
+        """
+        return self.conversation_class(self, system_message, task)
+
+    def route(self, task=None):
+        """
+        查找任务使用的模型和请求参数
+
+        Returns:
+            tuple: (模型名称, 请求参数字典)
+        """
+        if self.routes is None:
+            return self.model, {}
+        return self.routes.resolve(task, self.model)
+
+    def _call_options(self, task):
+        """任务的调用期限（秒）和对冲请求使用的模型（None表示与原请求相同）"""
+        options = self.routes.options(task) if self.routes is not None else {}
+        return options.get('deadline', self.deadline), options.get('hedge_model')
+
+    def _observe(self, task, started, hedged, hedge_won=False, timed_out=False):
+        if self.hedging is not None:
+            self.hedging.observe(task, time.monotonic() - started, hedged, hedge_won, timed_out)
+
+    def _cached(self, model, params, messages, use_cache, print_response, on_delta=None):
+        """
+        查找补全缓存，命中时整段回复作为一次增量交给on_delta
+
+        Returns:
+            tuple: (缓存键, 缓存的回复)；未启用缓存时键为None，未命中时回复为None
+        """
+        if not use_cache or self.cache is None:
+            return None, None
+        key = completion_key(model, messages, params)
+        cached = self.cache.get(key)
+        self._deliver_cached(cached, print_response, on_delta)
+        return key, cached
+
+    @staticmethod
+    def _deliver_cached(cached, print_response, on_delta):
+        if cached is not None:
+            if print_response:
+                print(f"助手: {cached}")
+            if on_delta:
+                on_delta(cached)
+
+    def _admit(self, model, messages, hedge=False):
+        """
+        获取一次调用配额（按估算的token数计入该模型每分钟的token限额），未配置准入控制时不限制
+
+        对冲请求不排队：没有空闲配额时直接放弃（抛出 Overloaded），且不计入准入控制的 shed 统计
+        """
+        if self.limiter is None:
+            return nullcontext()
+        return self.limiter.acquire(model, tokens=estimate_tokens(messages), timeout=0 if hedge else None,
+                                    shed=not hedge)
+
+    def _aadmit(self, model, messages, hedge=False):
+        """_admit 的协程版本"""
+        if self.limiter is None:
+            return nullcontext()
+        return self.limiter.aacquire(model, tokens=estimate_tokens(messages), timeout=0 if hedge else None,
+                                     shed=not hedge)
+
+    def _report_usage(self, model, task, permit, usage):
+        """记录回复中报告的token用量，并用实际用量校正估算的token数"""
+        if usage is None:
+            return
+        if isinstance(usage, dict):
+            # 流式分块中的用量不在客户端的数据模型里，以原始字典返回
+            from openai.types import CompletionUsage
+            usage = CompletionUsage(**usage)
+        record_usage(model, usage, task)
+        if permit is not None:
+            permit.report(usage.total_tokens)
+
+    def complete(self, messages, stream=False, print_response=False, use_cache=False, on_delta=None, task=None):
+        """
+        无状态地发送一组消息并获取AI回复，不读写任何共享历史
+
+        Args:
+            messages: 完整的消息列表
+            stream: 是否使用流式输出
+            print_response: 是否打印回复
+            use_cache: 是否使用补全缓存
+            on_delta: 流式输出时每收到一段内容的回调
+            task: 任务类型，决定使用的模型、请求参数和调用期限
+
+        Returns:
+            str: AI的完整回复内容
+
+        Raises:
+            TimeoutError: 超过调用期限
+        """
+        model, params = self.route(task)
+        cache_key, cached = self._cached(model, params, messages, use_cache, print_response, on_delta)
+        if cached is not None:
+            return cached
+
+        try:
+            deadline_seconds, hedge_model = self._call_options(task)
+            deadline = time.monotonic() + deadline_seconds
+            if stream:
+                # 已推送给调用方的流式输出无法换成另一个请求的结果，因此流式调用只受期限限制、不对冲
+                assistant_content = self._request(model, params, messages, task, deadline, stream=True,
+                                                  print_response=print_response, on_delta=on_delta)
+            else:
+                assistant_content = self._hedged(model, params, messages, task, deadline, hedge_model)
+                if print_response:
+                    print(f"助手: {assistant_content}")
+
+            if cache_key and assistant_content:
+                self.cache.set(cache_key, assistant_content)
+
+            return assistant_content
+            
+        except Exception as e:
+            print(_error_message(e))
+            raise
+
+    def _request(self, model, params, messages, task, deadline, stream=False, print_response=False, on_delta=None,
+                 hedge=False):
+        """
+        发送一次请求并收集完整回复
+
+        Args:
+            deadline: 调用期限（time.monotonic() 时刻），流式输出超过期限时中止
+            hedge: 是否为对冲请求（不等待准入配额）
+        """
+        with self._admit(model, messages, hedge) as permit, llm_span(model, task):
             # 发送请求
             response = self.client.chat.completions.create(
-                model=self.model,
-                messages=self.messages,
-                stream=stream
+                model=model,
+                messages=messages,
+                stream=stream,
+                timeout=_remaining(deadline),
+                **params
             )
-            
+        
             # 收集AI的完整回答
             assistant_content = ""
-            
+            usage = None
+        
             if stream:
                 if print_response:
                     print("助手: ", end='', flush=True)
-                
-                for chunk in response:
-                    if chunk.choices[0].delta.content:
-                        content = chunk.choices[0].delta.content
-                        if print_response:
-                            print(content, end='', flush=True)
-                        assistant_content += content
-                
+            
+                try:
+                    for chunk in response:
+                        # 部分服务在最后一个分块中返回用量，该分块没有 choices
+                        usage = getattr(chunk, 'usage', None) or usage
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            content = chunk.choices[0].delta.content
+                            if print_response:
+                                print(content, end='', flush=True)
+                            if on_delta:
+                                on_delta(content)
+                            assistant_content += content
+                        _remaining(deadline)
+                finally:
+                    response.close()
+            
                 if print_response:
                     print()  # 换行
             else:
                 assistant_content = response.choices[0].message.content
-                if print_response:
-                    print(f"助手: {assistant_content}")
-            
-            # 将AI回答添加到历史，用于下一轮对话
-            if assistant_content:
-                self.messages.append({
-                    'role': 'assistant',
-                    'content': assistant_content
-                })
-            
-            return assistant_content
-            
-        except AuthenticationError as e:
-            error_msg = f"认证错误: {e}\n请检查API key是否正确，是否已绑定阿里云账号"
-            print(error_msg)
-            raise
-        except Exception as e:
-            error_msg = f"发生错误: {e}"
-            print(error_msg)
-            raise
+                usage = response.usage
+            self._report_usage(model, task, permit, usage)
+
+        return assistant_content
+
+    def _hedged(self, model, params, messages, task, deadline, hedge_model=None):
+        """
+        发送非流式请求：超过该任务近期耗时的分位数仍未返回时再发出一个对冲请求，取先成功的结果
+
+        同步客户端无法中断进行中的请求，落选的请求在后台线程中完成后丢弃（用量仍会记录）
+
+        Raises:
+            TimeoutError: 超过调用期限
+        """
+        started = time.monotonic()
+        delay = self.hedging.delay(task) if self.hedging is not None else None
+
+        def submit(target_model, hedge=False):
+            return _CALL_EXECUTOR.submit(contextvars.copy_context().run, self._request, target_model, params,
+                                         messages, task, deadline, hedge=hedge)
+
+        pending = {submit(model)}
+        hedge = None
+        errors = {}
+        while pending:
+            until = deadline if delay is None else min(deadline, started + delay)
+            done, pending = wait(pending, timeout=max(0, until - time.monotonic()), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self._observe(task, started, hedge is not None, future is hedge)
+                    return future.result()
+                if future is hedge and isinstance(future.exception(), Overloaded):
+                    # 对冲请求没有拿到配额，相当于没有发出，不影响主请求的结果
+                    hedge = None
+                else:
+                    errors[future is hedge] = future.exception()
+            if done:
+                continue
+            if time.monotonic() >= deadline:
+                self._observe(task, started, hedge is not None, timed_out=True)
+                raise TimeoutError(f"模型 {model} 调用超过期限（{deadline - started:.0f}秒）")
+            # 等待可能略早于期限返回，未配置对冲或已发出过对冲时只继续等待
+            if delay is not None and self.hedging is not None and self.hedging.allow():
+                hedge = submit(hedge_model or model, hedge=True)
+                pending.add(hedge)
+            delay = None
+        # 两个请求都失败时以主请求的错误为准
+        raise errors.get(False) or errors[True]
+    
+    def _parse_or_repair(self, messages, text, schema, attempt, repair_attempts):
+        """
+        解析结构化回复；不合法时返回要求模型修正的新消息列表
+
+        Returns:
+            tuple: (解析结果, 修正用的消息列表)，两者只有一个不为None
+        """
+        try:
+            return parse_structured(text, schema), None
+        except ValueError as e:
+            if attempt >= repair_attempts:
+                raise ValueError(f"模型未能返回合法的结构化结果: {e}") from e
+            print(f"结构化回复不合法，要求模型修正: {e}")
+            return None, messages + [
+                {'role': 'assistant', 'content': text},
+                {'role': 'user', 'content': repair_prompt(e, schema)},
+            ]
+
+    def _cache_repaired(self, messages, value, use_cache, task=None):
+        """把修正后的结果写回原始请求的缓存，避免下次命中不合法的回复"""
+        if use_cache and self.cache is not None:
+            model, params = self.route(task)
+            self.cache.set(completion_key(model, messages, params), json.dumps(value, ensure_ascii=False))
+
+    def complete_json(self, messages, schema, use_cache=False, repair_attempts=1, task=None):
+        """
+        无状态地发送一组消息并获取符合schema的结构化回复
+
+        回复先经过容错解析（代码块、前后说明、尾逗号）和schema校验，
+        不合法时把错误反馈给模型要求修正，最多 repair_attempts 次。
+
+        Args:
+            messages: 完整的消息列表
+            schema: 回复需要满足的JSON Schema
+            use_cache: 是否使用补全缓存（只缓存原始请求）
+            repair_attempts: 回复不合法时要求模型修正的次数
+            task: 任务类型，决定使用的模型和请求参数
+
+        Returns:
+            校验后的JSON值
+
+        Raises:
+            ValueError: 修正后仍无法得到合法的结构化回复
+        """
+        request = list(messages)
+        text = self.complete(request, use_cache=use_cache, task=task)
+        for attempt in range(repair_attempts + 1):
+            value, request = self._parse_or_repair(request, text, schema, attempt, repair_attempts)
+            if request is None:
+                if attempt:
+                    self._cache_repaired(messages, value, use_cache, task)
+                return value
+            text = self.complete(request, task=task)
+
+    def chat(self, user_message, stream=True, print_response=True, use_cache=False):
+        """
+        在默认对话上下文中发送消息并获取AI回复
+        
+        Args:
+            user_message: 用户消息
+            stream: 是否使用流式输出
+            print_response: 是否打印回复（流式输出时）
+            use_cache: 是否使用补全缓存
+        
+        Returns:
+            str: AI的完整回复内容
+        """
+        return self._conversation.chat(user_message, stream=stream, print_response=print_response,
+                                       use_cache=use_cache)
     
     def clear_history(self, keep_system=True):
         """
@@ -104,11 +594,7 @@ class ChatBot:
         Args:
             keep_system: 是否保留系统消息
         """
-        if keep_system and self.messages:
-            system_msg = self.messages[0] if self.messages[0]['role'] == 'system' else None
-            self.messages = [system_msg] if system_msg else []
-        else:
-            self.messages = []
+        self._conversation.clear_history(keep_system)
     
     def get_history(self):
         """
@@ -117,7 +603,7 @@ class ChatBot:
         Returns:
             list: 对话历史消息列表
         """
-        return self.messages.copy()
+        return self._conversation.get_history()
     
     def set_system_message(self, system_message):
         """
@@ -126,21 +612,257 @@ class ChatBot:
         Args:
             system_message: 新的系统消息
         """
-        if self.messages and self.messages[0]['role'] == 'system':
-            self.messages[0]['content'] = system_message
-        else:
-            self.messages.insert(0, {
-                'role': 'system',
-                'content': system_message
+        self._conversation.set_system_message(system_message)
+
+
+class AsyncConversation(Conversation):
+    """异步版本的对话上下文，chat 为协程"""
+
+    async def _compact(self):
+        """Conversation._compact 的协程版本"""
+        compaction = self._compaction()
+        if compaction is None:
+            return
+        folded, start, end = compaction
+        summary = None
+        if self.bot.context_window.summarize:
+            try:
+                with span('context.summary'):
+                    summary = await self.bot.complete(self.bot.context_window.summary_request(folded),
+                                                      task='summary')
+            except Exception as e:
+                print(f"对话历史摘要失败，丢弃较早的轮次: {e}")
+        self._fold(start, end, summary)
+
+    async def chat(self, user_message, stream=True, print_response=True, use_cache=False, on_delta=None):
+        """
+        发送消息并等待AI回复，回复会追加到本对话的历史中
+
+        Args:
+            user_message: 用户消息
+            stream: 是否使用流式输出
+            print_response: 是否打印回复
+            use_cache: 是否使用bot的补全缓存（仅适用于确定性提示）
+            on_delta: 流式输出时每收到一段内容的回调
+
+        Returns:
+            str: AI的完整回复内容
+        """
+        if not user_message or not user_message.strip():
+            return ""
+
+        self.messages.append({
+            'role': 'user',
+            'content': user_message
+        })
+        await self._compact()
+
+        assistant_content = await self.bot.complete(self.messages, stream=stream, print_response=print_response,
+                                                    use_cache=use_cache, on_delta=on_delta, task=self.task)
+
+        if assistant_content:
+            self.messages.append({
+                'role': 'assistant',
+                'content': assistant_content
             })
 
+        return assistant_content
+
+    async def chat_json(self, user_message, schema, use_cache=False, repair_attempts=1):
+        """chat_json 的异步版本"""
+        self.messages.append({
+            'role': 'user',
+            'content': user_message
+        })
+        await self._compact()
+
+        value = await self.bot.complete_json(self.messages, schema, use_cache=use_cache,
+                                             repair_attempts=repair_attempts, task=self.task)
+
+        self.messages.append({
+            'role': 'assistant',
+            'content': json.dumps(value, ensure_ascii=False)
+        })
+
+        return value
+
+
+class AsyncChatBot(ChatBot):
+    """基于异步客户端的聊天机器人，等待模型回复时不占用线程
+
+    接口与 ChatBot 相同，但 chat / complete 以及对话上下文的 chat 都需要 await。
+    """
+
+    client_class = 'AsyncOpenAI'
+    conversation_class = AsyncConversation
+
+    async def warm_up(self):
+        """ChatBot.warm_up 的协程版本"""
+        import openai
+        try:
+            await self.client.with_options(max_retries=0).models.list()
+        except openai.APIStatusError:
+            pass
+
+    async def _acached(self, model, params, messages, use_cache, print_response, on_delta=None):
+        """_cached 的协程版本：缓存可能是SQLite文件，查询在线程中执行，不阻塞事件循环"""
+        if not use_cache or self.cache is None:
+            return None, None
+        key = completion_key(model, messages, params)
+        cached = await asyncio.to_thread(self.cache.get, key)
+        self._deliver_cached(cached, print_response, on_delta)
+        return key, cached
+
+    async def complete(self, messages, stream=False, print_response=False, use_cache=False, on_delta=None,
+                       task=None):
+        """
+        无状态地发送一组消息并等待AI回复
+
+        Args:
+            messages: 完整的消息列表
+            stream: 是否使用流式输出
+            print_response: 是否打印回复
+            use_cache: 是否使用补全缓存
+            on_delta: 流式输出时每收到一段内容的回调
+            task: 任务类型，决定使用的模型、请求参数和调用期限
+
+        Returns:
+            str: AI的完整回复内容
+
+        Raises:
+            TimeoutError: 超过调用期限
+        """
+        model, params = self.route(task)
+        cache_key, cached = await self._acached(model, params, messages, use_cache, print_response, on_delta)
+        if cached is not None:
+            return cached
+
+        try:
+            deadline_seconds, hedge_model = self._call_options(task)
+            deadline = time.monotonic() + deadline_seconds
+            if stream:
+                assistant_content = await self._request(model, params, messages, task, deadline, stream=True,
+                                                        print_response=print_response, on_delta=on_delta)
+            else:
+                assistant_content = await self._hedged(model, params, messages, task, deadline, hedge_model)
+                if print_response:
+                    print(f"助手: {assistant_content}")
+
+            if cache_key and assistant_content:
+                await asyncio.to_thread(self.cache.set, cache_key, assistant_content)
+
+            return assistant_content
+
+        except Exception as e:
+            print(_error_message(e))
+            raise
+
+    async def _request(self, model, params, messages, task, deadline, stream=False, print_response=False,
+                       on_delta=None, hedge=False):
+        """ChatBot._request 的协程版本"""
+        async with self._aadmit(model, messages, hedge) as permit:
+            with llm_span(model, task):
+                response = await self.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    stream=stream,
+                    timeout=_remaining(deadline),
+                    **params
+                )
+
+                assistant_content = ""
+                usage = None
+
+                if stream:
+                    if print_response:
+                        print("助手: ", end='', flush=True)
+
+                    try:
+                        async for chunk in response:
+                            usage = getattr(chunk, 'usage', None) or usage
+                            if chunk.choices and chunk.choices[0].delta.content:
+                                content = chunk.choices[0].delta.content
+                                if print_response:
+                                    print(content, end='', flush=True)
+                                if on_delta:
+                                    on_delta(content)
+                                assistant_content += content
+                            _remaining(deadline)
+                    finally:
+                        await response.close()
+
+                    if print_response:
+                        print()
+                else:
+                    assistant_content = response.choices[0].message.content
+                    usage = response.usage
+                self._report_usage(model, task, permit, usage)
+
+        return assistant_content
+
+    async def _hedged(self, model, params, messages, task, deadline, hedge_model=None):
+        """ChatBot._hedged 的协程版本，得到结果或超过期限后取消仍在进行的请求"""
+        started = time.monotonic()
+        delay = self.hedging.delay(task) if self.hedging is not None else None
+
+        def start(target_model, hedge=False):
+            return asyncio.ensure_future(self._request(target_model, params, messages, task, deadline,
+                                                       hedge=hedge))
+
+        pending = {start(model)}
+        hedge = None
+        errors = {}
+        try:
+            while pending:
+                until = deadline if delay is None else min(deadline, started + delay)
+                done, pending = await asyncio.wait(pending, timeout=max(0, until - time.monotonic()),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        self._observe(task, started, hedge is not None, attempt is hedge)
+                        return attempt.result()
+                    if attempt is hedge and isinstance(attempt.exception(), Overloaded):
+                        hedge = None
+                    else:
+                        errors[attempt is hedge] = attempt.exception()
+                if done:
+                    continue
+                if time.monotonic() >= deadline:
+                    self._observe(task, started, hedge is not None, timed_out=True)
+                    raise TimeoutError(f"模型 {model} 调用超过期限（{deadline - started:.0f}秒）")
+                if delay is not None and self.hedging is not None and self.hedging.allow():
+                    hedge = start(hedge_model or model, hedge=True)
+                    pending.add(hedge)
+                delay = None
+            raise errors.get(False) or errors[True]
+        finally:
+            for attempt in pending:
+                attempt.cancel()
+
+    async def complete_json(self, messages, schema, use_cache=False, repair_attempts=1, task=None):
+        """complete_json 的异步版本"""
+        request = list(messages)
+        text = await self.complete(request, use_cache=use_cache, task=task)
+        for attempt in range(repair_attempts + 1):
+            value, request = self._parse_or_repair(request, text, schema, attempt, repair_attempts)
+            if request is None:
+                if attempt:
+                    await asyncio.to_thread(self._cache_repaired, messages, value, use_cache, task)
+                return value
+            text = await self.complete(request, task=task)
+
 
 # 使用示例
 if __name__ == "__main__":
+    from ContextWindow import context_window_from_env
+    from ModelRoutes import model_routes_from_env
+
     # 创建聊天机器人实例
     bot = ChatBot(
         api_key=myToken,  # 请替换成您的ModelScope Access Token
-        model="Qwen/Qwen2.5-Coder-32B-Instruct"
+        model="Qwen/Qwen2.5-Coder-32B-Instruct",
+        routes=model_routes_from_env(),
+        context_window=context_window_from_env()  # 长对话中较早的轮次压缩为摘要，每轮开销保持平稳
     )
     
     print("多轮对话已启动，输入 'exit' 或 'quit' 退出")
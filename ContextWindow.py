@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import os
+from RateLimiter import estimate_tokens
+
+# 每条消息在角色标记等格式上额外消耗的token数
+_MESSAGE_OVERHEAD = 4
+
+# 摘要消息的前缀，用于识别历史中已有的摘要
+_SUMMARY_PREFIX = "此前对话的摘要："
+
+_SUMMARY_PROMPT = ("请把下面的对话压缩为一段简洁的摘要，保留其中的事实、用户的偏好和要求，以及尚未完成的问题，"
+                   "不要添加对话中没有的内容，只输出摘要本身。")
+
+_ROLE_NAMES = {'user': '用户', 'assistant': '助手', 'system': '系统'}
+
+
+class ContextWindow:
+    """多轮对话历史的token预算
+
+    历史超过 max_tokens 时，把较早的轮次折叠为一条摘要消息（或直接丢弃），直到降到 target_tokens 以下；
+    系统消息和最近 keep_messages 条消息始终保留，每轮请求的开销因此不再随对话轮数增长。
+    """
+
+    def __init__(self, max_tokens=4000, target_ratio=0.5, keep_messages=4, summarize=True):
+        """
+        初始化上下文预算
+
+        Args:
+            max_tokens: 历史（含系统消息）的token上限，超过时压缩
+            target_ratio: 压缩后的目标token数占上限的比例，留出余量避免每轮都要压缩
+            keep_messages: 始终原样保留的最近消息数
+            summarize: 是否把折叠的轮次交给模型摘要，为False时直接丢弃
+        """
+        self.max_tokens = max_tokens
+        self.target_tokens = int(max_tokens * target_ratio)
+        self.keep_messages = keep_messages
+        self.summarize = summarize
+
+    @staticmethod
+    def count(message):
+        """估算一条消息的token数"""
+        return estimate_tokens([message], completion=0) + _MESSAGE_OVERHEAD
+
+    @staticmethod
+    def is_summary(message):
+        """是否为 summary_message 生成的摘要消息"""
+        return message['role'] == 'system' and str(message.get('content') or '').startswith(_SUMMARY_PREFIX)
+
+    def plan(self, messages, counts):
+        """
+        选出需要折叠的较早消息
+
+        Args:
+            messages: 对话历史
+            counts: 与 messages 一一对应的token数
+
+        Returns:
+            tuple: 需要折叠的区间 (start, end)，不需要压缩时返回None；区间从系统消息之后开始（包含已有的摘要），
+                   在用户消息处结束，保证折叠后留下的都是完整的轮次
+        """
+        total = sum(counts)
+        if total <= self.max_tokens:
+            return None
+        start = 1 if messages and messages[0]['role'] == 'system' else 0
+        limit = len(messages) - max(self.keep_messages, 1)
+        end = None
+        for index in range(start, limit):
+            total -= counts[index]
+            if messages[index + 1]['role'] == 'user':
+                end = index + 1
+                if total <= self.target_tokens:
+                    break
+        if end is None or (end == start + 1 and self.is_summary(messages[start])):
+            return None
+        return start, end
+
+    def summary_request(self, messages):
+        """
+        构造摘要请求
+
+        Args:
+            messages: 需要折叠的消息（可能以已有的摘要开头）
+
+        Returns:
+            list: 发给模型的消息列表
+        """
+        lines = []
+        for message in messages:
+            if self.is_summary(message):
+                lines.append(message['content'])
+            else:
+                lines.append(f"{_ROLE_NAMES.get(message['role'], message['role'])}: {message.get('content') or ''}")
+        return [
+            {'role': 'system', 'content': _SUMMARY_PROMPT},
+            {'role': 'user', 'content': "\n".join(lines)}
+        ]
+
+    @staticmethod
+    def summary_message(summary):
+        """把摘要包装为放在系统消息之后的消息"""
+        return {'role': 'system', 'content': _SUMMARY_PREFIX + summary.strip()}
+
+
+def context_window_from_env():
+    """
+    根据环境变量创建上下文预算
+
+    环境变量：
+        CONTEXT_WINDOW: 设为 off 时不限制多轮对话的历史长度
+        CONTEXT_MAX_TOKENS: 历史的token上限，默认4000
+        CONTEXT_KEEP_MESSAGES: 始终保留的最近消息数，默认4
+        CONTEXT_SUMMARIZE: 设为 off 时直接丢弃较早的轮次，不调用模型摘要
+
+    Returns:
+        ContextWindow: 上下文预算，关闭时返回None
+    """
+    if os.getenv('CONTEXT_WINDOW', 'on').lower() == 'off':
+        return None
+    return ContextWindow(max_tokens=int(os.getenv('CONTEXT_MAX_TOKENS', 4000)),
+                         keep_messages=int(os.getenv('CONTEXT_KEEP_MESSAGES', 4)),
+                         summarize=os.getenv('CONTEXT_SUMMARIZE', 'on').lower() != 'off')
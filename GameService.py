@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+"""
+同步服务（app.py）和异步服务（asgi.py）共用的组件和业务逻辑
+
+两个入口只在执行方式上不同：app.py 在线程中执行步骤、等待图片任务，asgi.py 以协程执行；
+组件的创建、预生成的调度、会话的读写、请求的校验和错误响应都只在这里实现一次。
+这里的函数都是同步的，asgi.py 把其中访问会话存储的调用放到线程中执行，不阻塞事件循环。
+"""
+import base64
+import os
+import threading
+import traceback
+from ChatBot import ChatBot
+from GenPic import ImageGenerator
+from ImageVariants import image_variants_from_env
+from StaticAssets import StaticAssets
+from Pipeline import (STAGES, IMAGE_MODEL, quiz_prompt, QUIZ_SCHEMA, normalize_questions, stage_plan, outcome_plan,
+                      stage_response, outcome_response, new_session, record_stage, record_outcome, comic_prompt)
+from LLMCache import completion_cache_from_env
+from ModelRoutes import model_routes_from_env
+from Hedging import hedge_policy_from_env
+from QuizPool import quiz_pool_from_env
+from Speculator import speculator_from_env, outcome_speculator_from_env, speculation_key
+from SessionStore import session_store_from_env
+from RateLimiter import Overloaded, limiter_from_env
+from JobQueue import JobQueueFull
+from Metrics import REGISTRY, span
+from myToken import myToken
+
+# 1x1 PNG favicon to avoid 404s on /favicon.ico without adding a binary file.
+FAVICON_PNG = base64.b64decode(
+    b"iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR4nGMAAQAABQABDQottAAAAABJRU5ErkJggg==")
+
+# 上游调用的准入控制，对话和图片客户端共用
+limiter = limiter_from_env()
+
+# 按任务类型选择模型：短小的子任务（描述、提示词、选择题、测试题）使用小模型
+model_routes = model_routes_from_env()
+# 非流式调用超过近期耗时的分位数仍未返回时发出对冲请求；每次调用不超过 LLM_DEADLINE 秒
+hedging = hedge_policy_from_env()
+llm_deadline = float(os.getenv('LLM_DEADLINE', 120))
+
+# 同步对话客户端：app.py 的所有调用和测试题池的补充线程使用（asgi.py 另建异步客户端，共用同一个补全缓存）；
+# 客户端全局共享，对话上下文由每个请求通过 chatbot.conversation() 独立创建
+chatbot = ChatBot(api_key=myToken, cache=completion_cache_from_env(), limiter=limiter, routes=model_routes,
+                  hedging=hedging, deadline=llm_deadline)
+# 生成图片的保存目录（IMAGE_DIR），/images 从同一目录提供；压测等场景可指向临时目录，不写入仓库
+image_generator = ImageGenerator(output_dir=os.getenv('IMAGE_DIR', 'images'), limiter=limiter)
+# 生成阶段时等待图片任务的最长时间（秒），超时后该步骤失败，仍在排队的任务被取消
+image_wait_timeout = float(os.getenv('IMAGE_WAIT_TIMEOUT', 180))
+
+# 生成图片的缩略图和 WebP/AVIF 版本，/images 按请求参数或 Accept 头选择
+image_variants = image_variants_from_env(image_generator.output_dir)
+
+# 静态资源按内容哈希加版本号并返回预压缩版本（构建镜像时生成，缺失时在启动时补齐）；
+# 启动时补齐的压缩文件写在 STATIC_DIR（默认为仓库的 static/）中
+static_assets = StaticAssets(os.getenv('STATIC_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                     'static'))
+
+
+def generate_quiz(basic_info):
+    """生成一套性格测试问题，模型修正后仍不合法时返回空列表（在请求线程或题目池的补充线程中调用）"""
+    try:
+        with span('step', 'quiz'):
+            return normalize_questions(chatbot.conversation(task='quiz').chat_json(quiz_prompt(basic_info),
+                                                                                   QUIZ_SCHEMA))
+    except ValueError:
+        return []
+
+# 预生成的测试题池，由后台线程补充
+quiz_pool = quiz_pool_from_env(generate_quiz)
+
+# 阶段内容和选项结局的预生成（SPECULATE=on / SPECULATE_OUTCOMES=on 时开启）
+speculator = speculator_from_env()
+outcome_speculator = outcome_speculator_from_env()
+
+# 服务端会话，客户端只需回传 session_id
+session_store = session_store_from_env()
+
+# 图片任务的优先级：用户正在等待的任务优先于预生成任务
+PRIORITY_INTERACTIVE = 0
+PRIORITY_SPECULATIVE = 1
+
+# 客户端提交的图片任务可选的最低优先级
+PRIORITY_LOWEST = 9
+
+# 上游连接的预热状态，供 /readyz 参考（就绪检查不等待预热完成）
+warm_up_status = {}
+
+
+class RequestError(Exception):
+    """请求无效（400）或请求的资源不存在（404），由 error_response 转换为对应的响应"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class SpeculativeRun:
+    """一个预生成任务：由入口的启动函数创建，对 Speculator 表现为 future
+
+    记录已完成步骤的结果和提交的图片任务。被真实请求取走后，排队中和之后提交的图片任务改为交互优先级；
+    取消时尚未开始的步骤不再执行，排队中的图片任务也一并取消。
+    """
+
+    def __init__(self, image_jobs, player, cancelled):
+        """
+        初始化预生成任务，入口在启动执行后设置 future
+
+        Args:
+            image_jobs: 图片任务队列
+            player: 玩家标识，用于图片任务的公平调度
+            cancelled: threading.Event，被设置后线程中尚未开始的步骤不再执行
+        """
+        self.image_jobs = image_jobs
+        self.player = player
+        self.cancelled = cancelled
+        self.future = None
+        self._results = {}
+        self._jobs = []
+        self._priority = PRIORITY_SPECULATIVE
+        self._lock = threading.Lock()
+
+    def record(self, name, result):
+        """依赖图的 on_result 回调，记录已完成的步骤"""
+        with self._lock:
+            self._results[name] = result
+
+    def submit_image(self, payload):
+        """以当前优先级提交图片任务，返回任务ID"""
+        with self._lock:
+            job_id = self.image_jobs.submit(payload, session=self.player, priority=self._priority)
+            self._jobs.append(job_id)
+        return job_id
+
+    def claim(self):
+        """被真实请求取走：用户已在等待，图片任务提升为交互优先级"""
+        with self._lock:
+            self._priority = PRIORITY_INTERACTIVE
+            jobs = list(self._jobs)
+        for job_id in jobs:
+            self.image_jobs.promote(job_id, PRIORITY_INTERACTIVE)
+
+    def partial(self):
+        """
+        取消尚未完成的部分，返回已完成的步骤结果，由调用方只重新生成其余步骤
+
+        已开始的图片任务继续执行，重新提交的相同图片会合并到进行中的生成（ImageCache）
+        """
+        self.cancel()
+        with self._lock:
+            return dict(self._results)
+
+    def done(self):
+        return self.future.done()
+
+    def add_done_callback(self, callback):
+        self.future.add_done_callback(lambda _: callback(self))
+
+    def cancel(self):
+        """取消预生成：尚未开始的步骤不再执行，排队中的图片任务直接取消"""
+        self.cancelled.set()
+        cancelled = self.future.cancel()
+        with self._lock:
+            jobs = list(self._jobs)
+        for job_id in jobs:
+            self.image_jobs.cancel(job_id)
+        return cancelled
+
+
+def run_image_job(payload):
+    """图片任务的执行函数（JobQueue）：生成图片并安排生成各版本"""
+    path = image_generator.generate_and_save(payload['prompt'], model=payload['model'])
+    if image_variants is not None:
+        image_variants.schedule(path)
+    return path
+
+
+async def arun_image_job(payload):
+    """run_image_job 的协程版本（AsyncJobQueue）"""
+    path = await image_generator.agenerate_and_save(payload['prompt'], model=payload['model'])
+    if image_variants is not None:
+        image_variants.schedule(path)
+    return path
+
+
+def register_metrics(image_jobs):
+    """把各组件的统计登记为 /metrics 中的指标"""
+    if chatbot.cache is not None:
+        REGISTRY.register_stats('anotheryou_llm_cache', chatbot.cache.stats, gauges=('size',),
+                                counters=('hits', 'misses'))
+    if image_generator.cache is not None:
+        REGISTRY.register_stats('anotheryou_image_cache', image_generator.cache.stats, gauges=('inflight',),
+                                counters=('hits', 'misses'))
+    if image_variants is not None:
+        REGISTRY.register_stats('anotheryou_image_variants', image_variants.stats, gauges=('pending',),
+                                counters=('generated', 'hits', 'misses'))
+    if quiz_pool is not None:
+        REGISTRY.register_stats('anotheryou_quiz_pool', quiz_pool.stats, gauges=('buckets', 'sets', 'pending'),
+                                counters=('hits', 'misses'))
+    for prefix, spec in (('anotheryou_stage_speculation', speculator),
+                         ('anotheryou_outcome_speculation', outcome_speculator)):
+        if spec is not None:
+            REGISTRY.register_stats(prefix, spec.stats, gauges=('entries', 'running'),
+                                    counters=('hits', 'misses', 'skipped'))
+    if limiter is not None:
+        REGISTRY.register_stats('anotheryou_upstream', limiter.stats, gauges=('in_flight',),
+                                counters=('admitted', 'shed'), label='model')
+    if hedging is not None:
+        REGISTRY.register_stats('anotheryou_llm_hedge', hedging.stats, gauges=('delay',),
+                                counters=('calls', 'hedged', 'hedge_wins', 'timeouts'), label='task')
+    REGISTRY.register_stats('anotheryou_image_jobs', image_jobs.stats, gauges=('queued', 'running', 'sessions'))
+    REGISTRY.register_stats('anotheryou_image_poller', lambda: {'in_flight': image_generator.poller.in_flight()},
+                            gauges=('in_flight',))
+    REGISTRY.register_stats('anotheryou_sessions', session_store.stats, gauges=('size',))
+
+
+def player(basic_info, personality):
+    """玩家标识，用于图片任务的公平调度和预生成预算"""
+    return speculation_key('player', basic_info, personality)
+
+
+def _stage_key(stage_index, basic_info, personality):
+    return speculation_key('stage', stage_index, basic_info, personality)
+
+
+def _outcome_key(stage_index, story, choice):
+    return speculation_key('outcome', stage_index, story, choice)
+
+
+def _outcome_group(stage_index, story):
+    return speculation_key('outcomes', stage_index, story)
+
+
+def speculate_stage(launcher, stage_index, basic_info, personality):
+    """
+    在后台预生成某个阶段；未开启、阶段越界、已在生成或超出并发预算时跳过
+
+    Args:
+        launcher: 入口提供的启动函数工厂，参数为 (步骤声明, 并发数, 玩家标识)，
+                  返回供 Speculator.start 使用、以 SpeculativeRun 作为 future 的启动函数
+    """
+    if speculator is None or stage_index >= len(STAGES):
+        return
+    plan = stage_plan(STAGES[stage_index], basic_info, personality)
+    launch = launcher(plan, speculator.workers, player(basic_info, personality))
+    if speculator.start(_stage_key(stage_index, basic_info, personality), launch):
+        print(f"开始预生成第{stage_index + 1}阶段...")
+
+
+def speculate_outcomes(launcher, stage_index, basic_info, personality, story, options):
+    """在后台为每个选项预生成结局；结局图片只在该玩家的图片预算内预生成，launcher 同 speculate_stage"""
+    if outcome_speculator is None or stage_index >= len(STAGES):
+        return
+    owner = player(basic_info, personality)
+    for choice in options:
+        plan = outcome_plan(STAGES[stage_index], story, choice)
+        with_image = outcome_speculator.spend(owner)
+        if not with_image:
+            plan = [step for step in plan if step[2] != 'image']
+        started = outcome_speculator.start(_outcome_key(stage_index, story, choice),
+                                           launcher(plan, outcome_speculator.workers, owner),
+                                           group=_outcome_group(stage_index, story))
+        if not started and with_image:
+            outcome_speculator.refund(owner)
+
+
+def speculate_after_stage(launcher, stage_index, basic_info, personality, results):
+    """阶段返回后，预生成各选项的结局和下一阶段"""
+    speculate_outcomes(launcher, stage_index, basic_info, personality, results['story'], results['choice'][1])
+    speculate_stage(launcher, stage_index + 1, basic_info, personality)
+
+
+def _claimed(speculative):
+    if speculative is not None:
+        speculative.claim()
+    return speculative
+
+
+def claim_stage(stage_index, basic_info, personality):
+    """取走某个阶段的预生成任务（SpeculativeRun），不存在时返回None"""
+    if speculator is None:
+        return None
+    return _claimed(speculator.claim(_stage_key(stage_index, basic_info, personality)))
+
+
+def claim_outcome(stage_index, story, choice):
+    """取走所选选项的预生成结局，并取消其他选项的预生成"""
+    if outcome_speculator is None:
+        return None
+    speculative = outcome_speculator.claim(_outcome_key(stage_index, story, choice))
+    outcome_speculator.cancel_group(_outcome_group(stage_index, story))
+    return _claimed(speculative)
+
+
+def stage_index_of(data):
+    """
+    请求中的阶段索引
+
+    Raises:
+        RequestError: 阶段索引无效
+    """
+    stage_index = data.get('stage_index', 0)
+    if not isinstance(stage_index, int) or not 0 <= stage_index < len(STAGES):
+        raise RequestError('无效的阶段索引')
+    return stage_index
+
+
+def create_session(basic_info, personality):
+    """
+    创建游戏会话
+
+    Returns:
+        tuple: (session_id, 返回给旧客户端的 user_data)
+    """
+    session_id = session_store.create(new_session(basic_info, personality))
+    user_data = {
+        'basic_info': basic_info,
+        'personality': personality,
+        'current_stage': 0,
+        'stages_data': []
+    }
+    return session_id, user_data
+
+
+def request_session(data):
+    """
+    读取请求对应的会话
+
+    Returns:
+        tuple: (session_id, 会话数据)；未带 session_id 时由请求中的 user_data 构造一个不保存的临时会话（兼容旧客户端）
+
+    Raises:
+        RequestError: 请求带有 session_id 但会话不存在或已过期
+    """
+    session_id = data.get('session_id')
+    if not session_id:
+        user_data = data.get('user_data', {})
+        return None, new_session(user_data.get('basic_info', {}), user_data.get('personality', ''))
+    session = session_store.get(session_id)
+    if session is None:
+        raise RequestError('会话不存在或已过期，请重新开始', 404)
+    return session_id, session
+
+
+def save_session(session_id, func):
+    """原子地修改会话；临时会话不保存"""
+    if session_id:
+        session_store.update(session_id, func)
+
+
+def save_stage(session_id, stage_index, results):
+    """保存阶段结果到会话，返回接口数据"""
+    response = stage_response(results)
+    save_session(session_id, lambda session: record_stage(session, stage_index, response))
+    return response
+
+
+def save_outcome(session_id, stage_index, choice, results):
+    """保存结局结果到会话，返回接口数据"""
+    response = outcome_response(results)
+    save_session(session_id, lambda session: record_outcome(session, stage_index, choice, response))
+    return response
+
+
+def image_job_request(data):
+    """
+    解析客户端提交的图片任务
+
+    Returns:
+        tuple: (任务参数, 会话标识, 优先级)；客户端提交的任务不能高于用户正在等待的阶段图片
+
+    Raises:
+        RequestError: 缺少图片描述或优先级不是整数
+    """
+    prompt = str(data.get('prompt', '')).strip()
+    if not prompt:
+        raise RequestError('缺少图片描述')
+    try:
+        priority = int(data.get('priority', PRIORITY_INTERACTIVE))
+    except (TypeError, ValueError):
+        raise RequestError('优先级必须是整数')
+    priority = min(max(priority, PRIORITY_INTERACTIVE), PRIORITY_LOWEST)
+    return {'prompt': comic_prompt(prompt), 'model': IMAGE_MODEL}, data.get('session_id'), priority
+
+
+def job_missing():
+    return {'success': False, 'error': '任务不存在或已过期'}, 404
+
+
+def error_payload(e):
+    """接口异常的响应数据，上游繁忙时附带建议的重试时间（秒）"""
+    payload = {'success': False, 'error': str(e)}
+    if isinstance(e, Overloaded):
+        payload['retry_after'] = e.retry_after
+    return payload
+
+
+def error_response(e):
+    """
+    接口异常的统一响应：请求无效时返回400/404；上游繁忙时返回503并带 Retry-After 头，由客户端稍后重试；
+    任务队列已满时返回503；其他异常记录调用栈并返回500
+
+    Returns:
+        tuple: Flask 和 Quart 都能直接返回的 (响应数据, 状态码[, 响应头])
+    """
+    if isinstance(e, RequestError):
+        return error_payload(e), e.status
+    if isinstance(e, Overloaded):
+        return error_payload(e), 503, {'Retry-After': str(e.retry_after)}
+    if isinstance(e, JobQueueFull):
+        return error_payload(e), 503
+    traceback.print_exc()
+    return error_payload(e), 500
+
+
+def readiness(image_jobs):
+    """
+    就绪检查：已配置访问令牌且未在停止时返回200，否则返回503
+
+    静态页面和缓存内容不依赖上游，因此不等待连接预热完成；预热状态只随结果返回供参考
+    """
+    checks = {'token': bool(myToken), 'accepting_jobs': not image_jobs.closing}
+    ready = all(checks.values())
+    return {'status': 'ready' if ready else 'not ready', 'checks': checks,
+            'warm_up': dict(warm_up_status)}, 200 if ready else 503
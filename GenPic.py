@@ -1,48 +1,297 @@
 # -*- coding: utf-8 -*-
-import requests
+import asyncio
+import random
+import threading
 import time
 import json
 import os
 import hashlib
-from PIL import Image
-from io import BytesIO
-from myToken import myToken
+import tempfile
+from contextlib import nullcontext
+from ImageCache import ImageCache
+from Metrics import span
+from TaskPoller import TaskPoller
+from myToken import MODELSCOPE_BASE_URL, require_token
+
+# requests（同步会话）、httpx（只有异步接口使用）和 PIL（只在转换格式或缩放时使用）导入较慢，在用到时才导入
+
+# 可重试的HTTP状态码；提交任务（非幂等）只在服务端明确拒绝处理时重试
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+_RETRY_STATUS_SUBMIT = {429, 503}
+
+# 下载图片时每次写入磁盘的块大小
+_CHUNK_SIZE = 64 * 1024
+
+# 通过文件头魔数识别的图片格式
+_MAGIC_FORMATS = (
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+)
+
+
+def sniff_image_format(head):
+    """
+    根据文件头魔数识别图片格式，不解码图片内容
+    
+    Returns:
+        str: JPEG/PNG/GIF/WEBP，无法识别时返回None
+    """
+    for magic, image_format in _MAGIC_FORMATS:
+        if head.startswith(magic):
+            return image_format
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    return None
 
 
 class ImageGenerator:
     """图片生成器类，支持异步生成图片并保存到本地"""
     
-    def __init__(self, api_key=None, base_url="https://api-inference.modelscope.cn/", 
-                 model="Qwen/Qwen-Image", output_dir="images", poll_interval=3):
+    def __init__(self, api_key=None, base_url=MODELSCOPE_BASE_URL, 
+                 model="Qwen/Qwen-Image", output_dir="images", poll_interval=3, cache=None,
+                 pool_size=16, timeout=(5, 30), max_retries=3, backoff_base=0.5, backoff_max=8,
+                 poller=None, convert_format=None, max_size=None, limiter=None):
         """
         初始化图片生成器
         
         Args:
-            api_key: ModelScope Access Token，如果为None则从myToken导入
-            base_url: API基础URL
+            api_key: ModelScope Access Token，为None时使用环境变量 MODELSCOPE_KEY（在首次调用时才检查）
+            base_url: API基础URL，默认取自环境变量 MODELSCOPE_BASE_URL
             model: 默认模型名称
             output_dir: 图片保存目录
-            poll_interval: 轮询间隔（秒）
+            poll_interval: 最长轮询间隔（秒），实际间隔由轮询器根据历史完成耗时自适应调整
+            cache: 图片缓存（ImageCache），为None时在output_dir上创建默认缓存，为False时不使用缓存
+            pool_size: 每个主机保持的长连接数量上限
+            timeout: (连接超时, 读取超时)，单位秒
+            max_retries: 遇到429/5xx或网络错误时的最大重试次数
+            backoff_base: 指数退避的初始等待时间（秒）
+            backoff_max: 单次退避等待时间上限（秒）
+            poller: 任务轮询器（TaskPoller），为None时创建一个由所有任务共享的默认轮询器
+            convert_format: 需要转换成的图片格式（如 "JPEG"），为None时按原始字节保存，不做解码和重新编码
+            max_size: 图片最长边上限（像素），超出时缩小；为None时不缩放
+            limiter: 上游调用的准入控制（RateLimiter.Limiter），从提交任务到任务结束占用一个名额；为None时不限制
         """
-        self.api_key = api_key if api_key else myToken
+        self.api_key = api_key
         self.base_url = base_url.rstrip('/')
         self.model = model
         self.output_dir = output_dir
         self.poll_interval = poll_interval
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.convert_format = convert_format
+        self.max_size = max_size
+        self.limiter = limiter
         
         # 创建输出目录
         os.makedirs(self.output_dir, exist_ok=True)
         
-        # 设置通用请求头
-        self.common_headers = {
-            "Authorization": f"Bearer {self.api_key}",
+        self.cache = ImageCache(self.output_dir) if cache is None else (cache or None)
+        
+        # 同步会话在首次使用时创建
+        self._session = None
+        self._session_lock = threading.Lock()
+        
+        # 所有进行中的任务由同一个轮询器统一检查
+        self.poller = poller or TaskPoller(self._check_task, min_interval=min(0.5, poll_interval),
+                                           max_interval=poll_interval)
+        
+        # 异步客户端在首次使用时于当前事件循环中创建
+        self._async_client = None
+    
+    @property
+    def common_headers(self):
+        """通用请求头"""
+        return {
+            "Authorization": f"Bearer {require_token(self.api_key)}",
             "Content-Type": "application/json",
         }
     
+    @property
+    def session(self):
+        """复用连接的会话：提交、轮询和图片下载都不再为每个请求重新建立TCP/TLS连接"""
+        if self._session is None:
+            import requests
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size,
+                                                            pool_maxsize=self.pool_size)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+        return self._session
+    
+    def warm_up(self):
+        """预先建立到上游的连接（DNS解析和TLS握手不计入第一个任务），只有无法连接时抛出异常"""
+        self.session.head(self.base_url, timeout=self.timeout).close()
+    
+    async def awarm_up(self):
+        """warm_up 的异步版本，预热异步客户端的连接池"""
+        await self._get_async_client().head(self.base_url)
+    
+    def _admit(self, model=None):
+        """获取一次生成任务的配额，未配置准入控制时不限制"""
+        if self.limiter is None:
+            return nullcontext()
+        return self.limiter.acquire(model or self.model)
+    
+    def _aadmit(self, model=None):
+        """_admit 的协程版本"""
+        if self.limiter is None:
+            return nullcontext()
+        return self.limiter.aacquire(model or self.model)
+    
+    def _retry_delay(self, attempt, response=None):
+        """计算第attempt次重试前的等待时间：带全抖动的指数退避，并遵守Retry-After"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, min(float(retry_after), self.backoff_max))
+        return delay
+    
+    def _request(self, method, url, idempotent=True, **kwargs):
+        """
+        通过连接池发送请求，遇到可重试的状态码或网络错误时按指数退避重试
+        
+        Args:
+            method: HTTP方法
+            url: 请求地址
+            idempotent: 是否幂等；非幂等请求（提交任务）只在服务端明确拒绝或连接未建立时重试
+        
+        Returns:
+            requests.Response: 最后一次请求的响应
+        """
+        import requests
+        retry_status = _RETRY_STATUS if idempotent else _RETRY_STATUS_SUBMIT
+        retry_errors = ((requests.exceptions.ConnectionError, requests.exceptions.Timeout) if idempotent
+                        else (requests.exceptions.ConnectTimeout,))
+        for attempt in range(self.max_retries + 1):
+            response = None
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+                if response.status_code not in retry_status or attempt == self.max_retries:
+                    return response
+                response.close()
+            except retry_errors:
+                if attempt == self.max_retries:
+                    raise
+            time.sleep(self._retry_delay(attempt, response))
+    
     def _generate_md5(self, text):
         """生成文本的MD5哈希值"""
         return hashlib.md5(text.encode('utf-8')).hexdigest()
     
+    def _file_path(self, prompt):
+        """基于prompt的MD5生成本地文件路径（图片以 JPEG 保存，见 _needs_conversion）"""
+        return os.path.join(self.output_dir, f"{self._generate_md5(prompt)}.jpg")
+    
+    def _needs_conversion(self, image_format):
+        """是否需要重新编码：设置了 convert_format / max_size，或下载的不是 JPEG（文件按 .jpg 保存和发送）"""
+        return self.convert_format is not None or self.max_size is not None or image_format != "JPEG"
+    
+    def _temp_file(self, file_path):
+        """
+        在目标目录中创建临时文件，写完后通过 os.replace 原子地替换为目标文件
+
+        NamedTemporaryFile 创建的文件权限为 0600，替换后图片对其他用户（如单独运行的静态文件服务器）不可读，
+        因此创建后即改为 0644
+        """
+        tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(file_path) or ".", suffix=".part", delete=False)
+        os.chmod(tmp.name, 0o644)
+        return tmp
+    
+    def _check_format(self, head, url):
+        """
+        校验下载内容的文件头，确认是图片
+        
+        Returns:
+            str: 识别出的图片格式
+        """
+        image_format = sniff_image_format(head)
+        if image_format is None:
+            raise Exception(f"下载的内容不是可识别的图片: {url}")
+        return image_format
+    
+    def _convert_image(self, file_path):
+        """按 convert_format / max_size 对已保存的图片做格式转换或缩放，未指定格式时转换为 JPEG"""
+        from PIL import Image
+        with Image.open(file_path) as image:
+            image_format = self.convert_format or "JPEG"
+            if self.max_size is not None:
+                image.thumbnail((self.max_size, self.max_size))
+            if image_format.upper() == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            with self._temp_file(file_path) as tmp:
+                try:
+                    image.save(tmp, format=image_format)
+                except BaseException:
+                    tmp.close()
+                    os.remove(tmp.name)
+                    raise
+        os.replace(tmp.name, file_path)
+    
+    def _download_to_file(self, url, file_path):
+        """
+        以流式方式下载图片并分块写入磁盘，只通过文件头校验格式而不解码；
+        仅在设置了 convert_format / max_size 或下载的不是 JPEG 时才重新编码
+        """
+        response = self._request("GET", url, stream=True)
+        with response:
+            response.raise_for_status()
+            tmp = self._temp_file(file_path)
+            try:
+                with tmp:
+                    image_format = None
+                    for chunk in response.iter_content(chunk_size=_CHUNK_SIZE):
+                        if image_format is None:
+                            image_format = self._check_format(chunk, url)
+                        tmp.write(chunk)
+                    if image_format is None:
+                        raise Exception(f"下载的图片为空: {url}")
+                os.replace(tmp.name, file_path)
+            except BaseException:
+                if os.path.exists(tmp.name):
+                    os.remove(tmp.name)
+                raise
+        
+        if self._needs_conversion(image_format):
+            self._convert_image(file_path)
+        return file_path
+    
+    async def _adownload_to_file(self, url, file_path):
+        """_download_to_file 的异步版本"""
+        response = await self._arequest("GET", url, stream=True)
+        try:
+            response.raise_for_status()
+            tmp = self._temp_file(file_path)
+            try:
+                with tmp:
+                    image_format = None
+                    async for chunk in response.aiter_bytes(_CHUNK_SIZE):
+                        if image_format is None:
+                            image_format = self._check_format(chunk, url)
+                        tmp.write(chunk)
+                    if image_format is None:
+                        raise Exception(f"下载的图片为空: {url}")
+                os.replace(tmp.name, file_path)
+            except BaseException:
+                if os.path.exists(tmp.name):
+                    os.remove(tmp.name)
+                raise
+        finally:
+            await response.aclose()
+        
+        if self._needs_conversion(image_format):
+            # 图片解码和编码是CPU操作，放到线程中执行以免阻塞事件循环
+            await asyncio.to_thread(self._convert_image, file_path)
+        return file_path
+    
     def generate(self, prompt, model=None, **kwargs):
         """
         提交图片生成任务
@@ -55,6 +304,7 @@ class ImageGenerator:
         Returns:
             str: 任务ID (task_id)
         """
+        import requests
         if not prompt or not prompt.strip():
             raise ValueError("prompt不能为空")
         
@@ -66,11 +316,14 @@ class ImageGenerator:
         }
         
         try:
-            response = requests.post(
-                f"{self.base_url}/v1/images/generations",
-                headers={**self.common_headers, "X-ModelScope-Async-Mode": "true"},
-                data=json.dumps(request_data, ensure_ascii=False).encode('utf-8')
-            )
+            with span('image.submit', model):
+                response = self._request(
+                    "POST",
+                    f"{self.base_url}/v1/images/generations",
+                    idempotent=False,
+                    headers={**self.common_headers, "X-ModelScope-Async-Mode": "true"},
+                    data=json.dumps(request_data, ensure_ascii=False).encode('utf-8')
+                )
             
             response.raise_for_status()
             task_id = response.json()["task_id"]
@@ -97,43 +350,43 @@ class ImageGenerator:
             prompt = task_id
         
         # 生成基于prompt的MD5文件名
-        file_md5 = self._generate_md5(prompt)
-        file_path = os.path.join(self.output_dir, f"{file_md5}.jpg")
-        
-        while True:
-            try:
-                result = requests.get(
-                    f"{self.base_url}/v1/tasks/{task_id}",
-                    headers={**self.common_headers, "X-ModelScope-Task-Type": "image_generation"},
-                )
-                result.raise_for_status()
-                data = result.json()
-                
-                if data["task_status"] == "SUCCEED":
-                    # 下载并保存图片
-                    image_url = data["output_images"][0]
-                    image_response = requests.get(image_url)
-                    image_response.raise_for_status()
-                    
-                    # 保存图片
-                    image = Image.open(BytesIO(image_response.content))
-                    image.save(file_path)
-                    
-                    return file_path
-                    
-                elif data["task_status"] == "FAILED":
-                    error_msg = data.get("error_message", "图片生成失败")
-                    raise Exception(f"图片生成失败: {error_msg}")
-                
-                # 任务还在进行中，继续等待
-                time.sleep(self.poll_interval)
-                
-            except requests.exceptions.HTTPError as e:
-                raise Exception(f"轮询任务状态失败: {e}")
-            except Exception as e:
-                if "图片生成失败" in str(e):
-                    raise
-                raise Exception(f"轮询过程中发生错误: {e}")
+        return self._poll_to_file(task_id, self._file_path(prompt))
+    
+    def _check_task(self, task_id):
+        """查询一次任务状态，供轮询器调用"""
+        result = self._request(
+            "GET",
+            f"{self.base_url}/v1/tasks/{task_id}",
+            headers={**self.common_headers, "X-ModelScope-Task-Type": "image_generation"},
+        )
+        result.raise_for_status()
+        return result.json()
+    
+    def _task_image_url(self, data):
+        """从终止状态中取出图片地址，任务失败时抛出异常"""
+        if data["task_status"] == "FAILED":
+            error_msg = data.get("error_message", "图片生成失败")
+            raise Exception(f"图片生成失败: {error_msg}")
+        return data["output_images"][0]
+    
+    def _poll_to_file(self, task_id, file_path, model=None):
+        """等待轮询器报告任务完成，成功后将图片保存到指定路径"""
+        import requests
+        model = model or self.model
+        try:
+            with span('image.poll', model):
+                data = self.poller.submit(task_id, model).result()
+            
+            # 下载并保存图片
+            with span('image.download', model):
+                return self._download_to_file(self._task_image_url(data), file_path)
+            
+        except requests.exceptions.HTTPError as e:
+            raise Exception(f"轮询任务状态失败: {e}")
+        except Exception as e:
+            if "图片生成失败" in str(e):
+                raise
+            raise Exception(f"轮询过程中发生错误: {e}")
     
     def generate_and_save(self, prompt, model=None, **kwargs):
         """
@@ -147,9 +400,143 @@ class ImageGenerator:
         Returns:
             str: 图片的本地存储路径
         """
-        task_id = self.generate(prompt, model, **kwargs)
-        return self.poll(task_id, prompt)
+        if self.cache is None:
+            with self._admit(model):
+                task_id = self.generate(prompt, model, **kwargs)
+                return self.poll(task_id, prompt)
+        
+        # 先查缓存，未命中时由缓存保证相同参数的并发请求只提交一次远程任务
+        def create(file_path):
+            with self._admit(model):
+                task_id = self.generate(prompt, model, **kwargs)
+                return self._poll_to_file(task_id, file_path, model)
+        
+        key = self.cache.key(model or self.model, prompt, kwargs)
+        return self.cache.get_or_create(key, create)
 
+    
+    def _get_async_client(self):
+        """获取（必要时创建）带连接池的异步HTTP客户端"""
+        if self._async_client is None:
+            import httpx
+            connect_timeout, read_timeout = self.timeout
+            self._async_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=self.pool_size * 4, max_keepalive_connections=self.pool_size),
+            )
+        return self._async_client
+    
+    async def _arequest(self, method, url, idempotent=True, stream=False, **kwargs):
+        """_request 的异步版本，stream 为 True 时不预先读取响应体，调用方负责关闭响应"""
+        import httpx
+        retry_status = _RETRY_STATUS if idempotent else _RETRY_STATUS_SUBMIT
+        retry_errors = ((httpx.TransportError,) if idempotent
+                        else (httpx.ConnectError, httpx.ConnectTimeout))
+        client = self._get_async_client()
+        for attempt in range(self.max_retries + 1):
+            response = None
+            try:
+                response = await client.send(client.build_request(method, url, **kwargs), stream=stream)
+                if response.status_code not in retry_status or attempt == self.max_retries:
+                    return response
+                await response.aclose()
+            except retry_errors:
+                if attempt == self.max_retries:
+                    raise
+            await asyncio.sleep(self._retry_delay(attempt, response))
+    
+    def close(self):
+        """关闭同步HTTP会话及其连接池"""
+        if self._session is not None:
+            self._session.close()
+    
+    async def aclose(self):
+        """关闭异步HTTP客户端"""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+    
+    async def agenerate(self, prompt, model=None, **kwargs):
+        """
+        异步提交图片生成任务，参数与 generate 相同
+        
+        Returns:
+            str: 任务ID (task_id)
+        """
+        import httpx
+        if not prompt or not prompt.strip():
+            raise ValueError("prompt不能为空")
+        
+        model = model or self.model
+        request_data = {
+            "model": model,
+            "prompt": prompt,
+            **kwargs
+        }
+        
+        try:
+            with span('image.submit', model):
+                response = await self._arequest(
+                    "POST",
+                    f"{self.base_url}/v1/images/generations",
+                    idempotent=False,
+                    headers={**self.common_headers, "X-ModelScope-Async-Mode": "true"},
+                    content=json.dumps(request_data, ensure_ascii=False).encode('utf-8')
+                )
+            
+            response.raise_for_status()
+            return response.json()["task_id"]
+            
+        except httpx.HTTPStatusError as e:
+            error_msg = f"提交生成任务失败: {e}"
+            error_msg += f"\n错误详情: {e.response.text}"
+            raise Exception(error_msg)
+    
+    async def apoll(self, task_id, prompt=None):
+        """
+        异步轮询任务状态，等待期间让出事件循环而不占用线程；参数与返回值同 poll
+        """
+        if prompt is None:
+            prompt = task_id
+        
+        return await self._apoll_to_file(task_id, self._file_path(prompt))
+    
+    async def _apoll_to_file(self, task_id, file_path, model=None):
+        """异步等待轮询器报告任务完成，成功后将图片保存到指定路径（轮询器使用同步会话）"""
+        import httpx
+        import requests
+        model = model or self.model
+        future = self.poller.submit(task_id, model)
+        try:
+            with span('image.poll', model):
+                data = await asyncio.wrap_future(future)
+            
+            with span('image.download', model):
+                return await self._adownload_to_file(self._task_image_url(data), file_path)
+            
+        except (requests.exceptions.HTTPError, httpx.HTTPStatusError) as e:
+            raise Exception(f"轮询任务状态失败: {e}")
+        except Exception as e:
+            if "图片生成失败" in str(e):
+                raise
+            raise Exception(f"轮询过程中发生错误: {e}")
+    
+    async def agenerate_and_save(self, prompt, model=None, **kwargs):
+        """
+        异步生成图片并保存到本地（一步完成），参数与返回值同 generate_and_save
+        """
+        if self.cache is None:
+            async with self._aadmit(model):
+                task_id = await self.agenerate(prompt, model, **kwargs)
+                return await self.apoll(task_id, prompt)
+        
+        async def acreate(file_path):
+            async with self._aadmit(model):
+                task_id = await self.agenerate(prompt, model, **kwargs)
+                return await self._apoll_to_file(task_id, file_path, model)
+        
+        key = self.cache.key(model or self.model, prompt, kwargs)
+        return await self.cache.aget_or_create(key, acreate)
 
 # 使用示例
 if __name__ == "__main__":
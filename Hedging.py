@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+from collections import deque
+
+
+class HedgePolicy:
+    """按任务统计近期调用耗时，决定何时发出对冲请求
+
+    调用在该任务近期耗时的指定分位数之后仍未返回时，再发出一个相同的请求（可以发给备用模型），
+    取先完成的结果；对冲请求占近期调用的比例不超过 max_rate，避免上游整体变慢时成倍放大负载。
+    """
+
+    def __init__(self, percentile=0.95, window=200, min_samples=20, min_delay=0.5, max_rate=0.1):
+        """
+        初始化对冲策略
+
+        Args:
+            percentile: 等待时间取该任务近期耗时的分位数
+            window: 每个任务保留的近期耗时样本数，也是计算对冲比例的调用数
+            min_samples: 样本少于该数时不对冲
+            min_delay: 发出对冲前的最短等待时间（秒）
+            max_rate: 近期调用中对冲的最大比例
+        """
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_rate = max_rate
+        self._window = window
+        self._latencies = {}
+        self._recent = deque(maxlen=window)
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def delay(self, task):
+        """
+        发出对冲前应等待的时间
+
+        Returns:
+            float: 等待时间（秒），样本不足时返回None（不对冲）
+        """
+        with self._lock:
+            samples = self._latencies.get(task)
+            if samples is None or len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+        return max(self.min_delay, ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))])
+
+    def allow(self):
+        """近期对冲比例未超过上限时允许再发出一次对冲"""
+        with self._lock:
+            return sum(self._recent) < self.max_rate * max(len(self._recent), 1)
+
+    def observe(self, task, seconds, hedged=False, hedge_won=False, timed_out=False):
+        """
+        记录一次调用的结果
+
+        Args:
+            task: 任务类型
+            seconds: 从发出第一个请求到得到结果（或超时）的耗时
+            hedged: 是否发出了对冲请求
+            hedge_won: 结果是否来自对冲请求
+            timed_out: 是否超过了调用期限
+        """
+        with self._lock:
+            samples = self._latencies.get(task)
+            if samples is None:
+                samples = self._latencies[task] = deque(maxlen=self._window)
+            samples.append(seconds)
+            self._recent.append(hedged)
+            stats = self._stats.setdefault(task, {'calls': 0, 'hedged': 0, 'hedge_wins': 0, 'timeouts': 0})
+            stats['calls'] += 1
+            stats['hedged'] += hedged
+            stats['hedge_wins'] += hedge_won
+            stats['timeouts'] += timed_out
+
+    def stats(self):
+        """
+        获取各任务的对冲统计
+
+        Returns:
+            dict: {任务类型: {"calls", "hedged", "hedge_wins", "timeouts", "delay"}}，delay 为0表示当前不对冲
+        """
+        with self._lock:
+            result = {task: dict(stats) for task, stats in self._stats.items()}
+        for task, stats in result.items():
+            stats['delay'] = self.delay(task) or 0
+        return result
+
+
+def hedge_policy_from_env():
+    """
+    根据环境变量创建对冲策略
+
+    环境变量：
+        HEDGE: 设为 off 时不发出对冲请求（调用期限仍然生效）
+        HEDGE_PERCENTILE: 等待时间取近期耗时的分位数，默认0.95
+        HEDGE_MAX_RATE: 对冲请求占近期调用的最大比例，默认0.1
+        HEDGE_MIN_SAMPLES: 开始对冲前每个任务至少需要的样本数，默认20
+
+    Returns:
+        HedgePolicy: 策略实例，关闭时返回None
+    """
+    if os.getenv('HEDGE', 'on').lower() == 'off':
+        return None
+    return HedgePolicy(percentile=float(os.getenv('HEDGE_PERCENTILE', 0.95)),
+                       max_rate=float(os.getenv('HEDGE_MAX_RATE', 0.1)),
+                       min_samples=int(os.getenv('HEDGE_MIN_SAMPLES', 20)))
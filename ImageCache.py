@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future
+
+# 缓存文件名带有前缀，只有这些文件参与淘汰；目录中的其他文件（如仓库中同样以MD5命名的示例图片、
+# 未使用缓存时按提示词保存的图片）不受影响
+_CACHE_PREFIX = 'cache-'
+_CACHE_FILE_RE = re.compile(r'^cache-[0-9a-f]{32}\.jpg$')
+
+
+class ImageCache:
+    """按内容寻址的图片缓存
+
+    以 (模型, 提示词, 生成参数) 的哈希作为文件名，命中时直接返回本地文件；
+    相同参数的并发请求会合并为一次远程生成；目录按总大小和最近使用时间淘汰。
+    最近使用时间记录在文件的访问时间（atime）上，修改时间保持为生成时间，衍生版本据此判断是否过期。
+    """
+
+    def __init__(self, directory="images", max_bytes=512 * 1024 * 1024, max_age=7 * 24 * 3600,
+                 sweep_interval=60):
+        """
+        初始化图片缓存
+
+        Args:
+            directory: 缓存目录
+            max_bytes: 缓存文件总大小上限（字节），为None表示不限制
+            max_age: 文件最长未使用时间（秒），为None表示不限制
+            sweep_interval: 两次全目录淘汰扫描的最小间隔（秒）
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._ainflight = {}
+        self._total_bytes = None
+        self._last_sweep = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, model, prompt, params=None):
+        """
+        计算缓存键
+
+        Args:
+            model: 模型名称
+            prompt: 提示词
+            params: 其他生成参数
+
+        Returns:
+            str: 缓存键（MD5十六进制字符串）
+        """
+        payload = json.dumps({'model': model, 'prompt': prompt, 'params': params or {}},
+                             ensure_ascii=False, sort_keys=True)
+        return hashlib.md5(payload.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        """缓存键对应的本地文件路径"""
+        return os.path.join(self.directory, f"{_CACHE_PREFIX}{key}.jpg")
+
+    def get(self, key):
+        """
+        查找缓存
+
+        Returns:
+            str: 命中时返回本地路径，否则返回None
+        """
+        file_path = self.path(key)
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            self._count(hit=False)
+            return None
+
+        now = time.time()
+        if self.max_age is not None and now - stat.st_atime > self.max_age:
+            self._remove(file_path, stat.st_size)
+            self._count(hit=False)
+            return None
+
+        # 刷新访问时间，使淘汰按最近使用时间进行；修改时间不变，否则依赖它的衍生版本会被当作过期而重新生成
+        try:
+            os.utime(file_path, (now, stat.st_mtime))
+        except OSError:
+            pass
+        self._count(hit=True)
+        return file_path
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        """
+        获取命中统计
+
+        Returns:
+            dict: 包含hits、misses和inflight（正在生成的键数）的字典
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'inflight': len(self._inflight) + len(self._ainflight)}
+
+    def get_or_create(self, key, create):
+        """
+        查找缓存，未命中时调用create生成；相同键的并发调用只会执行一次create
+
+        Args:
+            key: 缓存键
+            create: 生成函数，接收目标文件路径，返回最终保存的路径
+
+        Returns:
+            str: 图片的本地路径
+        """
+        file_path = self.get(key)
+        if file_path:
+            return file_path
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = create(self.path(key))
+            future.set_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+        self._added(result)
+        return result
+
+    async def aget_or_create(self, key, acreate):
+        """
+        get_or_create 的异步版本，acreate 为接收目标文件路径的协程函数；查找和淘汰扫描目录在线程中执行
+        """
+        file_path = await asyncio.to_thread(self.get, key)
+        if file_path:
+            return file_path
+
+        future = self._ainflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._ainflight[key] = future
+        try:
+            result = await acreate(self.path(key))
+            future.set_result(result)
+        except asyncio.CancelledError:
+            future.set_exception(RuntimeError("图片生成任务已取消"))
+            future.exception()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            self._ainflight.pop(key, None)
+
+        await asyncio.to_thread(self._added, result)
+        return result
+
+    def _added(self, file_path):
+        """记录新文件并在需要时触发淘汰"""
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            return
+
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += size
+            over_budget = (self.max_bytes is not None and self._total_bytes is not None
+                           and self._total_bytes > self.max_bytes)
+            due = time.time() - self._last_sweep >= self.sweep_interval
+
+        if over_budget or due:
+            self.evict()
+
+    def _remove(self, file_path, size):
+        try:
+            os.remove(file_path)
+        except OSError:
+            return
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes -= size
+
+    def evict(self):
+        """
+        扫描缓存目录，删除超过最长未使用时间的文件，再按最近使用时间从旧到新删除直到总大小低于上限
+
+        Returns:
+            int: 删除的文件数
+        """
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.directory):
+            if not _CACHE_FILE_RE.match(name):
+                continue
+            file_path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, file_path))
+
+        removed = 0
+        kept = []
+        for atime, size, file_path in entries:
+            if self.max_age is not None and now - atime > self.max_age:
+                try:
+                    os.remove(file_path)
+                    removed += 1
+                except OSError:
+                    pass
+            else:
+                kept.append((atime, size, file_path))
+
+        total = sum(size for _, size, _ in kept)
+        if self.max_bytes is not None and total > self.max_bytes:
+            kept.sort()
+            for _, size, file_path in kept:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(file_path)
+                    removed += 1
+                    total -= size
+                except OSError:
+                    pass
+
+        with self._lock:
+            self._total_bytes = total
+            self._last_sweep = now
+
+        return removed
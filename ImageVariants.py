@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# 各输出格式对应的 Pillow 格式名、文件扩展名和 MIME 类型
+_FORMATS = {
+    'avif': ('AVIF', 'avif', 'image/avif'),
+    'webp': ('WEBP', 'webp', 'image/webp'),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg'),
+}
+
+# 客户端同时接受多种格式时按此顺序选择（压缩率从高到低）
+_PREFERENCE = ('avif', 'webp')
+
+# 默认编码质量，在保持漫画线条清晰的前提下尽量减小体积
+_DEFAULT_QUALITY = {'avif': 50, 'webp': 75, 'jpeg': 80}
+
+# 衍生文件名：<原文件名>[.<宽度>].<扩展名>，不带宽度的是原尺寸的格式转换版本
+_VARIANT_RE = re.compile(r'^(?P<source>.+\.(?:jpg|jpeg|png|gif|webp))(?:\.(?P<width>\d+))?\.(?:avif|webp|jpg)$',
+                         re.IGNORECASE)
+
+
+def supported_formats():
+    """
+    当前 Pillow 能编码的现代图片格式（首次调用时才导入 Pillow 及其插件）
+
+    AVIF 编码需要 Pillow 的 AVIF 支持：新版 Pillow 自带，旧版可安装 pillow-avif-plugin；都不可用时只生成 WebP
+
+    Returns:
+        tuple: avif/webp 中可用的格式
+    """
+    from PIL import Image
+    try:
+        import pillow_avif  # noqa: F401
+    except ImportError:
+        pass
+    Image.init()
+    return tuple(name for name in _PREFERENCE if _FORMATS[name][0] in Image.SAVE)
+
+
+def _accepted(accept, mimetype):
+    """Accept 头中是否明确接受该 MIME 类型（q=0 表示拒绝）"""
+    for item in (accept or '').split(','):
+        media, _, params = item.strip().partition(';')
+        if media.strip().lower() != mimetype:
+            continue
+        quality = re.search(r'q=([0-9.]+)', params)
+        return quality is None or float(quality.group(1)) > 0
+    return False
+
+
+class ImageVariants:
+    """生成图片的缩略图和 WebP/AVIF 版本，并按请求参数或 Accept 头选择合适的版本
+
+    图片保存后由 schedule() 在后台线程池中预生成全部衍生版本；请求的版本尚未生成时在请求中即时生成。
+    衍生文件保存在单独目录中，原图被缓存淘汰后对应的衍生文件也会在下次清理时删除。
+    """
+
+    def __init__(self, source_dir="images", variant_dir=None, widths=(320, 640, 1024), formats=_PREFERENCE,
+                 quality=None, workers=2, sweep_interval=600):
+        """
+        初始化衍生图片生成器
+
+        Args:
+            source_dir: 原图目录
+            variant_dir: 衍生文件目录，默认为原图目录下的 variants
+            widths: 缩略图宽度（像素），请求的宽度向上取到最接近的一档，超过最大档时使用原尺寸
+            formats: 要生成的现代格式，当前 Pillow 不支持的格式会被忽略
+            quality: 各格式的编码质量，如 {'webp': 80}，未指定的使用默认值
+            workers: 预生成衍生版本的线程数
+            sweep_interval: 两次清理孤立衍生文件的最小间隔（秒）
+        """
+        self.source_dir = source_dir
+        self.variant_dir = variant_dir or os.path.join(source_dir, 'variants')
+        self.widths = tuple(sorted(widths))
+        self._requested_formats = tuple(formats)
+        self._formats = None
+        self.quality = {**_DEFAULT_QUALITY, **(quality or {})}
+        self.sweep_interval = sweep_interval
+
+        os.makedirs(self.variant_dir, exist_ok=True)
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-variants")
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._last_sweep = 0
+        self.generated = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def formats(self):
+        """实际生成的现代格式（去掉当前 Pillow 不支持的）"""
+        if self._formats is None:
+            available = supported_formats()
+            self._formats = tuple(name for name in self._requested_formats if name in available)
+        return self._formats
+
+    def negotiate(self, accept=None, image_format=None, width=None):
+        """
+        选择要返回的版本
+
+        Args:
+            accept: 请求的 Accept 头
+            image_format: 显式指定的格式（avif/webp/jpeg），优先于 Accept 头
+            width: 期望的显示宽度（像素）
+
+        Returns:
+            tuple: (格式, 宽度)，格式为None表示原格式，宽度为None表示原尺寸
+        """
+        image_format = (image_format or '').lower()
+        if image_format == 'jpg':
+            image_format = 'jpeg'
+        if image_format not in self.formats and image_format != 'jpeg':
+            image_format = next((name for name in self.formats if _accepted(accept, _FORMATS[name][2])), None)
+
+        if width is not None and width > 0:
+            width = next((size for size in self.widths if size >= width), None)
+        else:
+            width = None
+        return image_format, width
+
+    def path(self, filename, image_format, width=None):
+        """衍生文件的本地路径"""
+        suffix = f".{width}" if width is not None else ''
+        return os.path.join(self.variant_dir, f"{filename}{suffix}.{_FORMATS[image_format][1]}")
+
+    def _source(self, filename):
+        """原图路径，文件名不合法或原图不存在时返回None"""
+        if not filename or os.path.basename(filename) != filename or filename.startswith('.'):
+            return None
+        source = os.path.join(self.source_dir, filename)
+        return source if os.path.isfile(source) else None
+
+    def _plan(self, filename, image_format, width):
+        """
+        确定要返回的衍生文件
+
+        Returns:
+            tuple: (原图路径, 衍生文件路径, 格式, 宽度)，原尺寸的原格式或原图不存在时返回None
+        """
+        if image_format in (None, 'jpeg') and width is None:
+            return None
+        source = self._source(filename)
+        if source is None:
+            return None
+        # 只缩小尺寸时保持常见的 JPEG 格式
+        image_format = image_format or 'jpeg'
+        return source, self.path(filename, image_format, width), image_format, width
+
+    def _fresh(self, source, target):
+        """衍生文件存在且不早于原图"""
+        try:
+            return os.stat(target).st_mtime >= os.stat(source).st_mtime
+        except OSError:
+            return False
+
+    def get(self, filename, accept=None, image_format=None, width=None):
+        """
+        获取（必要时生成）适合本次请求的版本
+
+        Args:
+            filename: 原图文件名
+            accept: 请求的 Accept 头
+            image_format: 显式指定的格式
+            width: 期望的显示宽度（像素）
+
+        Returns:
+            tuple: (文件绝对路径, MIME类型)，应直接返回原图时（未要求转换、原图不存在等）返回None
+        """
+        plan = self._plan(filename, *self.negotiate(accept, image_format, width))
+        if plan is None:
+            return None
+        source, target, image_format, width = plan
+        fresh = self._fresh(source, target)
+        self._count(fresh)
+        if not fresh:
+            self._render(source, [(image_format, width)])
+        return os.path.abspath(target), _FORMATS[image_format][2]
+
+    async def aget(self, filename, accept=None, image_format=None, width=None):
+        """get 的协程版本，需要即时生成时在线程中编码，不阻塞事件循环"""
+        plan = self._plan(filename, *self.negotiate(accept, image_format, width))
+        if plan is None:
+            return None
+        source, target, image_format, width = plan
+        fresh = self._fresh(source, target)
+        self._count(fresh)
+        if not fresh:
+            await asyncio.to_thread(self._render, source, [(image_format, width)])
+        return os.path.abspath(target), _FORMATS[image_format][2]
+
+    def variants(self):
+        """预生成的全部版本：各缩略图宽度的 JPEG 和现代格式，以及原尺寸的现代格式"""
+        sizes = self.widths + (None,)
+        return ([('jpeg', width) for width in self.widths]
+                + [(image_format, width) for image_format in self.formats for width in sizes])
+
+    def schedule(self, file_path):
+        """
+        在后台预生成一张图片的全部衍生版本，已是最新的版本会跳过
+
+        Args:
+            file_path: 刚保存的原图路径
+
+        Returns:
+            Future: 生成任务；同一张图片已在生成中时返回进行中的任务
+        """
+        filename = os.path.basename(file_path)
+        source = self._source(filename)
+        if source is None:
+            return None
+        with self._lock:
+            future = self._inflight.get(source)
+            if future is not None:
+                return future
+            future = self._executor.submit(self._render_all, source, filename)
+            self._inflight[source] = future
+        future.add_done_callback(lambda _: self._done(source))
+        return future
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _done(self, source):
+        with self._lock:
+            self._inflight.pop(source, None)
+
+    def _render_all(self, source, filename):
+        pending = [(image_format, width) for image_format, width in self.variants()
+                   if not self._fresh(source, self.path(filename, image_format, width))]
+        if pending:
+            self._render(source, pending)
+        if time.time() - self._last_sweep >= self.sweep_interval:
+            self.sweep()
+
+    def _render(self, source, variants):
+        """
+        解码原图一次，按宽度从大到小依次缩放并编码所需的各个版本
+
+        Args:
+            source: 原图路径
+            variants: [(格式, 宽度)] 列表，宽度为None表示原尺寸
+        """
+        from PIL import Image
+        filename = os.path.basename(source)
+        with Image.open(source) as original:
+            image = original.convert('RGB') if original.mode not in ('RGB', 'L') else original.copy()
+        # 按宽度从大到小处理，每次在上一次的结果上继续缩小，减少重采样的像素量
+        for width in sorted({width for _, width in variants}, key=lambda w: -(w or 1 << 30)):
+            if width is not None and image.width > width:
+                image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+            for image_format, variant_width in variants:
+                if variant_width == width:
+                    self._save(image, self.path(filename, image_format, width), image_format)
+
+    def _save(self, image, target, image_format):
+        """编码并以原子替换的方式写入衍生文件，并发生成同一版本时不会读到不完整的文件"""
+        pil_format = _FORMATS[image_format][0]
+        options = {'quality': self.quality[image_format]}
+        if image_format == 'jpeg':
+            options.update(optimize=True, progressive=True)
+        elif image_format == 'webp':
+            options['method'] = 4
+        with tempfile.NamedTemporaryFile(dir=self.variant_dir, suffix=".part", delete=False) as tmp:
+            try:
+                image.save(tmp, format=pil_format, **options)
+            except Exception:
+                os.remove(tmp.name)
+                raise
+        # 临时文件只有属主可读写，改为与普通文件相同的权限再替换
+        os.chmod(tmp.name, 0o644)
+        os.replace(tmp.name, target)
+        with self._lock:
+            self.generated += 1
+
+    def sweep(self):
+        """
+        删除原图已不存在的衍生文件（原图会被图片缓存按大小和时间淘汰）
+
+        Returns:
+            int: 删除的文件数
+        """
+        self._last_sweep = time.time()
+        removed = 0
+        for name in os.listdir(self.variant_dir):
+            match = _VARIANT_RE.match(name)
+            if match is None or os.path.exists(os.path.join(self.source_dir, match.group('source'))):
+                continue
+            try:
+                os.remove(os.path.join(self.variant_dir, name))
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def stats(self):
+        """
+        获取统计
+
+        Returns:
+            dict: 包含generated（已编码的文件数）、hits/misses（请求的版本是否已生成）和pending（等待预生成的图片数）的字典
+        """
+        with self._lock:
+            return {'generated': self.generated, 'hits': self.hits, 'misses': self.misses,
+                    'pending': len(self._inflight)}
+
+    def close(self):
+        """停止预生成，丢弃尚未开始的任务"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def image_variants_from_env(source_dir="images"):
+    """
+    根据环境变量创建衍生图片生成器
+
+    环境变量：
+        IMAGE_VARIANTS: 设为 off 时不生成衍生版本，/images 直接返回原图
+        IMAGE_VARIANT_WIDTHS: 缩略图宽度，逗号分隔，默认 320,640,1024
+        IMAGE_VARIANT_FORMATS: 现代格式，逗号分隔，默认 avif,webp（不支持的格式自动忽略）
+        IMAGE_VARIANT_WORKERS: 预生成线程数，默认2
+
+    Returns:
+        ImageVariants: 生成器实例，关闭时返回None
+    """
+    if os.getenv('IMAGE_VARIANTS', 'on').lower() == 'off':
+        return None
+    widths = [int(width) for width in os.getenv('IMAGE_VARIANT_WIDTHS', '320,640,1024').split(',') if width.strip()]
+    formats = [name.strip().lower() for name in os.getenv('IMAGE_VARIANT_FORMATS', ','.join(_PREFERENCE)).split(',')
+               if name.strip()]
+    return ImageVariants(source_dir, widths=widths, formats=formats,
+                         workers=int(os.getenv('IMAGE_VARIANT_WORKERS', 2)))
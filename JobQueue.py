@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from Metrics import record
+
+# 任务的终止状态
+FINAL_STATUS = ('succeeded', 'failed', 'cancelled')
+
+# 任务状态在共享存储中的键前缀
+_STORE_PREFIX = 'job:'
+
+# 等待其他进程受理的任务时查询共享存储的间隔（秒）
+_SHARED_POLL = 0.5
+
+
+class JobQueueFull(Exception):
+    """排队中的任务数已达上限"""
+
+
+class JobQueue:
+    """带优先级和会话间公平调度的后台任务队列
+
+    任务提交后立即返回任务ID，由固定数量的后台worker执行，HTTP请求数与进行中的生成任务数互不绑定。
+    调度顺序为 (优先级, 该会话中排在前面的任务数, 提交顺序)：优先级数值越小越先执行，
+    同一优先级下各会话轮流执行，某个会话一次提交大量任务不会让其他会话一直等待。
+    多进程部署时可传入共享存储，任务状态会同步写入其中，任一进程都能查询到其他进程受理的任务。
+    """
+
+    def __init__(self, run, workers=4, max_pending=1000, ttl=3600, store=None, drain_timeout=30):
+        """
+        初始化任务队列
+
+        Args:
+            run: 执行函数，接收任务参数并返回结果
+            workers: 同时执行的任务数
+            max_pending: 最多排队的任务数，超出时 submit 抛出 JobQueueFull
+            ttl: 已结束的任务保留时间（秒），之后无法再查询
+            store: 共享存储（SessionStore.SQLiteSessionStore），为None时任务只能在受理它的进程中查询
+            drain_timeout: drain 默认等待已受理任务完成的时间（秒）
+        """
+        self.run = run
+        self.workers = workers
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.store = store
+        self.drain_timeout = drain_timeout
+        self._closing = False
+
+        self._jobs = OrderedDict()
+        self._heap = []
+        self._seq = itertools.count()
+        self._active = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._threads = []
+
+    def submit(self, payload, session=None, priority=0):
+        """
+        提交任务
+
+        Args:
+            payload: 传给执行函数的任务参数
+            session: 会话标识，用于会话间公平调度
+            priority: 优先级，数值越小越先执行
+
+        Returns:
+            str: 任务ID
+
+        Raises:
+            JobQueueFull: 排队中的任务数已达上限
+        """
+        with self._lock:
+            self._expire()
+            if self._closing:
+                raise JobQueueFull("服务正在停止，请稍后再试")
+            if self._pending >= self.max_pending:
+                raise JobQueueFull("任务队列已满，请稍后再试")
+            rank = self._active.get(session, 0)
+            self._active[session] = rank + 1
+            self._pending += 1
+            job = {
+                'id': uuid.uuid4().hex,
+                'status': 'queued',
+                'payload': payload,
+                'session': session,
+                'key': (priority, rank, next(self._seq)),
+                'result': None,
+                'error': None,
+                'exception': None,
+                'created': time.time(),
+                'started': None,
+                'finished': None,
+                'callbacks': [],
+                # 任务在提交时的上下文中执行，使其耗时记录归入提交它的请求
+                'context': contextvars.copy_context(),
+            }
+            self._jobs[job['id']] = job
+            heapq.heappush(self._heap, (job['key'], job['id']))
+            state = self._public(job)
+        self._persist(state)
+        self._ensure_workers()
+        self._wake()
+        return job['id']
+
+    def get(self, job_id):
+        """
+        查询任务状态
+
+        Returns:
+            dict: 包含id、status、result、error、queued_ahead和各时间点的字典，任务不存在时返回None
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return self._public(job)
+        return self._shared(job_id)
+
+    def wait(self, job_id, timeout=None):
+        """
+        阻塞等待任务结束
+
+        Returns:
+            dict: 任务状态（超时时可能尚未结束），任务不存在时返回None
+        """
+        with self._cond:
+            if job_id in self._jobs or self.store is None:
+                self._cond.wait_for(
+                    lambda: job_id not in self._jobs or self._jobs[job_id]['status'] in FINAL_STATUS, timeout
+                )
+                job = self._jobs.get(job_id)
+                return self._public(job) if job is not None else None
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            state = self._shared(job_id)
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if state is None or state['status'] in FINAL_STATUS or (remaining is not None and remaining <= 0):
+                return state
+            time.sleep(_SHARED_POLL if remaining is None else min(_SHARED_POLL, remaining))
+
+    def result(self, job_id, timeout=None):
+        """
+        阻塞等待任务结束并返回结果
+
+        Raises:
+            执行函数抛出的原始异常；超时时抛出 TimeoutError，任务被取消或不存在时抛出 Exception
+        """
+        self.wait(job_id, timeout)
+        return self._outcome(job_id)
+
+    def on_done(self, job_id, callback):
+        """
+        登记任务结束时的回调，参数为任务状态；任务已结束时立即调用
+
+        Returns:
+            bool: 任务是否存在
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return False
+            if job['status'] not in FINAL_STATUS:
+                job['callbacks'].append(callback)
+                return True
+            state = self._public(job)
+        callback(state)
+        return True
+
+    def cancel(self, job_id):
+        """
+        取消尚未开始的任务
+
+        Returns:
+            bool: 是否已取消
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] != 'queued':
+                return False
+            self._pending -= 1
+        self._finish(job, status='cancelled')
+        return True
+
+    def promote(self, job_id, priority):
+        """
+        提高排队中任务的优先级（例如用户开始等待原本预生成的图片）
+
+        Returns:
+            bool: 是否已调整（任务不存在、已开始或优先级不低于 priority 时返回False）
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] != 'queued' or job['key'][0] <= priority:
+                return False
+            # 原位置的堆元素留在堆中，任务开始后被 _take 跳过
+            job['key'] = (priority,) + job['key'][1:]
+            heapq.heappush(self._heap, (job['key'], job_id))
+        self._wake()
+        return True
+
+    @property
+    def closing(self):
+        """是否已开始停止（drain），此后不再受理新任务"""
+        return self._closing
+
+    def drain(self, timeout=None, max_priority=None):
+        """
+        停止受理新任务并等待已受理的任务完成，用于平滑退出
+
+        Args:
+            timeout: 最长等待时间（秒），为None时使用 drain_timeout
+            max_priority: 优先级数值大于该值的排队任务（如预生成）直接取消而不再执行
+
+        Returns:
+            bool: 是否在期限内全部完成
+        """
+        for job_id in self._start_drain(max_priority):
+            self.cancel(job_id)
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._unfinished(),
+                                       self.drain_timeout if timeout is None else timeout)
+
+    def stats(self):
+        """
+        获取队列统计
+
+        Returns:
+            dict: 包含queued、running、sessions的字典
+        """
+        with self._lock:
+            running = sum(1 for job in self._jobs.values() if job['status'] == 'running')
+            return {'queued': self._pending, 'running': running, 'sessions': len(self._active)}
+
+    def _outcome(self, job_id):
+        """已结束任务的结果，失败时抛出原始异常"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                raise Exception("任务不存在或已过期")
+            status, result, exception = job['status'], job['result'], job['exception']
+        if status == 'succeeded':
+            return result
+        if exception is not None:
+            raise exception
+        if status == 'cancelled':
+            raise Exception("任务已取消")
+        raise TimeoutError("等待任务超时")
+
+    def _start_drain(self, max_priority):
+        """停止受理新任务，返回需要取消的排队任务"""
+        with self._lock:
+            self._closing = True
+            if max_priority is None:
+                return []
+            return [job_id for job_id, job in self._jobs.items()
+                    if job['status'] == 'queued' and job['key'][0] > max_priority]
+
+    def _unfinished(self):
+        """是否还有排队或执行中的任务（调用方持有锁）"""
+        return any(job['status'] not in FINAL_STATUS for job in self._jobs.values())
+
+    def _persist(self, state):
+        """把任务状态写入共享存储"""
+        if self.store is not None:
+            state = {key: value for key, value in state.items() if key != 'queued_ahead'}
+            self.store.put(_STORE_PREFIX + state['id'], state)
+
+    def _shared(self, job_id):
+        """从共享存储读取其他进程受理的任务状态"""
+        if self.store is None:
+            return None
+        return self.store.get(_STORE_PREFIX + job_id)
+
+    def _public(self, job):
+        """任务的对外状态（调用方持有锁）"""
+        state = {key: job[key] for key in ('id', 'status', 'result', 'error', 'created', 'started', 'finished')}
+        if job['status'] == 'queued':
+            state['queued_ahead'] = sum(
+                1 for key, job_id in self._heap
+                if key < job['key'] and self._jobs.get(job_id, {}).get('status') == 'queued'
+                and self._jobs[job_id]['key'] == key
+            )
+        return state
+
+    def _take(self):
+        """取出下一个要执行的任务（调用方持有锁）"""
+        while self._heap:
+            _, job_id = heapq.heappop(self._heap)
+            job = self._jobs.get(job_id)
+            if job is not None and job['status'] == 'queued':
+                job['status'] = 'running'
+                job['started'] = time.time()
+                self._pending -= 1
+                return job
+        return None
+
+    def _finish(self, job, result=None, error=None, status=None):
+        with self._cond:
+            job['status'] = status or ('failed' if error is not None else 'succeeded')
+            job['result'] = result
+            job['error'] = str(error) if error is not None else None
+            job['exception'] = error
+            job['finished'] = time.time()
+            remaining = self._active.get(job['session'], 1) - 1
+            if remaining > 0:
+                self._active[job['session']] = remaining
+            else:
+                self._active.pop(job['session'], None)
+            callbacks, job['callbacks'] = job['callbacks'], []
+            state = self._public(job)
+            self._cond.notify_all()
+        self._persist(state)
+        for callback in callbacks:
+            callback(state)
+
+    def _execute(self, job):
+        record('job.queue_wait', job['started'] - job['created'])
+        self._persist(self.get(job['id']))
+        return self.run(job['payload'])
+
+    def _expire(self):
+        """移除过期的已结束任务（调用方持有锁）"""
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job['status'] in FINAL_STATUS and now - job['finished'] > self.ttl]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _ensure_workers(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._worker, name="job-worker", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _wake(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._take()
+                while job is None:
+                    self._cond.wait()
+                    job = self._take()
+            try:
+                result = job['context'].run(self._execute, job)
+            except Exception as e:
+                self._finish(job, error=e)
+            else:
+                self._finish(job, result)
+
+
+class AsyncJobQueue(JobQueue):
+    """JobQueue 的协程版本：执行函数为协程函数，worker 是事件循环中的任务，所有方法需在事件循环中调用
+
+    共享存储的读写在线程中执行，不阻塞事件循环；状态写入由单个线程按提交顺序完成。
+    """
+
+    def __init__(self, run, workers=4, max_pending=1000, ttl=3600, store=None, drain_timeout=30):
+        super().__init__(run, workers=workers, max_pending=max_pending, ttl=ttl, store=store,
+                         drain_timeout=drain_timeout)
+        self._tasks = []
+        self._wakeup = None
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store") if store is not None else None
+
+    async def aget(self, job_id):
+        """get 的协程版本"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return self._public(job)
+        if self.store is None:
+            return None
+        return await asyncio.to_thread(self._shared, job_id)
+
+    async def await_job(self, job_id, timeout=None):
+        """
+        等待任务结束而不占用线程
+
+        Returns:
+            dict: 任务状态（超时时可能尚未结束），任务不存在时返回None
+        """
+        future = asyncio.get_running_loop().create_future()
+
+        def done(state):
+            if not future.done():
+                future.set_result(state)
+
+        if not self.on_done(job_id, done):
+            return await self._await_shared(job_id, timeout)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            return await self.aget(job_id)
+
+    async def _await_shared(self, job_id, timeout=None):
+        """等待其他进程受理的任务结束"""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            state = await asyncio.to_thread(self._shared, job_id)
+            remaining = None if deadline is None else deadline - loop.time()
+            if state is None or state['status'] in FINAL_STATUS or (remaining is not None and remaining <= 0):
+                return state
+            await asyncio.sleep(_SHARED_POLL if remaining is None else min(_SHARED_POLL, remaining))
+
+    async def adrain(self, timeout=None, max_priority=None):
+        """drain 的协程版本"""
+        for job_id in self._start_drain(max_priority):
+            self.cancel(job_id)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (self.drain_timeout if timeout is None else timeout)
+        while True:
+            with self._lock:
+                if not self._unfinished():
+                    return True
+            if loop.time() >= deadline:
+                return False
+            await asyncio.sleep(0.1)
+
+    async def await_result(self, job_id, timeout=None):
+        """result 的协程版本"""
+        await self.await_job(job_id, timeout)
+        return self._outcome(job_id)
+
+    def _ensure_workers(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.ensure_future(self._aworker()))
+
+    def _wake(self):
+        self._wakeup.set()
+
+    async def _aworker(self):
+        while True:
+            with self._lock:
+                job = self._take()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            try:
+                # 在任务自己的上下文中创建协程任务，上下文变量的修改不会影响worker
+                result = await job['context'].run(asyncio.ensure_future, self._aexecute(job))
+            except Exception as e:
+                self._finish(job, error=e)
+            else:
+                self._finish(job, result)
+
+    async def _aexecute(self, job):
+        record('job.queue_wait', job['started'] - job['created'])
+        self._persist(self.get(job['id']))
+        return await self.run(job['payload'])
+
+    def _persist(self, state):
+        if self._writer is not None:
+            self._writer.submit(super()._persist, state)
+
+    async def aclose(self):
+        """停止所有worker，并等待尚未写入共享存储的任务状态写完"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._writer is not None:
+            await asyncio.to_thread(self._writer.shutdown)
+
+
+def job_queue_from_env(run, queue_class=JobQueue, store=None):
+    """
+    根据环境变量创建图片任务队列
+
+    Args:
+        run: 执行函数
+        queue_class: JobQueue 或 AsyncJobQueue
+        store: 会话存储；为多进程共享的存储时，任务状态同步写入其中
+
+    环境变量：
+        IMAGE_WORKERS: 同时执行的图片生成任务数
+        JOB_MAX_PENDING: 最多排队的任务数
+        JOB_TTL: 已结束的任务保留时间（秒）
+        JOB_DRAIN_TIMEOUT: 退出时等待已受理任务完成的时间（秒）
+
+    Returns:
+        JobQueue: queue_class 的实例
+    """
+    return queue_class(
+        run,
+        workers=int(os.getenv('IMAGE_WORKERS', 4)),
+        max_pending=int(os.getenv('JOB_MAX_PENDING', 1000)),
+        ttl=float(os.getenv('JOB_TTL', 3600)),
+        store=store if store is not None and store.shared else None,
+        drain_timeout=float(os.getenv('JOB_DRAIN_TIMEOUT', 30)),
+    )
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def completion_key(model, messages, params=None):
+    """
+    计算对话补全的缓存键
+
+    Args:
+        model: 模型名称
+        messages: 完整的消息列表
+        params: 采样参数（如temperature、max_tokens）
+
+    Returns:
+        str: 缓存键（SHA256十六进制字符串）
+    """
+    payload = json.dumps({'model': model, 'messages': messages, 'params': params or {}},
+                         ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class CompletionCache:
+    """内存中的补全结果缓存，按最近使用淘汰（LRU）并带过期时间（TTL）"""
+
+    def __init__(self, max_entries=1024, ttl=3600):
+        """
+        初始化缓存
+
+        Args:
+            max_entries: 最大条目数
+            ttl: 条目有效期（秒），为None表示不过期
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        查找缓存
+
+        Returns:
+            str: 命中时返回缓存的回复，否则返回None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, created = entry
+                if self.ttl is None or time.time() - created <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """
+        获取命中统计
+
+        Returns:
+            dict: 包含hits、misses和size的字典
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+class SQLiteCompletionCache(CompletionCache):
+    """基于SQLite的补全结果缓存，可在进程重启和多个进程之间共享"""
+
+    def __init__(self, path, max_entries=10000, ttl=24 * 3600):
+        """
+        初始化缓存
+
+        Args:
+            path: SQLite数据库文件路径
+            max_entries: 最大条目数
+            ttl: 条目有效期（秒），为None表示不过期
+        """
+        super().__init__(max_entries=max_entries, ttl=ttl)
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)")
+            self._conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                value, created = row
+                if self.ttl is None or now - created <= self.ttl:
+                    self._conn.execute("UPDATE completions SET accessed = ? WHERE key = ?", (now, key))
+                    self._conn.commit()
+                    self.hits += 1
+                    return value
+                self._conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self._conn.commit()
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO completions (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            self._conn.execute(
+                "DELETE FROM completions WHERE key IN ("
+                "SELECT key FROM completions ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+            return {'hits': self.hits, 'misses': self.misses, 'size': size}
+
+
+def completion_cache_from_env():
+    """
+    根据环境变量创建补全缓存
+
+    环境变量：
+        LLM_CACHE: 设为 off 时关闭缓存
+        LLM_CACHE_DB: SQLite数据库路径，设置后使用持久化缓存，否则使用内存缓存
+        LLM_CACHE_TTL: 条目有效期（秒）
+        LLM_CACHE_SIZE: 最大条目数
+
+    Returns:
+        CompletionCache: 缓存实例，关闭时返回None
+    """
+    if os.getenv('LLM_CACHE', 'memory').lower() == 'off':
+        return None
+
+    ttl = float(os.getenv('LLM_CACHE_TTL', 3600))
+    db_path = os.getenv('LLM_CACHE_DB')
+    if db_path:
+        return SQLiteCompletionCache(db_path, max_entries=int(os.getenv('LLM_CACHE_SIZE', 10000)), ttl=ttl)
+    return CompletionCache(max_entries=int(os.getenv('LLM_CACHE_SIZE', 1024)), ttl=ttl)
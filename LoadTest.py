@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+完整游戏流程的压测工具
+
+每个虚拟玩家依次请求：测试题 → 开始游戏 → 4个阶段（每阶段生成内容并选择一个选项生成结局）→ 人生回顾，
+统计各接口的 p50/p95/p99 耗时、错误数和吞吐量。
+
+用法：
+    # 启动模拟服务和应用后压测（不需要网络和真实token）
+    python LoadTest.py --spawn --sessions 20 --concurrency 5
+    # 压测已在运行的服务
+    python LoadTest.py --url http://127.0.0.1:7860 --sessions 50 --concurrency 10 --stream
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+# 玩家基础信息的取值范围，各玩家随机组合以避免全部命中缓存
+GENDERS = ['男', '女']
+MBTIS = ['INTJ', 'INFP', 'ENTP', 'ESFJ', 'ISTP', 'ENFJ']
+ZODIACS = ['白羊座', '巨蟹座', '天秤座', '摩羯座']
+BACKGROUNDS = ['城市普通家庭', '农村家庭', '书香门第', '商人家庭']
+
+STAGE_COUNT = 4
+
+
+def percentile(values, q):
+    """线性插值的分位数，values 需已排序"""
+    if not values:
+        return None
+    position = (len(values) - 1) * q
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+class Recorder:
+    """按接口记录每次请求的耗时和结果"""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds, ok):
+        with self._lock:
+            self.samples.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, elapsed, sessions, failed_sessions):
+        endpoints = {}
+        total = 0
+        for name, values in self.samples.items():
+            values = sorted(values)
+            total += len(values)
+            endpoints[name] = {
+                'count': len(values),
+                'errors': self.errors.get(name, 0),
+                'mean': sum(values) / len(values),
+                'p50': percentile(values, 0.5),
+                'p95': percentile(values, 0.95),
+                'p99': percentile(values, 0.99),
+                'max': values[-1],
+            }
+        return {
+            'elapsed': elapsed,
+            'sessions': sessions,
+            'failed_sessions': failed_sessions,
+            'sessions_per_second': sessions / elapsed if elapsed else 0,
+            'requests': total,
+            'requests_per_second': total / elapsed if elapsed else 0,
+            'endpoints': endpoints,
+        }
+
+
+class Player:
+    """一个虚拟玩家，play() 走完一局完整游戏"""
+
+    def __init__(self, base_url, recorder, stream=False, timeout=300):
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.stream = stream
+        self.timeout = timeout
+        self.http = requests.Session()
+
+    def _post(self, path, payload, name=None):
+        name = name or path
+        started = time.perf_counter()
+        try:
+            response = self.http.post(self.base_url + path, json=payload, timeout=self.timeout)
+            data = response.json()
+            ok = response.status_code == 200 and data.get('success', False)
+        except (requests.RequestException, ValueError) as e:
+            data, ok = {'success': False, 'error': str(e)}, False
+        self.recorder.add(name, time.perf_counter() - started, ok)
+        if not ok:
+            raise RuntimeError(f"{path} 失败: {data.get('error')}")
+        return data
+
+    def _post_stream(self, path, payload):
+        """请求 SSE 接口，分别记录首个事件耗时和完整耗时，返回 done 事件的数据"""
+        started = time.perf_counter()
+        first_event = None
+        result = None
+        try:
+            with self.http.post(self.base_url + path, json=payload, timeout=self.timeout, stream=True) as response:
+                event = None
+                for line in response.iter_lines(decode_unicode=True):
+                    if line.startswith('event:'):
+                        event = line[6:].strip()
+                        if first_event is None:
+                            first_event = time.perf_counter() - started
+                    elif line.startswith('data:') and event in ('done', 'error'):
+                        result = json.loads(line[5:])
+        except (requests.RequestException, ValueError) as e:
+            result = {'success': False, 'error': str(e)}
+        ok = bool(result and result.get('success'))
+        if first_event is not None:
+            self.recorder.add(path + ' (first event)', first_event, True)
+        self.recorder.add(path, time.perf_counter() - started, ok)
+        if not ok:
+            raise RuntimeError(f"{path} 失败: {(result or {}).get('error')}")
+        return result
+
+    def play(self):
+        basic_info = {
+            'gender': random.choice(GENDERS),
+            'mbti': random.choice(MBTIS),
+            'zodiac': random.choice(ZODIACS),
+            'background': random.choice(BACKGROUNDS),
+        }
+        quiz = self._post('/api/quiz_questions', {'basic_info': basic_info})
+        answers = [random.choice(question['options']) for question in quiz['questions']]
+        session_id = self._post('/api/start', {'basic_info': basic_info, 'answers': answers})['session_id']
+
+        for stage_index in range(STAGE_COUNT):
+            payload = {'session_id': session_id, 'stage_index': stage_index}
+            if self.stream:
+                stage = self._post_stream('/api/generate_stage_stream', payload)
+            else:
+                stage = self._post('/api/generate_stage', payload)
+            self._post('/api/generate_outcome', {**payload, 'choice': random.choice(stage['options'])})
+
+        self._post('/api/life_review', {'session_id': session_id})
+
+
+def run(base_url, sessions, concurrency, stream=False, timeout=300):
+    """
+    以指定并发走完若干局游戏
+
+    Returns:
+        dict: 压测报告
+    """
+    recorder = Recorder()
+    failures = []
+
+    def play(_):
+        try:
+            Player(base_url, recorder, stream=stream, timeout=timeout).play()
+        except Exception as e:
+            failures.append(str(e))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(play, range(sessions)))
+    report = recorder.report(time.perf_counter() - started, sessions, len(failures))
+    report['failures'] = failures[:10]
+    return report
+
+
+def print_report(report):
+    print(f"\n{report['sessions']} 局游戏（失败 {report['failed_sessions']}），用时 {report['elapsed']:.1f}s，"
+          f"{report['sessions_per_second']:.2f} 局/s，{report['requests_per_second']:.2f} 请求/s")
+    print(f"{'接口':<42}{'次数':>6}{'错误':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for name, stats in sorted(report['endpoints'].items()):
+        print(f"{name:<44}{stats['count']:>6}{stats['errors']:>6}"
+              f"{stats['p50']:>9.3f}{stats['p95']:>9.3f}{stats['p99']:>9.3f}{stats['max']:>9.3f}")
+    for failure in report['failures']:
+        print(f"  失败: {failure}")
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_up(url, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"应用进程已退出，返回码 {process.returncode}")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"应用在 {timeout}s 内未启动: {url}")
+
+
+def spawn_app(mock_url, server='flask', env=None):
+    """
+    在子进程中启动应用，上游指向模拟服务；工作目录为临时目录，生成的图片及其衍生版本（IMAGE_DIR）
+    和静态资源的预压缩文件（STATIC_DIR 指向复制到临时目录的 static/）都不会写入仓库
+
+    Returns:
+        tuple: (应用地址, 子进程)
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    port = _free_port()
+    if server == 'asgi':
+        command = [sys.executable, '-m', 'hypercorn', 'asgi:app', '--bind', f'127.0.0.1:{port}']
+    else:
+        command = [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port), '--with-threads']
+    workdir = tempfile.mkdtemp(prefix='anotheryou-load-')
+    static_dir = shutil.copytree(os.path.join(root, 'static'), os.path.join(workdir, 'static'))
+    process_env = {
+        **os.environ,
+        'MODELSCOPE_KEY': os.getenv('MODELSCOPE_KEY', 'mock'),
+        'MODELSCOPE_BASE_URL': mock_url,
+        'STATIC_DIR': static_dir,
+        'IMAGE_DIR': os.path.join(workdir, 'images'),
+        'PYTHONPATH': root + os.pathsep + os.getenv('PYTHONPATH', ''),
+        **(env or {}),
+    }
+    process = subprocess.Popen(command, cwd=workdir, env=process_env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        _wait_until_up(url + '/favicon.ico', process)
+    except Exception:
+        process.kill()
+        raise
+    return url, process
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="完整游戏流程的压测工具")
+    parser.add_argument('--url', help="被测应用地址；不指定时需使用 --spawn")
+    parser.add_argument('--spawn', action='store_true', help="启动模拟服务和应用后再压测")
+    parser.add_argument('--server', choices=('flask', 'asgi'), default='flask', help="--spawn 时启动的应用")
+    parser.add_argument('--sessions', type=int, default=10, help="总局数")
+    parser.add_argument('--concurrency', type=int, default=5, help="同时进行的局数")
+    parser.add_argument('--stream', action='store_true', help="阶段内容使用流式接口")
+    parser.add_argument('--timeout', type=float, default=300, help="单个请求超时（秒）")
+    parser.add_argument('--chat-latency', default='lognormal:0.3,0.4', help="--spawn 时模拟服务的对话延迟分布")
+    parser.add_argument('--image-latency', default='lognormal:2,0.3', help="--spawn 时模拟服务的图片耗时分布")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="--spawn 时模拟服务随机返回错误的比例")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', dest='json_path', help="把报告写入JSON文件")
+    parser.add_argument('--max-error-rate', type=float, default=None,
+                        help="失败局数占比超过该值时以非零状态退出（用于CI）")
+    args = parser.parse_args(argv)
+
+    if not args.url and not args.spawn:
+        parser.error("需要指定 --url 或 --spawn")
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    mock = process = None
+    url = args.url
+    try:
+        if args.spawn:
+            from MockModelScope import MockModelScope
+            mock = MockModelScope(port=0, chat_latency=args.chat_latency, image_latency=args.image_latency,
+                                  error_rate=args.error_rate)
+            mock_url = mock.start()
+            url, process = spawn_app(mock_url, server=args.server)
+            print(f"模拟服务: {mock_url}，应用: {url}")
+
+        report = run(url, args.sessions, args.concurrency, stream=args.stream, timeout=args.timeout)
+        if mock is not None:
+            report['upstream'] = mock.stats()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+        if mock is not None:
+            mock.stop()
+
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.max_error_rate is not None and report['failed_sessions'] > args.max_error_rate * report['sessions']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# 耗时直方图的默认分桶（秒），覆盖从本地步骤到一分钟以上的图片生成
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120)
+
+# 当前请求的追踪记录；通过 contextvars 传递到依赖图步骤、任务队列和流式推送的后台任务中
+_current_trace = contextvars.ContextVar('trace', default=None)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                     for key, value in labels)
+    return '{' + pairs + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """只增不减的计数器，按标签分别计数"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, tuple(zip(self.labels, key)), value) for key, value in self._values.items()]
+
+
+class Histogram(Counter):
+    """按标签分别统计的直方图，输出累计分桶计数、总和与样本数"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                labels = tuple(zip(self.labels, key))
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    result.append((self.name + '_bucket', labels + (('le', _format_value(bound)),), cumulative))
+                result.append((self.name + '_sum', labels, total))
+                result.append((self.name + '_count', labels, count))
+        return result
+
+
+class _Collected:
+    """在输出时从组件的 stats() 读取的指标"""
+
+    def __init__(self, name, kind, help, func):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.func = func
+
+    def samples(self):
+        return [(self.name, labels, value) for labels, value in self.func()]
+
+
+class Registry:
+    """指标注册表，render() 输出 Prometheus 文本格式"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None and not isinstance(metric, _Collected):
+                return existing
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def register_stats(self, prefix, stats, gauges=(), counters=(), label=None):
+        """
+        把组件 stats() 中的数值字段登记为指标，每次输出时重新读取
+
+        Args:
+            prefix: 指标名前缀
+            stats: 返回统计字典的函数（如 JobQueue.stats）
+            gauges: 输出为 <prefix>_<字段> 的字段
+            counters: 只增不减的字段，输出为 <prefix>_<字段>_total
+            label: 统计字典按某个维度分组时（如 Limiter.stats 按模型）该维度的标签名
+        """
+        def rows():
+            data = stats()
+            if label is None:
+                return [((), data)]
+            return [(((label, group),), values) for group, values in data.items()]
+
+        for kind, fields in (('gauge', gauges), ('counter', counters)):
+            for field in fields:
+                def collect(field=field):
+                    return [(labels, values[field]) for labels, values in rows() if field in values]
+
+                name = f"{prefix}_{field}_total" if kind == 'counter' else f"{prefix}_{field}"
+                self._add(_Collected(name, kind, f"{prefix} {field}", collect))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print(f"读取指标 {metric.name} 失败: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    'anotheryou_request_seconds', '接口请求耗时（秒），流式接口包含推送时间', ('route', 'status'))
+SPAN_SECONDS = REGISTRY.histogram(
+    'anotheryou_span_seconds', '请求内各环节耗时（秒）', ('span', 'detail'))
+SPAN_ERRORS = REGISTRY.counter(
+    'anotheryou_span_errors_total', '请求内各环节失败次数', ('span', 'detail'))
+TOKENS = REGISTRY.counter(
+    'anotheryou_tokens_total', '模型回复中报告的token用量', ('task', 'model', 'kind'))
+LLM_SECONDS = REGISTRY.histogram(
+    'anotheryou_llm_seconds', '按任务类型和模型统计的模型调用耗时（秒）', ('task', 'model'))
+TASK_POLL_CHECKS = REGISTRY.histogram(
+    'anotheryou_task_poll_checks', '每个远程任务结束前的状态查询次数', ('model',),
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34))
+
+
+class Trace:
+    """一次请求的追踪记录"""
+
+    def __init__(self, route):
+        self.route = route
+        self.started = time.time()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span, detail, started, duration, error=None):
+        entry = {'span': span, 'detail': detail, 'offset': round(started - self.started, 4),
+                 'duration': round(duration, 4)}
+        if error is not None:
+            entry['error'] = error
+        with self._lock:
+            self.spans.append(entry)
+
+
+def record(span, seconds, detail='', error=None):
+    """记录一段已测得的耗时，同时写入当前请求的追踪"""
+    SPAN_SECONDS.observe(seconds, span=span, detail=detail)
+    if error is not None:
+        SPAN_ERRORS.inc(span=span, detail=detail)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(span, detail, time.time() - seconds, seconds, error)
+
+
+@contextmanager
+def span(name, detail=''):
+    """
+    测量一段代码的耗时
+
+    Args:
+        name: 环节名称，如 step、llm、image.poll
+        detail: 环节的具体用途，如步骤名称或模型名称
+    """
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        record(name, time.perf_counter() - started, detail, error)
+
+
+@contextmanager
+def llm_span(model, task=None):
+    """测量一次模型调用：记录为 llm 环节，同时按任务类型和模型统计耗时"""
+    started = time.perf_counter()
+    try:
+        with span('llm', model):
+            yield
+    finally:
+        LLM_SECONDS.observe(time.perf_counter() - started, task=task or 'default', model=model)
+
+
+def record_usage(model, usage, task=None):
+    """按任务类型和模型累计回复中报告的token用量"""
+    if usage is None:
+        return
+    for kind in ('prompt_tokens', 'completion_tokens'):
+        value = getattr(usage, kind, None)
+        if value:
+            TOKENS.inc(value, task=task or 'default', model=model, kind=kind.split('_')[0])
+
+
+def start_trace(route):
+    """开始追踪当前请求，之后在本上下文及其派生的线程和任务中记录的环节都会归入该请求"""
+    trace = Trace(route)
+    _current_trace.set(trace)
+    return trace
+
+
+def finish_trace(trace, status=''):
+    """结束追踪：记录请求耗时，开启 TRACE_LOG 时输出一行JSON追踪日志"""
+    if trace is None:
+        return
+    duration = time.time() - trace.started
+    REQUEST_SECONDS.observe(duration, route=trace.route, status=status)
+    if _trace_log is not None:
+        line = json.dumps({'route': trace.route, 'status': status, 'started': trace.started,
+                           'duration': round(duration, 4), 'spans': trace.spans}, ensure_ascii=False)
+        with _trace_lock:
+            _trace_log.write(line + '\n')
+            _trace_log.flush()
+
+
+def _open_trace_log():
+    """
+    根据环境变量打开追踪日志
+
+    环境变量：
+        TRACE_LOG: 设为 - 时输出到标准输出，设为文件路径时追加写入该文件，未设置时不输出
+    """
+    target = os.getenv('TRACE_LOG')
+    if not target:
+        return None
+    if target == '-':
+        return sys.stdout
+    return open(target, 'a', encoding='utf-8')
+
+
+_trace_lock = threading.Lock()
+_trace_log = _open_trace_log()
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+本地模拟的 ModelScope 服务，用于离线压测和开发
+
+实现与线上接口兼容的：
+    POST /v1/chat/completions      对话补全（支持 stream，流式时最后一个分块附带用量）
+    POST /v1/images/generations    提交异步图片生成任务
+    GET  /v1/tasks/<task_id>       查询任务状态
+    GET  /files/<task_id>.jpg      下载生成的图片
+    GET  /stats                    请求计数
+
+用法：
+    python MockModelScope.py --port 9000 --chat-latency lognormal:0.8,0.4 --image-latency lognormal:8,0.3
+    MODELSCOPE_BASE_URL=http://127.0.0.1:9000 MODELSCOPE_KEY=mock python app.py
+"""
+import argparse
+import io
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image
+
+# 生成回复文本时使用的字符
+_FILLER = "清晨的阳光洒在小镇的石板路上他望着远方的山心里藏着一个从未说出口的梦想风吹过稻田带来远处的钟声"
+
+
+def parse_latency(spec):
+    """
+    解析延迟分布
+
+    Args:
+        spec: "0.5"（固定值）、"uniform:最小,最大"、"lognormal:中位数,sigma"、"exp:均值"，单位秒
+
+    Returns:
+        function: 无参数的采样函数，返回秒数
+    """
+    kind, _, params = str(spec).partition(':')
+    if not params:
+        value = float(kind)
+        return lambda: value
+    args = [float(arg) for arg in params.split(',')]
+    if kind == 'uniform':
+        return lambda: random.uniform(args[0], args[1])
+    if kind == 'lognormal':
+        return lambda: random.lognormvariate(math.log(args[0]), args[1])
+    if kind == 'exp':
+        return lambda: random.expovariate(1 / args[0])
+    raise ValueError(f"未知的延迟分布: {spec}")
+
+
+def _filler(length):
+    start = random.randrange(len(_FILLER))
+    text = (_FILLER * (length // len(_FILLER) + 2))[start:start + length]
+    return text + f"（{uuid.uuid4().hex[:6]}）"
+
+
+def reply_for(prompt, length=120):
+    """
+    根据提示的格式要求构造一个能通过应用解析和校验的回复
+
+    Args:
+        prompt: 最后一条用户消息
+        length: 普通文本回复的长度（字）
+    """
+    if '"questions"' in prompt:
+        return json.dumps({'questions': [{'question': f"问题{i + 1}：{_filler(12)}",
+                                          'options': [_filler(4), _filler(4), _filler(4)]} for i in range(5)]},
+                          ensure_ascii=False)
+    if '"image_prompt1"' in prompt:
+        return json.dumps({'question': _filler(15), 'options': ['A. ' + _filler(6), 'B. ' + _filler(6)],
+                           'image_prompt1': _filler(40), 'image_prompt2': 'a comic scene, ' + uuid.uuid4().hex,
+                           'desc1': _filler(10), 'desc2': _filler(10)}, ensure_ascii=False)
+    if '"image_prompt"' in prompt:
+        return json.dumps({'image_prompt': 'a comic ending scene, ' + uuid.uuid4().hex, 'desc': _filler(10)},
+                          ensure_ascii=False)
+    if re.search(r'A\. 选项1', prompt):
+        return f"{_filler(15)}\nA. {_filler(6)}\nB. {_filler(6)}"
+    return _filler(length)
+
+
+class MockModelScope:
+    """模拟服务，start() 在后台线程中运行"""
+
+    def __init__(self, host='127.0.0.1', port=9000, chat_latency='lognormal:0.5,0.4', token_interval=0.02,
+                 image_latency='lognormal:8,0.3', error_rate=0.0, image_failure_rate=0.0, reply_length=120):
+        """
+        初始化模拟服务
+
+        Args:
+            host: 监听地址
+            port: 监听端口，为0时随机选择
+            chat_latency: 对话补全首个分块（非流式时为整个回复）的延迟分布，格式见 parse_latency
+            token_interval: 流式输出时相邻分块的间隔（秒）
+            image_latency: 图片任务从提交到完成的耗时分布
+            error_rate: 提交类请求随机返回429（带Retry-After）或500的比例
+            image_failure_rate: 图片任务以 FAILED 结束的比例
+            reply_length: 普通文本回复的长度（字）
+        """
+        self.chat_latency = parse_latency(chat_latency)
+        self.token_interval = token_interval
+        self.image_latency = parse_latency(image_latency)
+        self.error_rate = error_rate
+        self.image_failure_rate = image_failure_rate
+        self.reply_length = reply_length
+
+        self._tasks = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._image = self._render_image()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """在后台线程中开始服务，返回服务地址"""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-modelscope", daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def _count(self, name):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    @staticmethod
+    def _render_image():
+        buffer = io.BytesIO()
+        Image.new('RGB', (512, 512), (200, 120, 60)).save(buffer, 'JPEG', quality=85)
+        return buffer.getvalue()
+
+    def _handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, payload, headers=None):
+                body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _read_json(self):
+                """请求体的JSON对象，无法解析或不是对象时返回None"""
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    return None
+                return body if isinstance(body, dict) else None
+
+            def _injected_error(self):
+                """按 error_rate 随机返回错误，返回是否已返回错误"""
+                if mock.error_rate and random.random() < mock.error_rate:
+                    mock._count('errors')
+                    if random.random() < 0.5:
+                        self._send_json(429, {'error': 'rate limited'}, {'Retry-After': '1'})
+                    else:
+                        self._send_json(500, {'error': 'internal error'})
+                    return True
+                return False
+
+            def do_POST(self):
+                body = self._read_json()
+                if body is None:
+                    # 与真实服务一样返回400，而不是在处理线程中抛出异常
+                    self._send_json(400, {'error': 'request body must be a JSON object'})
+                elif self.path.rstrip('/') == '/v1/chat/completions':
+                    mock._count('chat')
+                    messages = body.get('messages')
+                    if not isinstance(messages, list) or not messages \
+                            or not all(isinstance(message, dict) for message in messages):
+                        self._send_json(400, {'error': "'messages' must be a non-empty list of objects"})
+                    elif not self._injected_error():
+                        self._chat(body)
+                elif self.path.rstrip('/') == '/v1/images/generations':
+                    mock._count('images')
+                    if not self._injected_error():
+                        task_id = uuid.uuid4().hex
+                        failed = random.random() < mock.image_failure_rate
+                        with mock._lock:
+                            mock._tasks[task_id] = (time.time() + mock.image_latency(), failed)
+                        self._send_json(200, {'task_id': task_id})
+                else:
+                    self._send_json(404, {'error': 'not found'})
+
+            def do_GET(self):
+                match = re.match(r'^/v1/tasks/([0-9a-f]+)$', self.path)
+                if match:
+                    mock._count('polls')
+                    self._task(match.group(1))
+                elif re.match(r'^/files/[0-9a-f]+\.jpg$', self.path):
+                    mock._count('downloads')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'image/jpeg')
+                    self.send_header('Content-Length', str(len(mock._image)))
+                    self.end_headers()
+                    self.wfile.write(mock._image)
+                elif self.path == '/stats':
+                    self._send_json(200, mock.stats())
+                else:
+                    self._send_json(404, {'error': 'not found'})
+
+            def _task(self, task_id):
+                with mock._lock:
+                    task = mock._tasks.get(task_id)
+                if task is None:
+                    self._send_json(404, {'error': 'task not found'})
+                    return
+                done_at, failed = task
+                if time.time() < done_at:
+                    self._send_json(200, {'task_status': 'RUNNING'})
+                elif failed:
+                    self._send_json(200, {'task_status': 'FAILED', 'error_message': 'mock failure'})
+                else:
+                    host = self.headers.get('Host', mock.base_url.split('://', 1)[1])
+                    self._send_json(200, {'task_status': 'SUCCEED',
+                                          'output_images': [f"http://{host}/files/{task_id}.jpg"]})
+
+            def _chat(self, body):
+                prompt = str(body['messages'][-1].get('content') or '')
+                text = reply_for(prompt, mock.reply_length)
+                prompt_tokens = sum(len(str(message.get('content') or '')) for message in body['messages'])
+                usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': len(text),
+                         'total_tokens': prompt_tokens + len(text)}
+                base = {'id': 'chatcmpl-' + uuid.uuid4().hex, 'created': int(time.time()), 'model': body.get('model')}
+                time.sleep(mock.chat_latency())
+
+                if not body.get('stream'):
+                    self._send_json(200, {**base, 'object': 'chat.completion', 'usage': usage, 'choices': [
+                        {'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}]})
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                chunks = [text[i:i + 8] for i in range(0, len(text), 8)]
+                for index, piece in enumerate(chunks):
+                    if index:
+                        time.sleep(mock.token_interval)
+                    self._send_event({**base, 'object': 'chat.completion.chunk', 'choices': [
+                        {'index': 0, 'delta': {'content': piece}, 'finish_reason': None}]})
+                self._send_event({**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.close_connection = True
+
+            def _send_event(self, payload):
+                self.wfile.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+
+        return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地模拟的 ModelScope 服务")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--chat-latency', default='lognormal:0.5,0.4', help="对话首个分块延迟分布")
+    parser.add_argument('--token-interval', type=float, default=0.02, help="流式分块间隔（秒）")
+    parser.add_argument('--image-latency', default='lognormal:8,0.3', help="图片任务完成耗时分布")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="随机返回429/500的比例")
+    parser.add_argument('--image-failure-rate', type=float, default=0.0, help="图片任务失败的比例")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    mock = MockModelScope(args.host, args.port, chat_latency=args.chat_latency, token_interval=args.token_interval,
+                          image_latency=args.image_latency, error_rate=args.error_rate,
+                          image_failure_rate=args.image_failure_rate)
+    print(f"模拟服务已启动: {mock.base_url}", flush=True)
+    try:
+        mock.serve_forever()
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == "__main__":
+    main()
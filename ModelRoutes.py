@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+# 模型调用的任务类型：
+#   story / outcome: 阶段故事和选项结局（长篇叙事）
+#   choice: 选择题；image_prompt: 图片提示词；caption: 图片的简短描述
+#   details: 一次生成选择题、图片提示词和描述的结构化调用
+#   quiz: 性格测试题；personality: 性格分析；review: 人生回顾
+#   summary: 把多轮对话中较早的轮次压缩为摘要（见 ContextWindow）
+TASKS = ('story', 'outcome', 'choice', 'image_prompt', 'caption', 'details', 'quiz', 'personality', 'review',
+         'summary')
+
+# 短小、格式固定的子任务（以及对话摘要）使用的小模型
+SMALL_MODEL = "Qwen/Qwen2.5-7B-Instruct"
+
+# 默认路由：短小的子任务改用小模型并限制输出长度，未列出的任务使用 ChatBot 的默认模型
+DEFAULT_ROUTES = {
+    'choice': {'model': SMALL_MODEL, 'max_tokens': 256},
+    'image_prompt': {'model': SMALL_MODEL, 'max_tokens': 256},
+    'caption': {'model': SMALL_MODEL, 'max_tokens': 64},
+    'quiz': {'model': SMALL_MODEL, 'max_tokens': 1024},
+    'summary': {'model': SMALL_MODEL, 'max_tokens': 512},
+}
+
+# 路由中可以配置的请求参数（model 之外）
+_PARAMS = ('max_tokens', 'temperature', 'top_p', 'presence_penalty', 'frequency_penalty', 'seed', 'stop')
+
+# 路由中控制调用方式、不随请求发送的选项：对冲请求使用的模型、单次调用的期限（秒）
+_OPTIONS = ('hedge_model', 'deadline')
+
+
+class ModelRoutes:
+    """任务类型到模型及请求参数的路由表"""
+
+    def __init__(self, routes=None):
+        """
+        初始化路由表
+
+        Args:
+            routes: {任务类型: {'model': 模型名称, 其他请求参数或选项}}；'default' 条目作用于所有任务，
+                    任务条目中的同名字段覆盖它；未配置 model 的任务使用调用方的默认模型
+
+        Raises:
+            ValueError: 任务类型或请求参数不在支持范围内
+        """
+        self.routes = {}
+        for task, route in (routes or {}).items():
+            if task != 'default' and task not in TASKS:
+                raise ValueError(f"未知的任务类型: {task}，可选: {', '.join(TASKS)}")
+            unknown = set(route) - set(_PARAMS) - set(_OPTIONS) - {'model'}
+            if unknown:
+                raise ValueError(f"任务 {task} 的路由包含不支持的参数: {', '.join(sorted(unknown))}")
+            self.routes[task] = dict(route)
+
+    def resolve(self, task=None, default_model=None):
+        """
+        查找任务对应的模型和请求参数
+
+        Args:
+            task: 任务类型，为None时只使用 'default' 条目
+            default_model: 路由未指定模型时使用的模型
+
+        Returns:
+            tuple: (模型名称, 请求参数字典)
+        """
+        params = {key: value for key, value in self._merged(task).items() if key not in _OPTIONS}
+        model = params.pop('model', None) or default_model
+        return model, params
+
+    def options(self, task=None):
+        """
+        查找任务的调用选项
+
+        Returns:
+            dict: 只包含已配置的 hedge_model / deadline
+        """
+        return {key: value for key, value in self._merged(task).items() if key in _OPTIONS}
+
+    def _merged(self, task):
+        return {**self.routes.get('default', {}), **self.routes.get(task, {})}
+
+    def models(self, default_model=None):
+        """
+        路由表中用到的全部模型
+
+        Returns:
+            dict: {任务类型: 模型名称}
+        """
+        return {task: self.resolve(task, default_model)[0] for task in TASKS}
+
+
+def model_routes_from_env():
+    """
+    根据环境变量创建路由表
+
+    环境变量：
+        MODEL_ROUTES: JSON（或JSON文件路径），格式同 ModelRoutes 的 routes 参数，按任务覆盖默认路由
+                      （如 {"caption": {}} 让描述改回默认模型）；设为 off 时所有任务都使用默认模型
+
+    Returns:
+        ModelRoutes: 路由表，关闭时返回None
+    """
+    config = os.getenv('MODEL_ROUTES', '').strip()
+    if config.lower() == 'off':
+        return None
+    if config and not config.startswith('{'):
+        with open(config, encoding='utf-8') as f:
+            config = f.read()
+    return ModelRoutes({**DEFAULT_ROUTES, **(json.loads(config) if config else {})})
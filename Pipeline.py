@@ -0,0 +1,563 @@
+# -*- coding: utf-8 -*-
+"""游戏流程中与服务框架无关的部分：阶段定义、提示词模板、结果解析和步骤声明
+
+同步服务（app.py）和异步服务（asgi.py）共用这些定义，只是各自以不同方式执行步骤。
+"""
+import json
+import os
+import random
+
+# 游戏阶段定义
+STAGES = [
+    {"name": "幼儿时期", "age_range": "0-12岁"},
+    {"name": "少年时期", "age_range": "13-24岁"},
+    {"name": "青年时期", "age_range": "25-36岁"},
+    {"name": "中年时期", "age_range": "37-50岁"}
+]
+
+# 图片生成使用的模型
+IMAGE_MODEL = "Qwen/Qwen-Image"
+
+# 阶段和结局的派生字段（选择题、图片提示词、描述）是否合并为一次结构化调用，STAGE_BATCH=off 时逐项生成
+BATCH_FIELDS = os.getenv('STAGE_BATCH', 'on').lower() != 'off'
+
+_TEXT = {'type': 'string', 'minLength': 1}
+
+# 性格测试问题的结构化输出格式
+QUIZ_SCHEMA = {
+    'type': 'object',
+    'required': ['questions'],
+    'properties': {
+        'questions': {
+            'type': 'array',
+            'minItems': 1,
+            'items': {
+                'type': 'object',
+                'required': ['question', 'options'],
+                'properties': {
+                    'question': _TEXT,
+                    'options': {'type': 'array', 'minItems': 2, 'items': _TEXT},
+                },
+            },
+        },
+    },
+}
+
+# 阶段派生字段的结构化输出格式
+STAGE_DETAILS_SCHEMA = {
+    'type': 'object',
+    'required': ['question', 'options', 'image_prompt1', 'image_prompt2', 'desc1', 'desc2'],
+    'properties': {
+        'question': _TEXT,
+        'options': {'type': 'array', 'minItems': 2, 'maxItems': 3, 'items': _TEXT},
+        'image_prompt1': _TEXT,
+        'image_prompt2': _TEXT,
+        'desc1': _TEXT,
+        'desc2': _TEXT,
+    },
+}
+
+# 结局派生字段的结构化输出格式
+OUTCOME_DETAILS_SCHEMA = {
+    'type': 'object',
+    'required': ['image_prompt', 'desc'],
+    'properties': {
+        'image_prompt': _TEXT,
+        'desc': _TEXT,
+    },
+}
+
+# 问题生成失败时使用的备用题库
+FALLBACK_QUESTIONS = [
+    {"question": "面对一项陌生任务，你更会先做什么？", "options": ["先拆解步骤再行动", "先行动再根据反馈调整", "先询问他人经验"]},
+    {"question": "当你必须做决定时，你更看重？", "options": ["逻辑和数据", "直觉和感受", "过往经验"]},
+    {"question": "在团队合作中你更像？", "options": ["组织者", "执行者", "协调者"]},
+    {"question": "你如何应对压力？", "options": ["制定计划逐步解决", "用兴趣转移注意", "寻求支持与交流"]},
+    {"question": "别人评价你时更常听到的是？", "options": ["理性", "温和", "果断"]},
+    {"question": "当计划被打乱时，你会？", "options": ["迅速重新规划", "顺势而为", "先冷静观察"]},
+    {"question": "你更喜欢哪种生活节奏？", "options": ["有序稳定", "灵活多变", "循序渐进"]},
+    {"question": "遇到冲突时，你倾向于？", "options": ["直接沟通", "先冷静再处理", "尽量回避"]},
+]
+
+
+def personality_prompt(basic_info, answers):
+    """构建性格画像生成提示"""
+    formatted_answers = []
+    for item in answers:
+        if isinstance(item, dict):
+            question = str(item.get('question', '')).strip()
+            answer = str(item.get('answer', '')).strip()
+            if question and answer:
+                formatted_answers.append(f"Q: {question}\nA: {answer}")
+            elif answer:
+                formatted_answers.append(answer)
+        elif item:
+            formatted_answers.append(str(item))
+
+    formatted_answers_text = "\n".join(formatted_answers)
+
+    return f"""根据以下信息生成一个详细的性格画像（控制在150字以内）：
+
+基础信息：
+- 性别：{basic_info.get('gender', '')}
+- MBTI：{basic_info.get('mbti', '')}
+- 星座：{basic_info.get('zodiac', '')}
+- 家庭出身背景：{basic_info.get('background', '')}
+
+性格测试答案：
+{formatted_answers_text}
+
+请生成一个生动、具体的性格画像，描述这个人的性格特点、行为倾向、价值观等。控制在150字以内。"""
+
+
+def quiz_prompt(basic_info, seed=None):
+    """构建性格测试问题生成提示"""
+    if seed is None:
+        seed = random.randint(1000, 9999)
+    return f"""你是性格测试设计师，请根据以下基础信息随机生成5个问题，每个问题提供3个简短选项，用于标定人物性格倾向。
+
+基础信息：
+- 性别：{basic_info.get('gender', '')}
+- MBTI：{basic_info.get('mbti', '')}
+- 星座：{basic_info.get('zodiac', '')}
+- 家庭出身背景：{basic_info.get('background', '')}
+- 随机种子：{seed}
+
+要求：
+1. 问题要具体、贴近日常场景
+2. 选项要有区分度
+3. 输出JSON，格式为：{{"questions":[{{"question":"...", "options":["...","...","..."]}}]}}
+4. 只输出JSON，不要额外说明
+"""
+
+
+def normalize_questions(data):
+    """将符合 QUIZ_SCHEMA 的数据规范化为问题列表"""
+    normalized = []
+    for item in data['questions']:
+        question = item['question'].strip()
+        options = [option.strip() for option in item['options'] if option.strip()]
+        if question and options:
+            normalized.append({'question': question, 'options': options})
+    return normalized
+
+
+def fallback_questions(count=5):
+    """从备用题库中随机抽取问题"""
+    pool = list(FALLBACK_QUESTIONS)
+    random.shuffle(pool)
+    return pool[:count]
+
+
+def review_prompt(basic_info, personality, stages):
+    """构建人生回顾生成提示"""
+    stage_lines = []
+    for item in stages:
+        if not isinstance(item, dict):
+            continue
+        stage = item.get('stage', {})
+        stage_name = stage.get('name', '某阶段')
+        story = str(item.get('story', '')).strip()
+        outcome = str(item.get('outcome', '')).strip()
+        if story or outcome:
+            stage_lines.append(f"{stage_name}：{story} 结局：{outcome}")
+
+    stage_lines_text = "\n".join(stage_lines)
+
+    return f"""请根据以下信息生成一段100字以内的人生回顾总结，语言温暖、简洁，突出关键转折。
+
+基础信息：
+- 性别：{basic_info.get('gender', '')}
+- MBTI：{basic_info.get('mbti', '')}
+- 星座：{basic_info.get('zodiac', '')}
+- 家庭出身背景：{basic_info.get('background', '')}
+- 性格画像：{personality}
+
+阶段内容：
+{stage_lines_text}
+
+请输出一段简短回顾："""
+
+
+def clean_image_prompt(text):
+    """清理模型生成的图片提示词"""
+    text = text.strip().replace('Prompt:', '').replace('prompt:', '').strip()
+    if len(text) > 500:
+        text = text[:500]
+    return text
+
+
+def comic_prompt(image_prompt):
+    """在图片提示词外加上统一的漫画风格修饰"""
+    return f"comic style, {image_prompt}, colorful, detailed"
+
+
+def parse_choice(choice_text):
+    """解析选择题文本，返回问题和选项列表"""
+    lines = choice_text.strip().split('\n')
+    question = lines[0] if lines else "你会如何选择？"
+    options = [line.strip() for line in lines[1:] if line.strip() and (line.strip().startswith('A.') or line.strip().startswith('B.') or line.strip().startswith('C.'))]
+    return question, options
+
+
+def story_prompt(stage, basic_info, personality):
+    """构建阶段故事生成提示"""
+    return f"""你是一个人生故事模拟器。根据以下信息，生成一段{stage['name']}（{stage['age_range']}）正在发生的故事：
+
+人物信息：
+- 性别：{basic_info.get('gender', '')}
+- MBTI：{basic_info.get('mbti', '')}
+- 星座：{basic_info.get('zodiac', '')}
+- 家庭背景：{basic_info.get('background', '')}
+- 性格画像：{personality}
+
+要求：
+1. 故事要生动具体，符合该年龄段的特征
+2. 故事要有冲突或选择点，但结局还未确定
+3. 控制在200字以内
+4. 故事要能引发读者的思考和选择
+
+请生成故事："""
+
+
+def choice_prompt(story):
+    """构建选择题生成提示"""
+    return f"""基于以下故事，生成一个选择题，让用户决定故事的走向：
+
+故事：{story}
+
+要求：
+1. 生成一个选择题，包含问题和2-3个选项
+2. 选项要能影响故事的结局
+3. 格式：问题\nA. 选项1\nB. 选项2\nC. 选项3（如果有）
+
+请生成选择题："""
+
+
+def image_prompt1_prompt(story):
+    """构建第一张图（开头场景）的prompt生成提示"""
+    return f"""将以下故事转换为图片生成提示词（prompt）：
+
+故事：{story}
+
+要求：
+1. 描述故事的开头场景
+2. 适合漫画风格
+3. 用中文描述，简洁明了
+4. 包含场景、人物、情绪等细节
+
+请生成prompt："""
+
+
+def image_prompt2_prompt(story):
+    """构建第二张图（关键时刻）的prompt生成提示"""
+    return f"""将以下故事转换为图片生成提示词（prompt），描述故事发展到关键时刻的场景：
+
+故事：{story}
+
+要求：
+1. 描述故事发展到关键时刻的场景
+2. 适合漫画风格
+3. 用英文描述，简洁明了
+4. 包含场景、人物、情绪等细节
+
+请生成prompt："""
+
+
+def desc1_prompt(story):
+    """构建开头场景描述文字的生成提示"""
+    return f"""为以下故事的开头场景生成一句简短的描述文字（20字以内）：
+
+故事：{story}
+
+请生成描述："""
+
+
+def desc2_prompt(story):
+    """构建关键时刻场景描述文字的生成提示"""
+    return f"""为以下故事的关键时刻场景生成一句简短的描述文字（20字以内）：
+
+故事：{story}
+
+请生成描述："""
+
+
+def stage_details_prompt(story):
+    """构建一次性生成阶段派生字段（选择题、两张图的prompt和描述）的结构化提示"""
+    prompt = f"""基于以下故事，一次性生成选择题、两张配图的图片生成提示词（prompt）和配图描述：
+
+故事：{story}
+
+要求：
+1. question：一个选择题的问题，让用户决定故事的走向
+2. options：2-3个选项，选项要能影响故事的结局，依次以"A. "、"B. "、"C. "开头
+3. image_prompt1：描述故事的开头场景，适合漫画风格，用中文描述，简洁明了，包含场景、人物、情绪等细节
+4. image_prompt2：描述故事发展到关键时刻的场景，适合漫画风格，用英文描述，简洁明了，包含场景、人物、情绪等细节
+5. desc1：开头场景的简短描述文字（20字以内）
+6. desc2：关键时刻场景的简短描述文字（20字以内）
+7. 输出JSON，格式为：{{"question":"...", "options":["A. ...","B. ...","C. ..."], "image_prompt1":"...", "image_prompt2":"...", "desc1":"...", "desc2":"..."}}
+8. 只输出JSON，不要额外说明
+"""
+    return prompt, STAGE_DETAILS_SCHEMA
+
+
+def _labelled_options(options):
+    """确保选项以 A. / B. / C. 开头"""
+    labelled = []
+    for label, option in zip('ABC', options):
+        option = option.strip()
+        if not (len(option) > 1 and option[0].upper() == label and option[1] in '.．、'):
+            option = f"{label}. {option}"
+        labelled.append(option)
+    return labelled
+
+
+def choice_from_details(details):
+    """从阶段派生字段中取出选择题，格式与 parse_choice 相同"""
+    return details['question'].strip(), _labelled_options(details['options'])
+
+
+def outcome_prompt(stage, story, choice):
+    """构建结局故事生成提示"""
+    return f"""基于以下故事和用户的选择，生成故事的结局：
+
+原故事：{story}
+用户选择：{choice}
+阶段：{stage['name']}（{stage['age_range']}）
+
+要求：
+1. 根据用户的选择，生成一个合理的结局
+2. 结局要符合人物的性格和背景
+3. 控制在150字以内
+4. 结局要有意义，能体现选择的影响
+
+请生成结局："""
+
+
+def outcome_image_prompt(outcome):
+    """构建结局图片的prompt生成提示"""
+    return f"""将以下结局转换为图片生成提示词（prompt）：
+
+结局：{outcome}
+
+要求：
+1. 描述结局的场景
+2. 适合漫画风格
+3. 用英文描述，简洁明了
+4. 包含场景、人物、情绪等细节
+
+请生成prompt："""
+
+
+def outcome_desc_prompt(outcome):
+    """构建结局描述文字的生成提示"""
+    return f"""为以下结局生成一句简短的描述文字（20字以内）：
+
+结局：{outcome}
+
+请生成描述："""
+
+
+def outcome_details_prompt(outcome):
+    """构建一次性生成结局图片prompt和描述的结构化提示"""
+    prompt = f"""基于以下结局，生成一张配图的图片生成提示词（prompt）和配图描述：
+
+结局：{outcome}
+
+要求：
+1. image_prompt：描述结局的场景，适合漫画风格，用英文描述，简洁明了，包含场景、人物、情绪等细节
+2. desc：结局的简短描述文字（20字以内）
+3. 输出JSON，格式为：{{"image_prompt":"...", "desc":"..."}}
+4. 只输出JSON，不要额外说明
+"""
+    return prompt, OUTCOME_DETAILS_SCHEMA
+
+
+# 输入完全由上游结果决定、适合复用模型回复的步骤（提示词转换和简短描述）
+CACHEABLE_STEPS = {'image_prompt1', 'image_prompt2', 'desc1', 'desc2', 'image_prompt', 'desc',
+                   'details', 'outcome_details'}
+
+
+# 流式接口中需要逐段推送模型输出的步骤
+STREAMED_STEPS = {'story', 'outcome'}
+
+
+# 调用模型的步骤对应的任务类型，由 ModelRoutes 决定各任务使用的模型和请求参数
+STEP_TASKS = {
+    'story': 'story', 'outcome': 'outcome', 'choice': 'choice',
+    'image_prompt1': 'image_prompt', 'image_prompt2': 'image_prompt', 'image_prompt': 'image_prompt',
+    'desc1': 'caption', 'desc2': 'caption', 'desc': 'caption',
+    'details': 'details', 'outcome_details': 'details',
+}
+
+
+def _strip(text):
+    return text.strip()
+
+
+def _field(name):
+    return lambda details: details[name]
+
+
+def stage_plan(stage, basic_info, personality):
+    """
+    阶段生成的步骤声明：故事生成后，选择题、两个图片prompt和两段描述可以并发生成，
+    每张图片在各自的prompt就绪后即可开始生成
+
+    BATCH_FIELDS 为 True 时，派生字段由一次结构化调用（details）生成，各字段步骤只从中取值
+
+    Returns:
+        list: (名称, 依赖, 类型, 输入构造函数, 结果处理函数) 元组列表；
+              类型为 'text' 时输入是对话提示，为 'json' 时输入是 (对话提示, JSON Schema)，
+              为 'image' 时输入是图片提示词，为 'local' 时输入构造函数的返回值即为结果、不调用模型；
+              输入构造函数按依赖顺序接收依赖步骤的结果
+    """
+    if BATCH_FIELDS:
+        return [
+            ('story', (), 'text', lambda: story_prompt(stage, basic_info, personality), None),
+            ('details', ('story',), 'json', stage_details_prompt, None),
+            ('choice', ('details',), 'local', choice_from_details, None),
+            ('image_prompt1', ('details',), 'local', _field('image_prompt1'), clean_image_prompt),
+            ('image_prompt2', ('details',), 'local', _field('image_prompt2'), clean_image_prompt),
+            ('image1', ('image_prompt1',), 'image', comic_prompt, None),
+            ('image2', ('image_prompt2',), 'image', comic_prompt, None),
+            ('desc1', ('details',), 'local', _field('desc1'), _strip),
+            ('desc2', ('details',), 'local', _field('desc2'), _strip),
+        ]
+    return [
+        ('story', (), 'text', lambda: story_prompt(stage, basic_info, personality), None),
+        ('choice', ('story',), 'text', choice_prompt, parse_choice),
+        ('image_prompt1', ('story',), 'text', image_prompt1_prompt, clean_image_prompt),
+        ('image_prompt2', ('story',), 'text', image_prompt2_prompt, clean_image_prompt),
+        ('image1', ('image_prompt1',), 'image', comic_prompt, None),
+        ('image2', ('image_prompt2',), 'image', comic_prompt, None),
+        ('desc1', ('story',), 'text', desc1_prompt, _strip),
+        ('desc2', ('story',), 'text', desc2_prompt, _strip),
+    ]
+
+
+def outcome_plan(stage, story, choice):
+    """
+    结局生成的步骤声明：结局生成后，图片链路（prompt → 图片）与描述并发执行
+
+    Returns:
+        list: 与 stage_plan 相同格式的步骤声明
+    """
+    if BATCH_FIELDS:
+        return [
+            ('outcome', (), 'text', lambda: outcome_prompt(stage, story, choice), None),
+            ('outcome_details', ('outcome',), 'json', outcome_details_prompt, None),
+            ('image_prompt', ('outcome_details',), 'local', _field('image_prompt'), clean_image_prompt),
+            ('image', ('image_prompt',), 'image', comic_prompt, None),
+            ('desc', ('outcome_details',), 'local', _field('desc'), _strip),
+        ]
+    return [
+        ('outcome', (), 'text', lambda: outcome_prompt(stage, story, choice), None),
+        ('image_prompt', ('outcome',), 'text', outcome_image_prompt, clean_image_prompt),
+        ('image', ('image_prompt',), 'image', comic_prompt, None),
+        ('desc', ('outcome',), 'text', outcome_desc_prompt, _strip),
+    ]
+
+
+def stage_response(results):
+    """将阶段步骤结果组装为接口返回数据"""
+    question, options = results['choice']
+    return {
+        'success': True,
+        'story': results['story'],
+        'question': question,
+        'options': options,
+        'images': [
+            {'path': results['image1'], 'description': results['desc1']},
+            {'path': results['image2'], 'description': results['desc2']}
+        ]
+    }
+
+
+def outcome_response(results):
+    """将结局步骤结果组装为接口返回数据"""
+    return {
+        'success': True,
+        'outcome': results['outcome'],
+        'image': {'path': results['image'], 'description': results['desc']}
+    }
+
+
+def new_session(basic_info, personality):
+    """构建一个新游戏会话的数据"""
+    return {'basic_info': basic_info, 'personality': personality, 'stages': {}}
+
+
+def record_stage(session, stage_index, response):
+    """把阶段的接口数据保存到会话（就地修改）"""
+    session['stages'][str(stage_index)] = {
+        key: response[key] for key in ('story', 'question', 'options', 'images')
+    }
+
+
+def saved_stage(session, stage_index):
+    """
+    取出会话中已生成的阶段
+
+    Returns:
+        dict: 与 stage_response 格式相同的接口数据，尚未生成时返回None
+    """
+    stage = session['stages'].get(str(stage_index))
+    if not stage or 'story' not in stage:
+        return None
+    return {'success': True, **{key: stage[key] for key in ('story', 'question', 'options', 'images')}}
+
+
+def record_outcome(session, stage_index, choice, response):
+    """把结局的接口数据和对应的选择保存到会话（就地修改）"""
+    stage = session['stages'].setdefault(str(stage_index), {})
+    stage.update({'choice': choice, 'outcome': response['outcome'], 'outcome_image': response['image']})
+
+
+def saved_outcome(session, stage_index, choice):
+    """
+    取出会话中针对同一选择已生成的结局
+
+    Returns:
+        dict: 与 outcome_response 格式相同的接口数据，不存在时返回None
+    """
+    stage = session['stages'].get(str(stage_index), {})
+    if stage.get('choice') != choice or 'outcome' not in stage:
+        return None
+    return {'success': True, 'outcome': stage['outcome'], 'image': stage['outcome_image']}
+
+
+def review_stages(session):
+    """按阶段顺序整理会话中的故事和结局，格式与 review_prompt 的 stages 参数相同"""
+    stages = []
+    for index, stage in enumerate(STAGES):
+        saved = session['stages'].get(str(index))
+        if saved:
+            stages.append({'stage': stage, 'story': saved.get('story', ''), 'outcome': saved.get('outcome', '')})
+    return stages
+
+
+def stage_events(response):
+    """将已生成的阶段接口数据转换为流式接口的事件序列，事件与实时生成时相同"""
+    events = [
+        ('story', {'value': response['story']}),
+        ('choice', {'question': response['question'], 'options': response['options']}),
+    ]
+    for index, image in enumerate(response['images'], 1):
+        events.append((f'image{index}', {'value': image['path']}))
+        events.append((f'desc{index}', {'value': image['description']}))
+    events.append(('done', response))
+    return events
+
+
+def step_event(name, result):
+    """将单个步骤的结果转换为流式接口推送的事件数据"""
+    if name == 'choice':
+        question, options = result
+        return {'question': question, 'options': options}
+    return {'value': result}
+
+
+def sse_event(event, data):
+    """编码一条 Server-Sent Events 消息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+# 决定题目内容的基础信息字段，相同取值的用户共用一个题目桶
+BUCKET_FIELDS = ('gender', 'mbti', 'zodiac', 'background')
+
+
+def bucket_key(basic_info):
+    """根据基础信息计算题目桶的键"""
+    return tuple(str(basic_info.get(field, '')).strip() for field in BUCKET_FIELDS)
+
+
+class QuizPool:
+    """预生成的性格测试题池
+
+    题目按 (性别, MBTI, 星座, 家庭出身背景) 分桶保存，每套题只发放一次。
+    某个桶的库存低于下限时由后台线程补充到目标数量，模型调用不再占用请求路径；
+    桶为空时 take 返回 None，由调用方同步生成。只有被请求过 hot_after 次（或通过 warm 预热）的桶才会补充，
+    只出现一次的组合不会在同步生成之外再触发 target 次后台调用。
+    """
+
+    def __init__(self, generate, target=3, low_watermark=2, max_buckets=512, max_age=86400, workers=2,
+                 max_failures=3, hot_after=2):
+        """
+        初始化题目池
+
+        Args:
+            generate: 生成函数，接收basic_info并返回校验后的问题列表，无效时返回空列表
+            target: 每个桶补充到的题目套数
+            low_watermark: 库存低于该值时触发补充
+            max_buckets: 最多保留的桶数量，超出时淘汰最久未使用的桶
+            max_age: 题目的最长保留时间（秒），过期的题目不再发放
+            workers: 后台补充线程数
+            max_failures: 单次补充中连续生成失败的次数上限
+            hot_after: 桶被请求多少次后才开始补充
+        """
+        self.generate = generate
+        self.target = target
+        self.low_watermark = low_watermark
+        self.max_buckets = max_buckets
+        self.max_age = max_age
+        self.workers = workers
+        self.max_failures = max_failures
+        self.hot_after = hot_after
+
+        self._buckets = OrderedDict()
+        self._infos = {}
+        self._requests = {}
+        self._pending = set()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._hits = 0
+        self._misses = 0
+
+    def take(self, basic_info):
+        """
+        取出一套题目，并在库存不足且桶已被请求 hot_after 次时安排后台补充
+
+        Returns:
+            list: 问题列表，池中没有可用题目时返回None
+        """
+        key = bucket_key(basic_info)
+        now = time.monotonic()
+        with self._lock:
+            questions = None
+            bucket = self._buckets.get(key)
+            while bucket:
+                created, item = bucket.popleft()
+                if now - created <= self.max_age:
+                    questions = item
+                    break
+
+            if questions is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+            self._track(key, basic_info)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            if self._requests[key] >= self.hot_after:
+                self._request_refill(key)
+        return questions
+
+    def warm(self, basic_infos):
+        """为给定的基础信息预先补充题目（不受 hot_after 限制）"""
+        with self._lock:
+            for basic_info in basic_infos:
+                key = bucket_key(basic_info)
+                self._track(key, basic_info)
+                self._request_refill(key)
+
+    def stats(self):
+        """
+        获取题目池统计
+
+        Returns:
+            dict: 包含buckets、sets、pending、hits、misses的字典
+        """
+        with self._lock:
+            return {
+                'buckets': len(self._buckets),
+                'sets': sum(len(bucket) for bucket in self._buckets.values()),
+                'pending': len(self._pending),
+                'hits': self._hits,
+                'misses': self._misses,
+            }
+
+    def _track(self, key, basic_info):
+        """登记（或刷新）一个桶，超出数量上限时淘汰最久未使用的桶"""
+        if key in self._buckets:
+            self._buckets.move_to_end(key)
+        else:
+            self._buckets[key] = deque()
+            self._infos[key] = {field: value for field, value in zip(BUCKET_FIELDS, key)}
+        while len(self._buckets) > self.max_buckets:
+            old_key, _ = self._buckets.popitem(last=False)
+            self._infos.pop(old_key, None)
+            self._requests.pop(old_key, None)
+
+    def _request_refill(self, key):
+        """库存低于下限时把桶加入补充队列（调用方持有锁）"""
+        bucket = self._buckets.get(key)
+        if bucket is None or len(bucket) >= self.low_watermark or key in self._pending:
+            return
+        self._pending.add(key)
+        self._queue.put(key)
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run, name="quiz-pool-refill", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        """补充线程：把队列中的桶补充到目标数量"""
+        while True:
+            key = self._queue.get()
+            failures = 0
+            while True:
+                with self._lock:
+                    bucket = self._buckets.get(key)
+                    basic_info = self._infos.get(key)
+                    if bucket is None or len(bucket) >= self.target or failures >= self.max_failures:
+                        self._pending.discard(key)
+                        break
+
+                try:
+                    questions = self.generate(basic_info)
+                except Exception as e:
+                    print(f"题目池补充失败: {e}")
+                    questions = None
+
+                if not questions:
+                    failures += 1
+                    continue
+                failures = 0
+                with self._lock:
+                    bucket = self._buckets.get(key)
+                    if bucket is not None:
+                        bucket.append((time.monotonic(), questions))
+
+
+def quiz_pool_from_env(generate):
+    """
+    根据环境变量创建题目池
+
+    环境变量：
+        QUIZ_POOL: 设为 off 时关闭题目池，每次请求都同步生成
+        QUIZ_POOL_TARGET: 每个桶补充到的题目套数
+        QUIZ_POOL_LOW: 触发补充的库存下限
+        QUIZ_POOL_WORKERS: 后台补充线程数
+        QUIZ_POOL_HOT_AFTER: 桶被请求多少次后才开始补充，默认2
+
+    Returns:
+        QuizPool: 题目池实例，关闭时返回None
+    """
+    if os.getenv('QUIZ_POOL', 'on').lower() == 'off':
+        return None
+
+    return QuizPool(
+        generate,
+        target=int(os.getenv('QUIZ_POOL_TARGET', 3)),
+        low_watermark=int(os.getenv('QUIZ_POOL_LOW', 2)),
+        workers=int(os.getenv('QUIZ_POOL_WORKERS', 2)),
+        hot_after=int(os.getenv('QUIZ_POOL_HOT_AFTER', 2)),
+    )
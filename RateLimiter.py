@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+from Metrics import record
+
+# 估算对话请求token数时为回复预留的token数
+COMPLETION_ALLOWANCE = 300
+
+# 在并发上限处排队时重新检查的间隔（秒），仅用于协程等待
+_ASYNC_POLL = 0.05
+
+
+class Overloaded(Exception):
+    """在排队期限内无法获得上游调用配额，应返回503并提示客户端稍后重试"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def estimate_tokens(messages, completion=COMPLETION_ALLOWANCE):
+    """粗略估算一次对话请求消耗的token数（中文约1.5字/token），用于每分钟token数限流"""
+    chars = sum(len(str(message.get('content') or '')) for message in messages)
+    return int(math.ceil(chars / 1.5)) + completion
+
+
+class TokenBucket:
+    """令牌桶：按每分钟速率持续补充，容量为一分钟的配额"""
+
+    def __init__(self, per_minute, burst=None):
+        self.rate = per_minute / 60.0
+        self.capacity = burst if burst is not None else per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """获得amount个令牌还需等待的时间（秒），超过容量的请求只需等桶满"""
+        self._refill(now)
+        needed = min(amount, self.capacity)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= amount
+
+
+class _ModelState:
+    def __init__(self, concurrency=None, rpm=None, tpm=None):
+        self.concurrency = concurrency
+        self.rpm = TokenBucket(rpm) if rpm else None
+        self.tpm = TokenBucket(tpm) if tpm else None
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed = 0
+
+
+class Permit:
+    """一次已获准的上游调用，可在拿到实际用量后校正每分钟token数的计数"""
+
+    def __init__(self, limiter, model, tokens):
+        self.limiter = limiter
+        self.model = model
+        self.tokens = tokens
+
+    def report(self, actual_tokens):
+        """用实际消耗的token数替换估算值"""
+        if actual_tokens is None:
+            return
+        self.limiter._adjust(self.model, actual_tokens - self.tokens)
+        self.tokens = actual_tokens
+
+
+class Limiter:
+    """上游调用的准入控制，ChatBot 和 ImageGenerator 共用
+
+    每个模型有独立的并发上限、每分钟请求数（RPM）和每分钟token数（TPM）令牌桶。
+    调用方在期限内排队等待配额；预计等不到时立即放弃并抛出 Overloaded（带建议的重试时间），
+    不再把突发流量转成上游的429和重试风暴。
+    """
+
+    def __init__(self, limits=None, max_wait=10):
+        """
+        初始化准入控制
+
+        Args:
+            limits: {模型名称: {"concurrency": 并发上限, "rpm": 每分钟请求数, "tpm": 每分钟token数}}，
+                    键 "default" 用于未单独配置的模型；未配置的项不限制
+            max_wait: 默认的排队期限（秒）
+        """
+        self.limits = limits or {}
+        self.max_wait = max_wait
+        self._states = {}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+
+    @contextmanager
+    def acquire(self, model, tokens=0, timeout=None, shed=True):
+        """
+        获取一次调用配额，离开上下文时释放并发名额
+
+        Args:
+            model: 模型名称
+            tokens: 本次调用预计消耗的token数
+            timeout: 排队期限（秒），为None时使用 max_wait
+            shed: 得不到配额时是否计入 shed 统计；可有可无的调用（如对冲请求）传False
+
+        Yields:
+            Permit: 可用于上报实际用量
+
+        Raises:
+            Overloaded: 期限内无法获得配额
+        """
+        started = time.monotonic()
+        deadline = started + (self.max_wait if timeout is None else timeout)
+        with self._cond:
+            while True:
+                wait = self._try_acquire(model, tokens)
+                if wait == 0:
+                    break
+                self._wait_or_shed(model, wait, deadline, shed)
+                self._cond.wait(self._sleep_time(wait, deadline))
+        record('upstream.wait', time.monotonic() - started, model)
+        try:
+            yield Permit(self, model, tokens)
+        finally:
+            self._release(model)
+
+    @asynccontextmanager
+    async def aacquire(self, model, tokens=0, timeout=None, shed=True):
+        """acquire 的协程版本，排队时不占用线程"""
+        started = time.monotonic()
+        deadline = started + (self.max_wait if timeout is None else timeout)
+        while True:
+            with self._lock:
+                wait = self._try_acquire(model, tokens)
+                if wait == 0:
+                    break
+                self._wait_or_shed(model, wait, deadline, shed)
+            await asyncio.sleep(min(self._sleep_time(wait, deadline), wait or _ASYNC_POLL))
+        record('upstream.wait', time.monotonic() - started, model)
+        try:
+            yield Permit(self, model, tokens)
+        finally:
+            self._release(model)
+
+    def stats(self):
+        """
+        获取各模型的准入统计
+
+        Returns:
+            dict: {模型名称: {"in_flight", "admitted", "shed"}}
+        """
+        with self._lock:
+            return {model: {'in_flight': state.in_flight, 'admitted': state.admitted, 'shed': state.shed}
+                    for model, state in self._states.items()}
+
+    def _state(self, model):
+        state = self._states.get(model)
+        if state is None:
+            config = self.limits.get(model, self.limits.get('default', {}))
+            state = _ModelState(config.get('concurrency'), config.get('rpm'), config.get('tpm'))
+            self._states[model] = state
+        return state
+
+    def _try_acquire(self, model, tokens):
+        """
+        尝试获得配额（调用方持有锁）
+
+        Returns:
+            0表示已获得；正数表示令牌桶还需等待的秒数；None表示在等待并发名额
+        """
+        state = self._state(model)
+        if state.concurrency is not None and state.in_flight >= state.concurrency:
+            return None
+        now = time.monotonic()
+        wait = max(state.rpm.wait_time(1, now) if state.rpm else 0.0,
+                   state.tpm.wait_time(tokens, now) if state.tpm and tokens else 0.0)
+        if wait > 0:
+            return wait
+        state.in_flight += 1
+        state.admitted += 1
+        if state.rpm:
+            state.rpm.take(1)
+        if state.tpm and tokens:
+            state.tpm.take(tokens)
+        return 0
+
+    def _wait_or_shed(self, model, wait, deadline, shed=True):
+        """期限已到，或令牌桶需要的等待超出期限时放弃（调用方持有锁）"""
+        remaining = deadline - time.monotonic()
+        if remaining > 0 and (wait is None or wait <= remaining):
+            return
+        if shed:
+            self._state(model).shed += 1
+        retry_after = max(1, int(math.ceil(wait if wait is not None else 1)))
+        raise Overloaded(f"上游模型 {model} 繁忙，请稍后再试", retry_after)
+
+    @staticmethod
+    def _sleep_time(wait, deadline):
+        remaining = max(0.0, deadline - time.monotonic())
+        return remaining if wait is None else min(wait, remaining)
+
+    def _release(self, model):
+        with self._cond:
+            self._state(model).in_flight -= 1
+            self._cond.notify_all()
+
+    def _adjust(self, model, delta):
+        with self._lock:
+            state = self._state(model)
+            if state.tpm:
+                state.tpm.take(delta)
+
+
+def per_worker(limits, workers):
+    """
+    把整个服务的限额平分到每个工作进程（准入状态在各进程内存中，互不相通）
+
+    Args:
+        limits: 格式同 Limiter 的 limits 参数
+        workers: 工作进程数
+
+    Returns:
+        dict: 每个进程的限额，每项至少为1
+    """
+    if workers <= 1:
+        return limits
+    return {model: {key: max(1, int(value / workers)) for key, value in config.items()}
+            for model, config in limits.items()}
+
+
+def limiter_from_env():
+    """
+    根据环境变量创建准入控制
+
+    环境变量：
+        UPSTREAM_LIMITS: JSON，格式同 Limiter 的 limits 参数，是整个服务（所有工作进程合计）的限额；设为 off 时不限制
+        UPSTREAM_MAX_WAIT: 排队期限（秒）
+        WORKERS: 工作进程数（serve.py 设置），每个进程使用 1/WORKERS 的限额
+
+    Returns:
+        Limiter: 准入控制实例，关闭时返回None
+    """
+    config = os.getenv('UPSTREAM_LIMITS', '{"default": {"concurrency": 8}}')
+    if config.lower() == 'off':
+        return None
+    return Limiter(per_worker(json.loads(config), int(os.getenv('WORKERS', 1))),
+                   max_wait=float(os.getenv('UPSTREAM_MAX_WAIT', 10)))
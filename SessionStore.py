@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def new_session_id():
+    """生成不可猜测的会话ID"""
+    return secrets.token_urlsafe(24)
+
+
+class SessionStore:
+    """内存中的会话存储，按最近访问淘汰并带滑动过期时间
+
+    会话数据以JSON保存，get 返回的是副本；修改会话需通过 update 原子地完成。
+    """
+
+    # 数据是否在多个进程之间共享
+    shared = False
+
+    def __init__(self, ttl=24 * 3600, max_sessions=10000):
+        """
+        初始化会话存储
+
+        Args:
+            ttl: 会话在最后一次访问后的有效期（秒）
+            max_sessions: 最多保留的会话数，超出时淘汰最久未访问的会话
+        """
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, data):
+        """
+        创建会话
+
+        Returns:
+            str: 会话ID
+        """
+        session_id = new_session_id()
+        with self._lock:
+            self._entries[session_id] = (json.dumps(data, ensure_ascii=False), time.time())
+            self._evict()
+        return session_id
+
+    def put(self, session_id, data):
+        """以指定的键写入（或覆盖）一条数据，供任务状态等需要跨进程可见的数据使用"""
+        with self._lock:
+            self._entries[session_id] = (json.dumps(data, ensure_ascii=False), time.time())
+            self._entries.move_to_end(session_id)
+            self._evict()
+
+    def get(self, session_id):
+        """
+        读取会话
+
+        Returns:
+            dict: 会话数据的副本，不存在或已过期时返回None
+        """
+        with self._lock:
+            payload = self._touch(session_id)
+        return json.loads(payload) if payload is not None else None
+
+    def update(self, session_id, func):
+        """
+        原子地修改会话
+
+        Args:
+            session_id: 会话ID
+            func: 接收会话数据（dict）并就地修改的函数
+
+        Returns:
+            dict: 修改后的会话数据，会话不存在或已过期时返回None
+        """
+        with self._lock:
+            payload = self._touch(session_id)
+            if payload is None:
+                return None
+            data = json.loads(payload)
+            func(data)
+            self._entries[session_id] = (json.dumps(data, ensure_ascii=False), time.time())
+        return data
+
+    def delete(self, session_id):
+        """删除会话"""
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def stats(self):
+        """
+        获取会话统计
+
+        Returns:
+            dict: 包含size的字典
+        """
+        with self._lock:
+            return {'size': len(self._entries)}
+
+    def _touch(self, session_id):
+        """取出未过期的会话并刷新访问时间（调用方持有锁）"""
+        entry = self._entries.get(session_id)
+        if entry is None:
+            return None
+        payload, accessed = entry
+        now = time.time()
+        if now - accessed > self.ttl:
+            del self._entries[session_id]
+            return None
+        self._entries[session_id] = (payload, now)
+        self._entries.move_to_end(session_id)
+        return payload
+
+    def _evict(self):
+        now = time.time()
+        while self._entries:
+            session_id, (_, accessed) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_sessions and now - accessed <= self.ttl:
+                break
+            del self._entries[session_id]
+
+
+class SQLiteSessionStore(SessionStore):
+    """基于SQLite的会话存储，可在进程重启和多个进程之间共享"""
+
+    shared = True
+
+    def __init__(self, path, ttl=24 * 3600, max_sessions=100000):
+        """
+        初始化会话存储
+
+        Args:
+            path: SQLite数据库文件路径
+            ttl: 会话在最后一次访问后的有效期（秒）
+            max_sessions: 最多保留的会话数
+        """
+        super().__init__(ttl=ttl, max_sessions=max_sessions)
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, data TEXT NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_accessed ON sessions (accessed)")
+            self._conn.commit()
+
+    def create(self, data):
+        session_id = new_session_id()
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sessions (id, data, accessed) VALUES (?, ?, ?)",
+                (session_id, json.dumps(data, ensure_ascii=False), now)
+            )
+            self._conn.execute("DELETE FROM sessions WHERE accessed < ?", (now - self.ttl,))
+            self._conn.execute(
+                "DELETE FROM sessions WHERE id IN ("
+                "SELECT id FROM sessions ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_sessions,)
+            )
+            self._conn.commit()
+        return session_id
+
+    def put(self, session_id, data):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, accessed) VALUES (?, ?, ?)",
+                (session_id, json.dumps(data, ensure_ascii=False), time.time())
+            )
+            self._conn.commit()
+
+    def get(self, session_id):
+        with self._lock:
+            payload = self._touch(session_id)
+            self._conn.commit()
+        return json.loads(payload) if payload is not None else None
+
+    def update(self, session_id, func):
+        with self._lock:
+            # 立即获取写锁，避免多个进程同时修改同一会话时互相覆盖
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                payload = self._touch(session_id)
+                if payload is None:
+                    self._conn.commit()
+                    return None
+                data = json.loads(payload)
+                func(data)
+                self._conn.execute(
+                    "UPDATE sessions SET data = ?, accessed = ? WHERE id = ?",
+                    (json.dumps(data, ensure_ascii=False), time.time(), session_id)
+                )
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+        return data
+
+    def delete(self, session_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            return {'size': self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]}
+
+    def _touch(self, session_id):
+        row = self._conn.execute("SELECT data, accessed FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        if row is None:
+            return None
+        payload, accessed = row
+        now = time.time()
+        if now - accessed > self.ttl:
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            return None
+        self._conn.execute("UPDATE sessions SET accessed = ? WHERE id = ?", (now, session_id))
+        return payload
+
+
+def session_store_from_env():
+    """
+    根据环境变量创建会话存储
+
+    环境变量：
+        SESSION_DB: SQLite数据库路径，设置后使用持久化存储（多进程部署时需要），否则使用内存存储
+        SESSION_TTL: 会话在最后一次访问后的有效期（秒）
+
+    Returns:
+        SessionStore: 会话存储实例
+    """
+    ttl = float(os.getenv('SESSION_TTL', 24 * 3600))
+    db_path = os.getenv('SESSION_DB')
+    if db_path:
+        return SQLiteSessionStore(db_path, ttl=ttl)
+    return SessionStore(ttl=ttl)
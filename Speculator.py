@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def speculation_key(*parts):
+    """根据生成所需的全部输入计算预生成结果的键"""
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class Speculator:
+    """在用户做选择时提前生成下一步内容
+
+    每个预生成任务以其全部输入为键登记，之后的真实请求通过 claim 取走进行中或已完成的结果，
+    输入不同（例如用户重新开始）时自然不会命中。同时进行的预生成数量受 max_in_flight 限制，
+    超出时直接放弃预生成，不与真实请求争抢资源；未被取走的任务在过期或被淘汰时取消。
+    代价较高的预生成（如图片）可通过 spend 按所有者（玩家）计入预算。
+    """
+
+    def __init__(self, max_in_flight=2, workers=2, ttl=600, max_entries=128, budget=None, max_owners=1024):
+        """
+        初始化预生成管理器
+
+        Args:
+            max_in_flight: 同时进行的预生成任务上限
+            workers: 每个预生成任务内部可并发执行的步骤数
+            ttl: 未被取走的结果保留时间（秒）
+            max_entries: 最多保留的预生成任务数
+            budget: 每个所有者可消耗的预算上限，None表示不限
+            max_owners: 最多记录预算消耗的所有者数量
+        """
+        self.max_in_flight = max_in_flight
+        self.workers = workers
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.budget = budget
+        self.max_owners = max_owners
+
+        self._entries = OrderedDict()
+        self._spent = OrderedDict()
+        self._running = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._skipped = 0
+
+    def start(self, key, launch, group=None):
+        """
+        开始一个预生成任务
+
+        Args:
+            key: 预生成结果的键
+            launch: 启动函数，接收一个 threading.Event（被设置表示已取消，供无法中断的线程任务检查），
+                    返回支持 add_done_callback、cancel 的 future（concurrent.futures.Future 或 asyncio 任务）
+            group: 任务分组，可通过 cancel_group 一并取消
+
+        Returns:
+            bool: 是否启动了新任务（已存在相同任务或超出并发上限时返回False）
+        """
+        with self._lock:
+            self._expire()
+            if key in self._entries:
+                return False
+            if self._running >= self.max_in_flight:
+                self._skipped += 1
+                return False
+            cancelled = threading.Event()
+            future = launch(cancelled)
+            self._running += 1
+            self._entries[key] = {'future': future, 'cancelled': cancelled, 'created': time.monotonic(),
+                                  'group': group}
+            while len(self._entries) > self.max_entries:
+                _, entry = self._entries.popitem(last=False)
+                self._cancel(entry)
+        future.add_done_callback(self._finished)
+        return True
+
+    def claim(self, key):
+        """
+        取走一个预生成任务
+
+        Returns:
+            future: 进行中或已完成的任务，不存在时返回None
+        """
+        with self._lock:
+            self._expire()
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            return entry['future']
+
+    def cancel(self, key):
+        """取消一个尚未被取走的预生成任务"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._cancel(entry)
+
+    def cancel_group(self, group):
+        """取消同一分组中尚未被取走的预生成任务（例如用户已选定某个选项后的其他选项）"""
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if entry['group'] == group]
+            entries = [self._entries.pop(key) for key in keys]
+        for entry in entries:
+            self._cancel(entry)
+
+    def spend(self, owner, cost=1):
+        """
+        从所有者的预算中扣除cost
+
+        Returns:
+            bool: 预算是否足够（不足时不扣除）
+        """
+        with self._lock:
+            spent = self._spent.pop(owner, 0)
+            allowed = self.budget is None or spent + cost <= self.budget
+            if allowed:
+                spent += cost
+            self._spent[owner] = spent
+            while len(self._spent) > self.max_owners:
+                self._spent.popitem(last=False)
+            return allowed
+
+    def refund(self, owner, cost=1):
+        """退还未实际使用的预算"""
+        with self._lock:
+            if owner in self._spent:
+                self._spent[owner] = max(0, self._spent[owner] - cost)
+
+    def stats(self):
+        """
+        获取预生成统计
+
+        Returns:
+            dict: 包含entries、running、hits、misses、skipped的字典
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'running': self._running,
+                'hits': self._hits,
+                'misses': self._misses,
+                'skipped': self._skipped,
+            }
+
+    def _finished(self, future):
+        with self._lock:
+            self._running -= 1
+
+    def _expire(self):
+        """取消并移除过期的任务（调用方持有锁）"""
+        now = time.monotonic()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if now - entry['created'] <= self.ttl:
+                break
+            del self._entries[key]
+            self._cancel(entry)
+
+    @staticmethod
+    def _cancel(entry):
+        entry['cancelled'].set()
+        entry['future'].cancel()
+
+
+def speculator_from_env():
+    """
+    根据环境变量创建预生成管理器
+
+    环境变量：
+        SPECULATE: 设为 on 时开启预生成（默认关闭）
+        SPECULATE_MAX_IN_FLIGHT: 同时进行的预生成任务上限
+        SPECULATE_WORKERS: 每个预生成任务内部的并发步骤数
+        SPECULATE_TTL: 未被取走的结果保留时间（秒）
+
+    Returns:
+        Speculator: 预生成管理器，关闭时返回None
+    """
+    if os.getenv('SPECULATE', 'off').lower() != 'on':
+        return None
+
+    return Speculator(
+        max_in_flight=int(os.getenv('SPECULATE_MAX_IN_FLIGHT', 2)),
+        workers=int(os.getenv('SPECULATE_WORKERS', 2)),
+        ttl=float(os.getenv('SPECULATE_TTL', 600)),
+    )
+
+
+def outcome_speculator_from_env():
+    """
+    根据环境变量创建选项结局的预生成管理器
+
+    环境变量：
+        SPECULATE_OUTCOMES: 设为 on 时为每个选项预生成结局（默认关闭）
+        SPECULATE_OUTCOMES_MAX_IN_FLIGHT: 同时进行的结局预生成任务上限
+        SPECULATE_IMAGE_BUDGET: 每位玩家可预生成的结局图片数，为0时只预生成文字
+        SPECULATE_WORKERS、SPECULATE_TTL: 同 speculator_from_env
+
+    Returns:
+        Speculator: 预生成管理器（budget 为图片预算），关闭时返回None
+    """
+    if os.getenv('SPECULATE_OUTCOMES', 'off').lower() != 'on':
+        return None
+
+    return Speculator(
+        max_in_flight=int(os.getenv('SPECULATE_OUTCOMES_MAX_IN_FLIGHT', 6)),
+        workers=int(os.getenv('SPECULATE_WORKERS', 2)),
+        ttl=float(os.getenv('SPECULATE_TTL', 600)),
+        budget=int(os.getenv('SPECULATE_IMAGE_BUDGET', 0)),
+    )
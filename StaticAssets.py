@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+静态资源的缓存策略和预压缩
+
+构建镜像时运行 `python StaticAssets.py static` 为 static/ 下的文本资源生成 .gz（以及安装了 brotli 时的 .br）版本，
+请求时按 Accept-Encoding 直接返回压缩好的文件，不在请求中压缩。
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import sys
+import tempfile
+import threading
+from werkzeug.security import safe_join
+
+# 带内容哈希版本号的静态资源可以永久缓存
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# 生成的图片按提示词的哈希命名而不是按内容：缓存淘汰后同一地址会重新生成出不同的图片，只缓存一天
+IMAGE_CACHE = 'public, max-age=86400'
+
+# 地址不变而内容可能更新的文件：每次使用前用 ETag 向服务器确认，未修改时返回304
+REVALIDATE = 'no-cache'
+
+# 按压缩率从高到低的顺序选择预压缩版本
+_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+_COMPRESSIBLE = ('.html', '.css', '.js', '.json', '.svg', '.txt')
+
+# 小于该字节数的文件压缩收益不抵额外的请求头
+_MIN_SIZE = 512
+
+# 预压缩文件的权限；临时文件创建时只有属主可读（0600），以其他用户运行的前端服务器会读不到
+_FILE_MODE = 0o644
+
+# index.html 中引用的静态资源地址，改写为带版本号的地址
+_ASSET_RE = re.compile(r'((?:href|src)=")/static/([^"?#]+)(")')
+
+
+def _brotli():
+    """brotli 为可选依赖，未安装时只生成 gzip 版本"""
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def _accepted_encodings(accept_encoding):
+    """Accept-Encoding 头中接受的编码（q=0 表示拒绝）"""
+    accepted = set()
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = re.search(r'q=([0-9.]+)', params)
+        if coding and (quality is None or float(quality.group(1)) > 0):
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def _write_atomic(path, data):
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".part", delete=False) as tmp:
+        tmp.write(data)
+    os.chmod(tmp.name, _FILE_MODE)
+    os.replace(tmp.name, path)
+
+
+def precompress(directory):
+    """
+    为目录下的文本资源生成预压缩版本，已是最新的跳过
+
+    Args:
+        directory: 静态资源目录
+
+    Returns:
+        int: 新生成的压缩文件数
+    """
+    brotli = _brotli()
+    written = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            source = os.path.join(root, name)
+            if not name.endswith(_COMPRESSIBLE) or os.path.getsize(source) < _MIN_SIZE:
+                continue
+            mtime = os.path.getmtime(source)
+            with open(source, 'rb') as f:
+                data = f.read()
+            for encoding, suffix in _ENCODINGS:
+                target = source + suffix
+                if os.path.exists(target) and os.path.getmtime(target) >= mtime:
+                    continue
+                if encoding == 'br':
+                    if brotli is None:
+                        continue
+                    _write_atomic(target, brotli.compress(data, quality=11))
+                else:
+                    _write_atomic(target, gzip.compress(data, 9, mtime=0))
+                written += 1
+    return written
+
+
+class StaticAssets:
+    """静态资源：按 Accept-Encoding 选择预压缩版本，按内容哈希给资源地址加版本号
+
+    index.html 中引用的 /static/ 资源被改写为 /static/<文件>?v=<内容哈希>，带当前版本号的请求可以永久缓存；
+    index.html 本身和不带版本号的请求每次向服务器确认（ETag），资源更新后页面立即引用新地址。
+    """
+
+    def __init__(self, directory='static', index='index.html', compress=True):
+        """
+        初始化静态资源
+
+        Args:
+            directory: 静态资源目录
+            index: 首页文件名
+            compress: 是否在启动时补齐缺失或过期的预压缩文件（目录不可写时跳过）
+        """
+        self.directory = directory
+        self.index_name = index
+        self._versions = {}
+        self._index = None
+        self._lock = threading.Lock()
+        if compress:
+            try:
+                precompress(directory)
+            except OSError as e:
+                print(f"预压缩静态资源失败: {e}")
+
+    def version(self, filename):
+        """
+        资源的版本号（内容哈希），按修改时间和大小缓存
+
+        Returns:
+            str: 版本号，文件不存在时返回None
+        """
+        path = safe_join(self.directory, filename)
+        if path is None or not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        key = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            cached = self._versions.get(filename)
+            if cached is not None and cached[0] == key:
+                return cached[1]
+        with open(path, 'rb') as f:
+            digest = hashlib.md5(f.read()).hexdigest()[:12]
+        with self._lock:
+            self._versions[filename] = (key, digest)
+        return digest
+
+    def resolve(self, filename, accept_encoding=None, ranged=False):
+        """
+        选择要发送的文件
+
+        Args:
+            filename: 请求的资源路径（相对静态资源目录）
+            accept_encoding: 请求的 Accept-Encoding 头
+            ranged: 是否为 Range 请求；范围针对原始文件，此时不返回压缩版本
+
+        Returns:
+            tuple: (文件路径, MIME 类型, 内容编码)，编码为None表示未压缩；文件不存在时返回None
+        """
+        path = safe_join(self.directory, filename)
+        if path is None or not os.path.isfile(path):
+            return None
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        if not ranged:
+            accepted = _accepted_encodings(accept_encoding)
+            for encoding, suffix in _ENCODINGS:
+                compressed = path + suffix
+                if encoding in accepted and os.path.isfile(compressed) \
+                        and os.path.getmtime(compressed) >= os.path.getmtime(path):
+                    return compressed, mimetype, encoding
+        return path, mimetype, None
+
+    def cache_control(self, filename, version=None):
+        """请求带有资源当前版本号时永久缓存，否则每次确认"""
+        return IMMUTABLE if version and version == self.version(filename) else REVALIDATE
+
+    def index(self, accept_encoding=None):
+        """
+        改写资源地址后的首页，首页或资源更新后重新生成
+
+        Returns:
+            tuple: (内容, 内容编码, ETag)
+        """
+        path = os.path.join(self.directory, self.index_name)
+        with open(path, 'rb') as f:
+            html = f.read().decode('utf-8')
+        rendered = self._index
+        key = (html, tuple(self.version(match[1]) for match in _ASSET_RE.findall(html)))
+        if rendered is None or rendered[0] != key:
+            body = _ASSET_RE.sub(lambda m: f"{m.group(1)}/static/{m.group(2)}?v={self.version(m.group(2)) or ''}"
+                                           f"{m.group(3)}", html).encode('utf-8')
+            etag = hashlib.md5(body).hexdigest()
+            rendered = self._index = (key, body, gzip.compress(body, 9, mtime=0), etag)
+        _, body, compressed, etag = rendered
+        if 'gzip' in _accepted_encodings(accept_encoding):
+            return compressed, 'gzip', etag + '-gzip'
+        return body, None, etag
+
+
+def cache_headers(response, cache_control, encoding=None, negotiated=False):
+    """
+    设置缓存和内容编码相关的响应头
+
+    Args:
+        response: Flask 或 Quart 的响应
+        cache_control: Cache-Control 的值
+        encoding: 预压缩版本的内容编码，为None表示未压缩
+        negotiated: 是否按 Accept-Encoding 选择了版本（共享缓存需要按该头区分）
+
+    Returns:
+        response
+    """
+    response.headers['Cache-Control'] = cache_control
+    # 发送文件时框架会按默认有效期设置 Expires，以 Cache-Control 为准
+    response.headers.pop('Expires', None)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if negotiated:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+if __name__ == '__main__':
+    target = sys.argv[1] if len(sys.argv) > 1 else 'static'
+    print(f"预压缩 {target}：生成 {precompress(target)} 个文件"
+          f"{'' if _brotli() else '（未安装 brotli，只生成 gzip）'}")
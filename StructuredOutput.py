@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import json
+import re
+
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)```", re.S)
+_TRAILING_COMMA_RE = re.compile(r",\s*([}\]])")
+
+_TYPES = {
+    'object': dict,
+    'array': list,
+    'string': str,
+    'integer': int,
+    'number': (int, float),
+    'boolean': bool,
+}
+
+
+def _candidates(text):
+    """依次给出可能是JSON的文本片段：原文、代码块内容、最外层括号之间的内容"""
+    text = text.strip()
+    yield text
+    for block in _FENCE_RE.findall(text):
+        yield block.strip()
+    for open_char, close_char in (('{', '}'), ('[', ']')):
+        start, end = text.find(open_char), text.rfind(close_char)
+        if start != -1 and end > start:
+            yield text[start:end + 1]
+
+
+def extract_json(text):
+    """
+    从模型回复中提取JSON，容忍代码块包裹、前后说明文字和多余的尾逗号
+
+    Returns:
+        解析出的JSON值
+
+    Raises:
+        ValueError: 无法提取出合法JSON
+    """
+    for candidate in _candidates(text or ''):
+        for attempt in (candidate, _TRAILING_COMMA_RE.sub(r"\1", candidate)):
+            try:
+                return json.loads(attempt)
+            except json.JSONDecodeError:
+                continue
+    raise ValueError("回复中没有合法的JSON")
+
+
+def validate(value, schema, path='$'):
+    """
+    按JSON Schema的常用子集校验数据
+
+    支持 type、properties、required、items、minItems、maxItems、minLength、enum。
+
+    Raises:
+        ValueError: 数据不符合schema，错误信息包含出错位置
+    """
+    expected = schema.get('type')
+    if expected:
+        python_type = _TYPES[expected]
+        if not isinstance(value, python_type) or (expected in ('integer', 'number') and isinstance(value, bool)):
+            raise ValueError(f"{path} 应为 {expected}")
+
+    if 'enum' in schema and value not in schema['enum']:
+        raise ValueError(f"{path} 应为 {schema['enum']} 之一")
+
+    if isinstance(value, str) and len(value.strip()) < schema.get('minLength', 0):
+        raise ValueError(f"{path} 长度不足")
+
+    if isinstance(value, dict):
+        for key in schema.get('required', ()):
+            if key not in value:
+                raise ValueError(f"{path} 缺少字段 {key}")
+        for key, sub_schema in schema.get('properties', {}).items():
+            if key in value:
+                validate(value[key], sub_schema, f"{path}.{key}")
+
+    if isinstance(value, list):
+        if len(value) < schema.get('minItems', 0):
+            raise ValueError(f"{path} 至少需要 {schema['minItems']} 项")
+        if 'maxItems' in schema and len(value) > schema['maxItems']:
+            raise ValueError(f"{path} 最多 {schema['maxItems']} 项")
+        if 'items' in schema:
+            for index, item in enumerate(value):
+                validate(item, schema['items'], f"{path}[{index}]")
+
+
+def parse_structured(text, schema):
+    """
+    解析并校验模型回复的结构化输出
+
+    Returns:
+        符合schema的JSON值
+
+    Raises:
+        ValueError: 无法解析或不符合schema
+    """
+    value = extract_json(text)
+    validate(value, schema)
+    return value
+
+
+def repair_prompt(error, schema):
+    """构建要求模型修正上一条回复的提示"""
+    return f"""上一条回复无法使用：{error}。
+请只输出修正后的JSON，必须符合以下JSON Schema，不要额外说明：
+{json.dumps(schema, ensure_ascii=False)}"""
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class TaskGraph:
+    """任务依赖图，依赖满足的步骤会被立即并发调度，总耗时取决于关键路径"""
+
+    def __init__(self):
+        self.tasks = {}
+
+    def add(self, name, func, deps=()):
+        """
+        添加一个步骤
+
+        Args:
+            name: 步骤名称，同时作为结果字典的键
+            func: 步骤函数，依赖步骤的结果会以同名关键字参数传入
+            deps: 依赖的步骤名称列表
+
+        Returns:
+            TaskGraph: 自身，便于链式调用
+        """
+        if name in self.tasks:
+            raise ValueError(f"步骤重复定义: {name}")
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError(f"步骤 {name} 依赖了未定义的步骤: {dep}")
+        self.tasks[name] = (func, tuple(deps))
+        return self
+
+    def run(self, executor=None, max_workers=None, on_result=None):
+        """
+        执行所有步骤，任一步骤失败时取消尚未开始的步骤并抛出该异常
+
+        Args:
+            executor: 使用的线程池，如果为None则为本次执行创建一个
+            max_workers: 新建线程池的最大线程数，默认为步骤数量
+            on_result: 每个步骤完成时的回调，参数为 (步骤名称, 结果)
+
+        Returns:
+            dict: 步骤名称到结果的映射
+        """
+        if executor is None:
+            own_executor = ThreadPoolExecutor(max_workers=max_workers or max(len(self.tasks), 1))
+            try:
+                results = self.run(own_executor, on_result=on_result)
+            except BaseException:
+                # 失败时不等待仍在执行的其他步骤，异常立即返回给调用方（这些步骤的结果不再需要）
+                own_executor.shutdown(wait=False, cancel_futures=True)
+                raise
+            own_executor.shutdown()
+            return results
+
+        results = {}
+        pending = dict(self.tasks)
+        running = {}
+
+        while pending or running:
+            # 提交所有依赖已满足的步骤
+            for name, (func, deps) in list(pending.items()):
+                if all(dep in results for dep in deps):
+                    kwargs = {dep: results[dep] for dep in deps}
+                    # 步骤在调用方的上下文中执行（例如请求的追踪记录）
+                    running[executor.submit(contextvars.copy_context().run, func, **kwargs)] = name
+                    del pending[name]
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception:
+                    for other in running:
+                        other.cancel()
+                    raise
+                if on_result:
+                    on_result(name, results[name])
+
+        return results
+
+    async def arun(self, on_result=None):
+        """
+        在事件循环中执行所有步骤，步骤函数需为协程函数；任一步骤失败时取消其余步骤并抛出该异常
+
+        Args:
+            on_result: 每个步骤完成时的回调，参数为 (步骤名称, 结果)
+
+        Returns:
+            dict: 步骤名称到结果的映射
+        """
+        results = {}
+        pending = dict(self.tasks)
+        running = {}
+
+        try:
+            while pending or running:
+                for name, (func, deps) in list(pending.items()):
+                    if all(dep in results for dep in deps):
+                        kwargs = {dep: results[dep] for dep in deps}
+                        running[asyncio.ensure_future(func(**kwargs))] = name
+                        del pending[name]
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = running.pop(task)
+                    results[name] = task.result()
+                    if on_result:
+                        on_result(name, results[name])
+        finally:
+            for task in running:
+                task.cancel()
+
+        return results
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, InvalidStateError
+from Metrics import TASK_POLL_CHECKS
+
+# 任务的终止状态
+_FINAL_STATUS = ('SUCCEED', 'FAILED')
+
+
+def _resolve(future, result=None, error=None):
+    """完成future；调用方已取消时忽略"""
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+def _percentile(values, q):
+    """计算有序列表的分位数（最近秩法）"""
+    index = min(len(values) - 1, max(0, int(round(q * (len(values) - 1)))))
+    return values[index]
+
+
+class TaskPoller:
+    """集中轮询所有进行中的远程任务
+
+    所有任务由一个调度线程统一安排检查时间，检查请求在一个小线程池中执行，
+    不再为每个任务占用一个 sleep 中的线程。检查间隔是自适应的：
+    积累了某个模型的历史完成耗时后，在大概率尚未完成的阶段不做检查，
+    在常见完成区间内密集检查，超出后按指数退避；没有历史数据时从短间隔开始逐步退避。
+    """
+
+    def __init__(self, check, min_interval=0.5, max_interval=5, backoff=1.5, history=50, workers=4,
+                 min_samples=5):
+        """
+        初始化轮询器
+
+        Args:
+            check: 检查函数，接收task_id并返回任务状态字典（含 task_status 字段）
+            min_interval: 最短检查间隔（秒）
+            max_interval: 最长检查间隔（秒）
+            backoff: 无历史数据或超出常见完成区间时的间隔增长倍数
+            history: 每个模型保留的最近完成耗时数量
+            workers: 执行检查请求的线程数
+            min_samples: 启用基于历史分布的调度所需的最少样本数
+        """
+        self.check = check
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.history = history
+        self.min_samples = min_samples
+
+        self._heap = []
+        self._seq = itertools.count()
+        self._durations = {}
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="task-poller")
+        self._thread = None
+
+    def submit(self, task_id, model=None):
+        """
+        登记一个进行中的任务
+
+        Args:
+            task_id: 任务ID
+            model: 模型名称，用于按模型统计完成耗时
+
+        Returns:
+            Future: 任务到达终止状态（SUCCEED/FAILED）时以最后一次的状态字典完成；
+                    检查请求出错时以该异常完成；调用方可取消以停止轮询
+        """
+        entry = {
+            'task_id': task_id,
+            'model': model,
+            'future': Future(),
+            'started': time.monotonic(),
+            'checks': 0,
+        }
+        with self._cond:
+            self._schedule(entry, self._next_delay(entry))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="task-poller-scheduler", daemon=True)
+                self._thread.start()
+        return entry['future']
+
+    def in_flight(self):
+        """当前等待中的任务数"""
+        with self._cond:
+            return len(self._heap)
+
+    def stats(self, model=None):
+        """
+        获取某个模型的完成耗时分布
+
+        Returns:
+            dict: 包含count、p10、p50、p90的字典（秒），样本不足时只含count
+        """
+        with self._cond:
+            durations = sorted(self._durations.get(model, ()))
+        result = {'count': len(durations)}
+        if durations:
+            result.update({q: _percentile(durations, p)
+                           for q, p in (('p10', 0.1), ('p50', 0.5), ('p90', 0.9))})
+        return result
+
+    def _schedule(self, entry, delay):
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), entry))
+        self._cond.notify()
+
+    def _next_delay(self, entry):
+        """根据已等待时间和该模型的历史完成耗时计算下一次检查的等待时间"""
+        elapsed = time.monotonic() - entry['started']
+        durations = sorted(self._durations.get(entry['model'], ()))
+
+        if len(durations) >= self.min_samples:
+            early, late = _percentile(durations, 0.1), _percentile(durations, 0.9)
+            if elapsed < early:
+                # 此前完成的概率很低，直接等到常见完成区间的起点
+                return max(self.min_interval, early - elapsed)
+            if elapsed <= late:
+                return self.min_interval
+            overdue_checks = max(0, entry['checks'] - 1)
+            return min(self.max_interval, self.min_interval * (self.backoff ** overdue_checks))
+
+        return min(self.max_interval, self.min_interval * (self.backoff ** entry['checks']))
+
+    def _run(self):
+        """调度线程：取出到期的任务并交给线程池检查"""
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                due, _, entry = self._heap[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self._heap)
+
+            if entry['future'].cancelled():
+                continue
+            self._executor.submit(self._check, entry)
+
+    def _check(self, entry):
+        future = entry['future']
+        try:
+            data = self.check(entry['task_id'])
+        except Exception as e:
+            _resolve(future, error=e)
+            return
+
+        entry['checks'] += 1
+        if data.get('task_status') in _FINAL_STATUS:
+            TASK_POLL_CHECKS.observe(entry['checks'], model=entry['model'] or '')
+            if data.get('task_status') == 'SUCCEED':
+                with self._cond:
+                    durations = self._durations.setdefault(entry['model'], deque(maxlen=self.history))
+                    durations.append(time.monotonic() - entry['started'])
+            _resolve(future, data)
+            return
+
+        with self._cond:
+            if not future.cancelled():
+                self._schedule(entry, self._next_delay(entry))
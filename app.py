@@ -1,43 +1,265 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, request, jsonify, send_from_directory, Response
-from concurrent.futures import ThreadPoolExecutor
+"""同步（WSGI）服务入口，组件和业务逻辑在 GameService 中与 asgi.py 共用，这里只负责以线程方式执行步骤"""
+from flask import Flask, request, jsonify, send_from_directory, send_file, Response, stream_with_context, g
 from flask_cors import CORS
-import base64
-import json
+import contextvars
 import os
-import random
-from ChatBot import ChatBot
-from GenPic import ImageGenerator
-from myToken import myToken
-
-app = Flask(__name__, static_folder='static')
+import queue
+import threading
+from werkzeug.exceptions import NotFound
+from concurrent.futures import Future, CancelledError
+from StaticAssets import IMAGE_CACHE, REVALIDATE, cache_headers
+from TaskGraph import TaskGraph
+from Pipeline import (STAGES, IMAGE_MODEL, personality_prompt, fallback_questions, review_prompt, stage_plan,
+                      outcome_plan, stage_response, CACHEABLE_STEPS, STREAMED_STEPS, STEP_TASKS, step_event,
+                      sse_event, saved_stage, saved_outcome, review_stages, stage_events)
+from GameService import (FAVICON_PNG, PRIORITY_INTERACTIVE, SpeculativeRun, chatbot, image_generator,
+                         image_wait_timeout, image_variants, static_assets, quiz_pool, session_store, warm_up_status,
+                         generate_quiz, run_image_job, register_metrics, player, speculate_stage, speculate_after_stage,
+                         claim_stage, claim_outcome, stage_index_of, create_session, request_session, save_stage,
+                         save_outcome, image_job_request, job_missing, error_payload, error_response, readiness)
+from JobQueue import FINAL_STATUS, job_queue_from_env
+from Metrics import REGISTRY, span, start_trace, finish_trace
+
+app = Flask(__name__, static_folder=None)
 CORS(app)
 
-# 1x1 PNG favicon to avoid 404s on /favicon.ico without adding a binary file.
-_FAVICON_PNG = b"iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR4nGMAAQAABQABDQottAAAAABJRU5ErkJggg=="
+# 图片生成任务队列：所有图片任务由固定数量的后台线程执行，与HTTP worker数量无关；
+# 会话存储在多进程间共享时任务状态也写入其中，任一进程都能查询
+image_jobs = job_queue_from_env(run_image_job, store=session_store)
+
+def shutdown():
+    """
+    停止受理新任务并等待已受理的图片任务完成，排队中的预生成任务直接取消
+
+    由 serve.py 在工作进程停止服务后、开发服务器在 app.run 返回后调用。任务还要用轮询器的线程池，
+    解释器退出时线程池先于 atexit 处理函数关闭，因此不注册为 atexit
+    """
+    image_jobs.drain(max_priority=PRIORITY_INTERACTIVE)
+    if image_variants is not None:
+        image_variants.close()
+
+register_metrics(image_jobs)
+
+def _warm_up():
+    """预先建立到上游的连接，使导入客户端库、DNS解析和TLS握手不计入第一个请求；失败只记录，不影响服务"""
+    for name, client in (('chat', chatbot), ('image', image_generator)):
+        warm_up_status[name] = 'pending'
+        try:
+            with span('warm_up', name):
+                client.warm_up()
+            warm_up_status[name] = 'ok'
+        except Exception as e:
+            warm_up_status[name] = f"failed: {e}"
+            print(f"预热上游连接 {name} 失败: {e}")
+
+# 在后台预热（WARM_UP=off 时关闭），不推迟开始接受请求
+if os.getenv('WARM_UP', 'on').lower() != 'off':
+    threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+
+def _ask(prompt, use_cache=False, on_delta=None, task=None):
+    """
+    在一个新的对话上下文中发送单轮提示并返回回复
+
+    use_cache 为 True 时复用相同提示的缓存回复；传入 on_delta 时以流式方式请求并逐段回调
+    """
+    return chatbot.conversation(task=task).chat(prompt, stream=on_delta is not None, print_response=False,
+                                                use_cache=use_cache, on_delta=on_delta)
+
+def _generate_image(prompt, session=None, priority=PRIORITY_INTERACTIVE, run=None):
+    """通过任务队列生成图片并等待结果（不超过 image_wait_timeout 秒）；预生成任务（run）提交的图片由其记录并决定优先级"""
+    payload = {'prompt': prompt, 'model': IMAGE_MODEL}
+    if run is not None:
+        job_id = run.submit_image(payload)
+    else:
+        job_id = image_jobs.submit(payload, session=session, priority=priority)
+    try:
+        return image_jobs.result(job_id, timeout=image_wait_timeout)
+    except TimeoutError:
+        image_jobs.cancel(job_id)
+        raise
+
+def _run_step(name, kind, build, post, args, on_delta=None, image_job=None):
+    """执行一个步骤声明：构造输入、调用模型、处理结果，image_job 为图片任务的提交参数（session、priority 或 run）"""
+    if kind == 'local':
+        result = build(*args)
+    else:
+        with span('step', name):
+            if kind == 'json':
+                prompt, schema = build(*args)
+                result = chatbot.conversation(task=STEP_TASKS.get(name)).chat_json(
+                    prompt, schema, use_cache=name in CACHEABLE_STEPS)
+            elif kind == 'image':
+                result = _generate_image(build(*args), **(image_job or {}))
+            else:
+                result = _ask(build(*args), use_cache=name in CACHEABLE_STEPS, on_delta=on_delta,
+                              task=STEP_TASKS.get(name))
+    return post(result) if post else result
+
+def _build_graph(plan, on_delta=None, cancelled=None, known=None, image_job=None):
+    """
+    将步骤声明转换为同步执行的依赖图
+
+    Args:
+        plan: Pipeline 中的步骤声明
+        on_delta: 流式步骤每收到一段输出时的回调，参数为 (步骤名称, 内容)
+        cancelled: threading.Event，被设置后尚未开始的步骤不再执行
+        known: 已有的步骤结果（如预生成的部分结果），这些步骤直接返回而不再调用模型
+        image_job: 图片任务的提交参数（session、priority，预生成时为 run）
+    """
+    graph = TaskGraph()
+    for name, deps, kind, build, post in plan:
+        step_delta = None
+        if on_delta and name in STREAMED_STEPS:
+            step_delta = lambda text, _name=name: on_delta(_name, text)
+        def step(_name=name, _kind=kind, _build=build, _post=post, _deps=deps, _delta=step_delta, **results):
+            if known and _name in known:
+                return known[_name]
+            if cancelled is not None and cancelled.is_set():
+                raise RuntimeError("生成已取消")
+            return _run_step(_name, _kind, _build, _post, [results[dep] for dep in _deps], on_delta=_delta,
+                             image_job=image_job)
+        graph.add(name, step, deps=deps)
+    return graph
+
+def _plan_launcher(plan, workers, player):
+    """返回供 Speculator.start 使用的启动函数：在后台线程中以预生成优先级执行步骤声明"""
+    def launch(cancelled):
+        run = SpeculativeRun(image_jobs, player, cancelled)
+        run.future = Future()
+
+        def worker():
+            if not run.future.set_running_or_notify_cancel():
+                return
+            try:
+                graph = _build_graph(plan, cancelled=cancelled, image_job={'run': run})
+                run.future.set_result(graph.run(max_workers=workers, on_result=run.record))
+            except Exception as e:
+                run.future.set_exception(e)
+
+        threading.Thread(target=worker, daemon=True).start()
+        return run
+
+    return launch
+
+def _speculative_results(speculative):
+    """
+    等待预生成任务完成
+
+    Returns:
+        tuple: (全部步骤结果, 已完成的步骤结果)；失败或已取消时全部结果为None，由调用方只重新生成未完成的步骤
+    """
+    try:
+        return speculative.future.result(), None
+    except (Exception, CancelledError) as e:
+        print(f"预生成结果不可用，重新生成: {e}")
+        return None, speculative.partial()
+
+def _finish_stage(session_id, stage_index, basic_info, personality, results):
+    """保存阶段结果到会话并开始后续预生成，返回接口数据"""
+    response = save_stage(session_id, stage_index, results)
+    speculate_after_stage(_plan_launcher, stage_index, basic_info, personality, results)
+    return response
+
+def _stream_plan(plan, build_response, speculative=None, on_done=None, image_job=None):
+    """
+    在后台线程中执行步骤声明，并把流式输出和每个步骤的结果作为 SSE 事件依次推送
+
+    事件：delta（流式步骤的增量文本）、<步骤名称>（该步骤的结果）、done（完整的接口数据）、error
+
+    Args:
+        speculative: 预生成任务；已完成时直接推送其结果，尚未完成时立即推送已完成的步骤，
+                     其余步骤取消后重新生成（流式步骤因此能逐段推送，不必等整个预生成结束）
+        on_done: 全部步骤完成后、推送 done 之前的回调，参数为步骤结果
+        image_job: 图片任务的提交参数，同 _build_graph
+    """
+    events = queue.Queue()
+
+    def on_delta(name, text):
+        events.put(('delta', {'step': name, 'text': text}))
+
+    def worker():
+        try:
+            results = known = None
+            if speculative is not None:
+                if speculative.done():
+                    results, known = _speculative_results(speculative)
+                else:
+                    known = speculative.partial()
+            if results is not None:
+                for name, *_ in plan:
+                    events.put((name, step_event(name, results[name])))
+            else:
+                graph = _build_graph(plan, on_delta=on_delta, known=known, image_job=image_job)
+                results = graph.run(on_result=lambda name, result: events.put((name, step_event(name, result))))
+            if on_done:
+                # 先保存再推送 done，客户端收到 done 后立即发出的下一个请求能读到本阶段的结果
+                on_done(results)
+            events.put(('done', build_response(results)))
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            events.put(('error', error_payload(e)))
+        finally:
+            events.put(None)
+
+    # 在请求的上下文中执行，使各步骤的耗时归入该请求的追踪
+    threading.Thread(target=contextvars.copy_context().run, args=(worker,), daemon=True).start()
+
+    def generate():
+        while True:
+            item = events.get()
+            if item is None:
+                return
+            yield sse_event(*item)
+
+    return _sse_response(generate())
+
+def _sse_response(events):
+    """将 SSE 消息生成器包装为流式响应"""
+    return Response(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.before_request
+def _begin_trace():
+    g.trace = start_trace(request.url_rule.rule if request.url_rule else 'unmatched')
 
-# 初始化工具
-chatbot = ChatBot(api_key=myToken)
-image_generator = ImageGenerator()
+@app.after_request
+def _trace_status(response):
+    g.status = response.status_code
+    return response
 
-# 游戏阶段定义
-STAGES = [
-    {"name": "幼儿时期", "age_range": "0-12岁"},
-    {"name": "少年时期", "age_range": "13-24岁"},
-    {"name": "青年时期", "age_range": "25-36岁"},
-    {"name": "中年时期", "age_range": "37-50岁"}
-]
+@app.teardown_request
+def _end_trace(exc):
+    # 流式响应在推送结束后才执行到这里，记录的是完整耗时
+    finish_trace(g.pop('trace', None), g.pop('status', 500 if exc else ''))
 
 @app.route('/')
 def index():
-    return send_from_directory('static', 'index.html')
+    """首页：引用的静态资源带版本号，首页本身每次用 ETag 确认"""
+    body, encoding, etag = static_assets.index(request.headers.get('Accept-Encoding'))
+    response = Response(body, mimetype='text/html')
+    response.set_etag(etag)
+    response = response.make_conditional(request)
+    return cache_headers(response, REVALIDATE, encoding, negotiated=True)
+
+@app.route('/static/<path:filename>')
+def static_file(filename):
+    """静态资源：带当前版本号（v 参数）的请求永久缓存，按 Accept-Encoding 返回预压缩版本，支持 ETag 和 Range"""
+    asset = static_assets.resolve(filename, request.headers.get('Accept-Encoding'), 'Range' in request.headers)
+    if asset is None:
+        raise NotFound()
+    path, mimetype, encoding = asset
+    response = send_file(path, mimetype=mimetype)
+    return cache_headers(response, static_assets.cache_control(filename, request.args.get('v')), encoding,
+                         negotiated=True)
 
 @app.route('/favicon.ico')
 def favicon():
-    return Response(
-        base64.b64decode(_FAVICON_PNG),
-        mimetype='image/png'
-    )
+    return Response(FAVICON_PNG, mimetype='image/png')
 
 @app.route('/api/start', methods=['POST'])
 def start_game():
@@ -46,60 +268,24 @@ def start_game():
         data = request.json
         basic_info = data.get('basic_info', {})
         answers = data.get('answers', [])
-        
-        # 构建性格画像生成提示
-        gender = basic_info.get('gender', '')
-        mbti = basic_info.get('mbti', '')
-        zodiac = basic_info.get('zodiac', '')
-        background = basic_info.get('background', '')
-        
-        formatted_answers = []
-        for item in answers:
-            if isinstance(item, dict):
-                question = str(item.get('question', '')).strip()
-                answer = str(item.get('answer', '')).strip()
-                if question and answer:
-                    formatted_answers.append(f"Q: {question}\nA: {answer}")
-                elif answer:
-                    formatted_answers.append(answer)
-            elif item:
-                formatted_answers.append(str(item))
-
-        formatted_answers_text = "\n".join(formatted_answers)
-
-        prompt = f"""根据以下信息生成一个详细的性格画像（控制在150字以内）：
-
-基础信息：
-- 性别：{gender}
-- MBTI：{mbti}
-- 星座：{zodiac}
-- 家庭出身背景：{background}
-
-性格测试答案：
-{formatted_answers_text}
-
-请生成一个生动、具体的性格画像，描述这个人的性格特点、行为倾向、价值观等。控制在150字以内。"""
-        
+
         # 生成性格画像
-        chatbot.clear_history()
-        personality = chatbot.chat(prompt, stream=False, print_response=False)
-        
-        # 保存用户信息到session（简化版，实际应该用session或数据库）
-        user_data = {
-            'basic_info': basic_info,
-            'personality': personality,
-            'current_stage': 0,
-            'stages_data': []
-        }
-        
+        with span('step', 'personality'):
+            personality = _ask(personality_prompt(basic_info, answers), use_cache=True, task='personality')
+        speculate_stage(_plan_launcher, 0, basic_info, personality)
+
+        # 保存用户信息到服务端会话，之后的请求只需携带 session_id
+        session_id, user_data = create_session(basic_info, personality)
+
         return jsonify({
             'success': True,
+            'session_id': session_id,
             'personality': personality,
             'user_data': user_data
         })
-    
+
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+        return error_response(e)
 
 @app.route('/api/quiz_questions', methods=['POST'])
 def quiz_questions():
@@ -107,340 +293,199 @@ def quiz_questions():
     try:
         data = request.json or {}
         basic_info = data.get('basic_info', {})
-        seed = random.randint(1000, 9999)
 
-        prompt = f"""你是性格测试设计师，请根据以下基础信息随机生成5个问题，每个问题提供3个简短选项，用于标定人物性格倾向。
+        questions = quiz_pool.take(basic_info) if quiz_pool else None
+        if not questions:
+            questions = generate_quiz(basic_info)
+        if questions:
+            return jsonify({'success': True, 'questions': questions})
+
+        return jsonify({'success': True, 'questions': fallback_questions()})
+
+    except Exception as e:
+        return error_response(e)
 
-基础信息：
-- 性别：{basic_info.get('gender', '')}
-- MBTI：{basic_info.get('mbti', '')}
-- 星座：{basic_info.get('zodiac', '')}
-- 家庭出身背景：{basic_info.get('background', '')}
-- 随机种子：{seed}
+@app.route('/api/generate_stage', methods=['POST'])
+def generate_stage():
+    """生成某个阶段的故事和图片"""
+    try:
+        data = request.json
+        stage_index = stage_index_of(data)
+        session_id, session = request_session(data)
 
-要求：
-1. 问题要具体、贴近日常场景
-2. 选项要有区分度
-3. 输出JSON，格式为：{{"questions":[{{"question":"...", "options":["...","...","..."]}}]}}
-4. 只输出JSON，不要额外说明
-"""
+        saved = saved_stage(session, stage_index)
+        if saved:
+            return jsonify(saved)
 
-        chatbot.clear_history()
-        raw = chatbot.chat(prompt, stream=False, print_response=False)
+        stage = STAGES[stage_index]
+        basic_info = session['basic_info']
+        personality = session['personality']
 
-        def _parse_questions(text):
-            try:
-                return json.loads(text)
-            except json.JSONDecodeError:
-                start = text.find('{')
-                end = text.rfind('}')
-                if start != -1 and end != -1 and end > start:
-                    return json.loads(text[start:end + 1])
-                raise
+        speculative = claim_stage(stage_index, basic_info, personality)
+        results, known = _speculative_results(speculative) if speculative is not None else (None, None)
+        if results is None:
+            print("正在按依赖图并发生成阶段内容...")
+            results = _build_graph(stage_plan(stage, basic_info, personality), known=known,
+                                   image_job={'session': player(basic_info, personality)}).run()
 
-        try:
-            data_obj = _parse_questions(raw)
-            questions = data_obj.get('questions', []) if isinstance(data_obj, dict) else []
-            normalized = []
-            for item in questions:
-                question = str(item.get('question', '')).strip()
-                options = item.get('options', [])
-                options = [str(option).strip() for option in options if str(option).strip()]
-                if question and options:
-                    normalized.append({'question': question, 'options': options})
-            if normalized:
-                return jsonify({'success': True, 'questions': normalized})
-        except Exception:
-            pass
-
-        fallback_pool = [
-            {"question": "面对一项陌生任务，你更会先做什么？", "options": ["先拆解步骤再行动", "先行动再根据反馈调整", "先询问他人经验"]},
-            {"question": "当你必须做决定时，你更看重？", "options": ["逻辑和数据", "直觉和感受", "过往经验"]},
-            {"question": "在团队合作中你更像？", "options": ["组织者", "执行者", "协调者"]},
-            {"question": "你如何应对压力？", "options": ["制定计划逐步解决", "用兴趣转移注意", "寻求支持与交流"]},
-            {"question": "别人评价你时更常听到的是？", "options": ["理性", "温和", "果断"]},
-            {"question": "当计划被打乱时，你会？", "options": ["迅速重新规划", "顺势而为", "先冷静观察"]},
-            {"question": "你更喜欢哪种生活节奏？", "options": ["有序稳定", "灵活多变", "循序渐进"]},
-            {"question": "遇到冲突时，你倾向于？", "options": ["直接沟通", "先冷静再处理", "尽量回避"]},
-        ]
-        random.shuffle(fallback_pool)
-        return jsonify({'success': True, 'questions': fallback_pool[:5]})
+        return jsonify(_finish_stage(session_id, stage_index, basic_info, personality, results))
 
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)}), 500
+        return error_response(e)
 
-@app.route('/api/generate_stage', methods=['POST'])
-def generate_stage():
-    """生成某个阶段的故事和图片"""
+@app.route('/api/generate_stage_stream', methods=['POST'])
+def generate_stage_stream():
+    """以 Server-Sent Events 流式生成某个阶段：先逐段推送故事，再在每个步骤完成时推送其结果"""
     try:
         data = request.json
-        stage_index = data.get('stage_index', 0)
-        user_data = data.get('user_data', {})
-        
-        if stage_index >= len(STAGES):
-            return jsonify({'success': False, 'error': '无效的阶段索引'}), 400
-        
+        stage_index = stage_index_of(data)
+        session_id, session = request_session(data)
+
+        saved = saved_stage(session, stage_index)
+        if saved:
+            return _sse_response(sse_event(*event) for event in stage_events(saved))
+
         stage = STAGES[stage_index]
-        basic_info = user_data.get('basic_info', {})
-        personality = user_data.get('personality', '')
-        
-        # 生成故事
-        story_prompt = f"""你是一个人生故事模拟器。根据以下信息，生成一段{stage['name']}（{stage['age_range']}）正在发生的故事：
-
-人物信息：
-- 性别：{basic_info.get('gender', '')}
-- MBTI：{basic_info.get('mbti', '')}
-- 星座：{basic_info.get('zodiac', '')}
-- 家庭背景：{basic_info.get('background', '')}
-- 性格画像：{personality}
-
-要求：
-1. 故事要生动具体，符合该年龄段的特征
-2. 故事要有冲突或选择点，但结局还未确定
-3. 控制在200字以内
-4. 故事要能引发读者的思考和选择
-
-请生成故事："""
-        
-        chatbot.clear_history()
-        story = chatbot.chat(story_prompt, stream=False, print_response=False)
-        
-        # 生成选择题
-        choice_prompt = f"""基于以下故事，生成一个选择题，让用户决定故事的走向：
-
-故事：{story}
-
-要求：
-1. 生成一个选择题，包含问题和2-3个选项
-2. 选项要能影响故事的结局
-3. 格式：问题\nA. 选项1\nB. 选项2\nC. 选项3（如果有）
-
-请生成选择题："""
-        
-        choice_text = chatbot.chat(choice_prompt, stream=False, print_response=False)
-        
-        # 解析选择题
-        lines = choice_text.strip().split('\n')
-        question = lines[0] if lines else "你会如何选择？"
-        options = [line.strip() for line in lines[1:] if line.strip() and (line.strip().startswith('A.') or line.strip().startswith('B.') or line.strip().startswith('C.'))]
-        
-        # 生成第一张图的prompt
-        prompt1_text = f"""将以下故事转换为图片生成提示词（prompt）：
-
-故事：{story}
-
-要求：
-1. 描述故事的开头场景
-2. 适合漫画风格
-3. 用中文描述，简洁明了
-4. 包含场景、人物、情绪等细节
-
-请生成prompt："""
-        
-        chatbot.clear_history()
-        image_prompt1 = chatbot.chat(prompt1_text, stream=False, print_response=False)
-        # 清理prompt，只保留英文描述
-        image_prompt1 = image_prompt1.strip().replace('Prompt:', '').replace('prompt:', '').strip()
-        if len(image_prompt1) > 500:
-            image_prompt1 = image_prompt1[:500]
-        
-        # 生成第二张图的prompt
-        prompt2_text = f"""将以下故事转换为图片生成提示词（prompt），描述故事发展到关键时刻的场景：
-
-故事：{story}
-
-要求：
-1. 描述故事发展到关键时刻的场景
-2. 适合漫画风格
-3. 用英文描述，简洁明了
-4. 包含场景、人物、情绪等细节
-
-请生成prompt："""
-        
-        image_prompt2 = chatbot.chat(prompt2_text, stream=False, print_response=False)
-        image_prompt2 = image_prompt2.strip().replace('Prompt:', '').replace('prompt:', '').strip()
-        if len(image_prompt2) > 500:
-            image_prompt2 = image_prompt2[:500]
-        
-        # 生成图片（并行）
-        prompt1 = f"comic style, {image_prompt1}, colorful, detailed"
-        prompt2 = f"comic style, {image_prompt2}, colorful, detailed"
-        print("正在并行生成前两张图片...")
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            future1 = executor.submit(
-                image_generator.generate_and_save,
-                prompt1,
-                model="Qwen/Qwen-Image"
-            )
-            future2 = executor.submit(
-                image_generator.generate_and_save,
-                prompt2,
-                model="Qwen/Qwen-Image"
-            )
-            image_path1 = future1.result()
-            image_path2 = future2.result()
-        
-        # 生成图片描述文字
-        desc1_prompt = f"""为以下故事的开头场景生成一句简短的描述文字（20字以内）：
-
-故事：{story}
-
-请生成描述："""
-        chatbot.clear_history()
-        desc1 = chatbot.chat(desc1_prompt, stream=False, print_response=False).strip()
-        
-        desc2_prompt = f"""为以下故事的关键时刻场景生成一句简短的描述文字（20字以内）：
-
-故事：{story}
-
-请生成描述："""
-        desc2 = chatbot.chat(desc2_prompt, stream=False, print_response=False).strip()
-        
-        return jsonify({
-            'success': True,
-            'story': story,
-            'question': question,
-            'options': options,
-            'images': [
-                {'path': image_path1, 'description': desc1},
-                {'path': image_path2, 'description': desc2}
-            ]
-        })
-    
+        basic_info = session['basic_info']
+        personality = session['personality']
+
+        return _stream_plan(
+            stage_plan(stage, basic_info, personality),
+            stage_response,
+            speculative=claim_stage(stage_index, basic_info, personality),
+            on_done=lambda results: _finish_stage(session_id, stage_index, basic_info, personality, results),
+            image_job={'session': player(basic_info, personality)}
+        )
+
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({'success': False, 'error': str(e)}), 500
+        return error_response(e)
 
 @app.route('/api/generate_outcome', methods=['POST'])
 def generate_outcome():
     """根据用户选择生成结局图片"""
     try:
         data = request.json
-        stage_index = data.get('stage_index', 0)
-        user_data = data.get('user_data', {})
-        story = data.get('story', '')
+        stage_index = stage_index_of(data)
         choice = data.get('choice', '')
-        
-        if stage_index >= len(STAGES):
-            return jsonify({'success': False, 'error': '无效的阶段索引'}), 400
-        
+        session_id, session = request_session(data)
+
+        saved = saved_outcome(session, stage_index, choice)
+        if saved:
+            return jsonify(saved)
+
         stage = STAGES[stage_index]
-        
-        # 生成结局故事
-        outcome_prompt = f"""基于以下故事和用户的选择，生成故事的结局：
-
-原故事：{story}
-用户选择：{choice}
-阶段：{stage['name']}（{stage['age_range']}）
-
-要求：
-1. 根据用户的选择，生成一个合理的结局
-2. 结局要符合人物的性格和背景
-3. 控制在150字以内
-4. 结局要有意义，能体现选择的影响
-
-请生成结局："""
-        
-        chatbot.clear_history()
-        outcome = chatbot.chat(outcome_prompt, stream=False, print_response=False)
-        
-        # 生成结局图片的prompt
-        image_prompt_text = f"""将以下结局转换为图片生成提示词（prompt）：
-
-结局：{outcome}
-
-要求：
-1. 描述结局的场景
-2. 适合漫画风格
-3. 用英文描述，简洁明了
-4. 包含场景、人物、情绪等细节
-
-请生成prompt："""
-        
-        image_prompt = chatbot.chat(image_prompt_text, stream=False, print_response=False)
-        image_prompt = image_prompt.strip().replace('Prompt:', '').replace('prompt:', '').strip()
-        if len(image_prompt) > 500:
-            image_prompt = image_prompt[:500]
-        
-        # 生成结局图片
-        print(f"正在生成结局图片...")
-        image_path = image_generator.generate_and_save(
-            f"comic style, {image_prompt}, colorful, detailed",
-            model="Qwen/Qwen-Image"
-        )
-        
-        # 生成结局描述
-        desc_prompt = f"""为以下结局生成一句简短的描述文字（20字以内）：
+        story = data.get('story') or (saved_stage(session, stage_index) or {}).get('story', '')
 
-结局：{outcome}
+        speculative = claim_outcome(stage_index, story, choice)
+        results, known = _speculative_results(speculative) if speculative is not None else (None, None)
+
+        print("正在生成结局及结局图片...")
+        results = _build_graph(outcome_plan(stage, story, choice), known=results or known,
+                               image_job={'session': player(session['basic_info'], session['personality'])}).run()
+
+        return jsonify(save_outcome(session_id, stage_index, choice, results))
 
-请生成描述："""
-        chatbot.clear_history()
-        desc = chatbot.chat(desc_prompt, stream=False, print_response=False).strip()
-        
-        return jsonify({
-            'success': True,
-            'outcome': outcome,
-            'image': {'path': image_path, 'description': desc}
-        })
-    
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({'success': False, 'error': str(e)}), 500
+        return error_response(e)
 
 @app.route('/api/life_review', methods=['POST'])
 def life_review():
     """生成整个人生回顾的简短描述"""
     try:
         data = request.json or {}
-        user_data = data.get('user_data', {})
-        stages = data.get('stages', [])
-        basic_info = user_data.get('basic_info', {})
-        personality = user_data.get('personality', '')
+        session_id, session = request_session(data)
 
-        stage_lines = []
-        for item in stages:
-            if not isinstance(item, dict):
-                continue
-            stage = item.get('stage', {})
-            stage_name = stage.get('name', '某阶段')
-            story = str(item.get('story', '')).strip()
-            outcome = str(item.get('outcome', '')).strip()
-            if story or outcome:
-                stage_lines.append(f"{stage_name}：{story} 结局：{outcome}")
+        stages = review_stages(session) if session_id else data.get('stages', [])
+        basic_info = session['basic_info']
+        personality = session['personality']
 
-        stage_lines_text = "\n".join(stage_lines)
+        with span('step', 'review'):
+            summary = _ask(review_prompt(basic_info, personality, stages), use_cache=True, task='review').strip()
 
-        prompt = f"""请根据以下信息生成一段100字以内的人生回顾总结，语言温暖、简洁，突出关键转折。
-
-基础信息：
-- 性别：{basic_info.get('gender', '')}
-- MBTI：{basic_info.get('mbti', '')}
-- 星座：{basic_info.get('zodiac', '')}
-- 家庭出身背景：{basic_info.get('background', '')}
-- 性格画像：{personality}
-
-阶段内容：
-{stage_lines_text}
+        return jsonify({'success': True, 'summary': summary})
 
-请输出一段简短回顾："""
+    except Exception as e:
+        return error_response(e)
 
-        chatbot.clear_history()
-        summary = chatbot.chat(prompt, stream=False, print_response=False).strip()
+@app.route('/api/jobs/image', methods=['POST'])
+def submit_image_job():
+    """提交图片生成任务，立即返回任务ID，之后通过 /api/jobs/<job_id> 查询结果"""
+    try:
+        payload, session, priority = image_job_request(request.json or {})
+        job_id = image_jobs.submit(payload, session=session, priority=priority)
 
-        return jsonify({'success': True, 'summary': summary})
+        return jsonify({'success': True, 'job': image_jobs.get(job_id)}), 202
 
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({'success': False, 'error': str(e)}), 500
+        return error_response(e)
+
+@app.route('/api/jobs/<job_id>')
+def get_job(job_id):
+    """查询任务状态；带 wait 参数（秒，最长30）时长轮询，直到任务结束或超时"""
+    wait = min(request.args.get('wait', 0, type=float), 30)
+    job = image_jobs.wait(job_id, timeout=wait) if wait > 0 else image_jobs.get(job_id)
+    if job is None:
+        return job_missing()
+    return jsonify({'success': True, 'job': job})
+
+@app.route('/api/jobs/<job_id>/events')
+def job_events(job_id):
+    """以 Server-Sent Events 推送任务状态，状态变化时推送 status 事件，任务结束后关闭"""
+    job = image_jobs.get(job_id)
+    if job is None:
+        return job_missing()
+
+    def generate(job):
+        last = None
+        while job is not None:
+            progress = (job['status'], job.get('queued_ahead'))
+            if progress != last:
+                yield sse_event('status', job)
+                last = progress
+            else:
+                yield ": keepalive\n\n"
+            if job['status'] in FINAL_STATUS:
+                return
+            job = image_jobs.wait(job_id, timeout=2)
+
+    return _sse_response(generate(job))
+
+@app.route('/healthz')
+def healthz():
+    """存活检查：进程能处理请求即返回200，不访问上游"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """就绪检查，见 GameService.readiness"""
+    return readiness(image_jobs)
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus 文本格式的指标"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/images/<path:filename>')
 def serve_image(filename):
-    """提供图片文件服务"""
-    return send_from_directory('images', filename)
+    """
+    提供图片文件服务；w（显示宽度）和 format（avif/webp/jpeg）参数或 Accept 头可选择缩略图和现代格式版本
+
+    图片按提示词的哈希命名，缓存淘汰后同一地址可能重新生成出不同的内容，因此只缓存一天（IMAGE_CACHE）；支持 ETag 和 Range
+    """
+    if image_variants is None:
+        return cache_headers(send_from_directory(image_generator.output_dir, filename), IMAGE_CACHE)
+    variant = image_variants.get(filename, request.headers.get('Accept'), request.args.get('format'),
+                                 request.args.get('w', type=int))
+    if variant is None:
+        response = send_from_directory(image_generator.output_dir, filename)
+    else:
+        response = send_file(variant[0], mimetype=variant[1])
+    # 同一地址按 Accept 头返回不同格式，共享缓存需要区分
+    response.vary.add('Accept')
+    return cache_headers(response, IMAGE_CACHE)
 
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port=7860)
+    try:
+        app.run(host="0.0.0.0", port=7860)
+    finally:
+        shutdown()
@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+"""异步（ASGI）服务入口，接口与 app.py 完全一致，组件和业务逻辑在 GameService 中共用
+
+所有模型调用和图片任务轮询都以协程方式等待，单个进程即可同时挂起大量生成请求，
+而不需要为每个请求占用线程；会话存储的读写在线程中执行，不阻塞事件循环。启动方式：
+
+    hypercorn asgi:app --bind 0.0.0.0:7860
+"""
+from quart import Quart, request, jsonify, send_from_directory, send_file, Response, g
+from quart_cors import cors
+import asyncio
+import os
+from werkzeug.exceptions import NotFound
+from ChatBot import AsyncChatBot
+from StaticAssets import IMAGE_CACHE, REVALIDATE, cache_headers
+from TaskGraph import TaskGraph
+from Pipeline import (STAGES, IMAGE_MODEL, personality_prompt, quiz_prompt, QUIZ_SCHEMA, normalize_questions,
+                      fallback_questions, review_prompt, stage_plan, outcome_plan, stage_response, CACHEABLE_STEPS,
+                      STREAMED_STEPS, STEP_TASKS, step_event, sse_event, saved_stage, saved_outcome, review_stages,
+                      stage_events)
+from GameService import (FAVICON_PNG, PRIORITY_INTERACTIVE, SpeculativeRun, limiter, model_routes, hedging,
+                         llm_deadline, chatbot as sync_chatbot, image_generator, image_wait_timeout, image_variants,
+                         static_assets, quiz_pool, session_store, warm_up_status, arun_image_job, register_metrics,
+                         player, speculate_stage, speculate_after_stage, claim_stage, claim_outcome, stage_index_of,
+                         create_session, request_session, save_stage, save_outcome, image_job_request, job_missing,
+                         error_payload, error_response, readiness)
+from JobQueue import AsyncJobQueue, FINAL_STATUS, job_queue_from_env
+from Metrics import REGISTRY, span, start_trace, finish_trace
+from myToken import myToken
+
+app = cors(Quart(__name__, static_folder=None))
+
+# 异步对话客户端全局共享，对话上下文由每个请求独立创建；与测试题池使用的同步客户端共用补全缓存
+chatbot = AsyncChatBot(api_key=myToken, cache=sync_chatbot.cache, limiter=limiter, routes=model_routes,
+                       hedging=hedging, deadline=llm_deadline)
+
+# 图片生成任务队列：所有图片任务由固定数量的协程执行，与请求数无关
+image_jobs = job_queue_from_env(arun_image_job, queue_class=AsyncJobQueue, store=session_store)
+
+register_metrics(image_jobs)
+
+async def _warm_up():
+    """预先建立到上游的连接，使导入客户端库、DNS解析和TLS握手不计入第一个请求；失败只记录，不影响服务"""
+    async def warm(name, call):
+        warm_up_status[name] = 'pending'
+        try:
+            with span('warm_up', name):
+                await call()
+            warm_up_status[name] = 'ok'
+        except Exception as e:
+            warm_up_status[name] = f"failed: {e}"
+            print(f"预热上游连接 {name} 失败: {e}")
+
+    # 图片任务的提交和下载使用异步客户端，状态轮询使用同步会话，两个连接池都需要预热
+    await asyncio.gather(warm('chat', chatbot.warm_up), warm('image', image_generator.awarm_up),
+                         warm('image_poller', lambda: asyncio.to_thread(image_generator.warm_up)))
+
+@app.before_serving
+async def _start_warm_up():
+    # 在后台预热（WARM_UP=off 时关闭），不推迟开始接受请求
+    if os.getenv('WARM_UP', 'on').lower() != 'off':
+        app.add_background_task(_warm_up)
+
+async def _ask(prompt, use_cache=False, on_delta=None, task=None):
+    """
+    在一个新的对话上下文中发送单轮提示并等待回复
+
+    use_cache 为 True 时复用相同提示的缓存回复；传入 on_delta 时以流式方式请求并逐段回调
+    """
+    return await chatbot.conversation(task=task).chat(prompt, stream=on_delta is not None, print_response=False,
+                                                      use_cache=use_cache, on_delta=on_delta)
+
+async def _generate_image(prompt, session=None, priority=PRIORITY_INTERACTIVE, run=None):
+    """通过任务队列生成图片并等待结果（不超过 image_wait_timeout 秒）；预生成任务（run）提交的图片由其记录并决定优先级"""
+    payload = {'prompt': prompt, 'model': IMAGE_MODEL}
+    if run is not None:
+        job_id = run.submit_image(payload)
+    else:
+        job_id = image_jobs.submit(payload, session=session, priority=priority)
+    try:
+        return await image_jobs.await_result(job_id, timeout=image_wait_timeout)
+    except TimeoutError:
+        image_jobs.cancel(job_id)
+        raise
+
+async def _run_step(name, kind, build, post, args, on_delta=None, image_job=None):
+    """执行一个步骤声明：构造输入、调用模型、处理结果"""
+    if kind == 'local':
+        result = build(*args)
+    else:
+        with span('step', name):
+            if kind == 'json':
+                prompt, schema = build(*args)
+                result = await chatbot.conversation(task=STEP_TASKS.get(name)).chat_json(
+                    prompt, schema, use_cache=name in CACHEABLE_STEPS)
+            elif kind == 'image':
+                result = await _generate_image(build(*args), **(image_job or {}))
+            else:
+                result = await _ask(build(*args), use_cache=name in CACHEABLE_STEPS, on_delta=on_delta,
+                                    task=STEP_TASKS.get(name))
+    return post(result) if post else result
+
+def _build_graph(plan, on_delta=None, known=None, image_job=None):
+    """将步骤声明转换为异步执行的依赖图，on_delta、known、image_job 的含义同 app.py"""
+    graph = TaskGraph()
+    for name, deps, kind, build, post in plan:
+        step_delta = None
+        if on_delta and name in STREAMED_STEPS:
+            step_delta = lambda text, _name=name: on_delta(_name, text)
+        async def step(_name=name, _kind=kind, _build=build, _post=post, _deps=deps, _delta=step_delta, **results):
+            if known and _name in known:
+                return known[_name]
+            return await _run_step(_name, _kind, _build, _post, [results[dep] for dep in _deps], on_delta=_delta,
+                                   image_job=image_job)
+        graph.add(name, step, deps=deps)
+    return graph
+
+def _plan_launcher(plan, workers, player):
+    """返回供 Speculator.start 使用的启动函数；协程任务可直接取消，不需要检查取消标志，并发数由事件循环决定"""
+    def launch(cancelled):
+        run = SpeculativeRun(image_jobs, player, cancelled)
+        run.future = asyncio.ensure_future(_build_graph(plan, image_job={'run': run}).arun(on_result=run.record))
+        return run
+
+    return launch
+
+async def _speculative_results(speculative):
+    """等待预生成任务完成，返回值同 app.py；请求本身被取消时不影响预生成任务"""
+    task = speculative.future
+    try:
+        return await asyncio.shield(task), None
+    except asyncio.CancelledError:
+        if not task.cancelled():
+            raise
+        print("预生成任务已取消，重新生成")
+    except Exception as e:
+        print(f"预生成结果不可用，重新生成: {e}")
+    return None, speculative.partial()
+
+def _stream_plan(plan, build_response, speculative=None, on_done=None, image_job=None):
+    """执行步骤声明并以 SSE 事件推送进度，事件格式和参数同 app.py"""
+    events = asyncio.Queue()
+
+    def on_delta(name, text):
+        events.put_nowait(('delta', {'step': name, 'text': text}))
+
+    async def worker():
+        try:
+            results = known = None
+            if speculative is not None:
+                if speculative.done():
+                    results, known = await _speculative_results(speculative)
+                else:
+                    known = speculative.partial()
+            if results is not None:
+                for name, *_ in plan:
+                    events.put_nowait((name, step_event(name, results[name])))
+            else:
+                graph = _build_graph(plan, on_delta=on_delta, known=known, image_job=image_job)
+                results = await graph.arun(
+                    on_result=lambda name, result: events.put_nowait((name, step_event(name, result))))
+            if on_done:
+                # 先保存再推送 done：客户端收到 done 后可能立即断开（generate 随之取消本任务）或发出下一个请求，
+                # shield 保证断开时保存和后续预生成照常完成
+                await asyncio.shield(on_done(results))
+            events.put_nowait(('done', build_response(results)))
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            events.put_nowait(('error', error_payload(e)))
+        finally:
+            events.put_nowait(None)
+
+    async def generate():
+        task = asyncio.ensure_future(worker())
+        try:
+            while True:
+                item = await events.get()
+                if item is None:
+                    return
+                yield sse_event(*item)
+        finally:
+            # 客户端断开时不再继续生成
+            task.cancel()
+
+    return _sse_response(generate())
+
+def _sse_response(events):
+    """将 SSE 消息的异步生成器包装为流式响应"""
+    return Response(
+        events,
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+async def _replay_events(events):
+    for event in events:
+        yield sse_event(*event)
+
+async def _finish_stage(session_id, stage_index, basic_info, personality, results):
+    """保存阶段结果到会话并开始后续预生成，返回接口数据"""
+    response = await asyncio.to_thread(save_stage, session_id, stage_index, results)
+    speculate_after_stage(_plan_launcher, stage_index, basic_info, personality, results)
+    return response
+
+async def _request_session(data):
+    """在线程中读取请求对应的会话，返回值同 GameService.request_session"""
+    return await asyncio.to_thread(request_session, data)
+
+async def _generate_quiz(basic_info):
+    """生成一套性格测试问题，模型修正后仍不合法时返回空列表"""
+    try:
+        with span('step', 'quiz'):
+            return normalize_questions(await chatbot.conversation(task='quiz').chat_json(quiz_prompt(basic_info),
+                                                                                         QUIZ_SCHEMA))
+    except ValueError:
+        return []
+
+@app.after_serving
+async def _close_clients():
+    # 停止受理新任务并等待已受理的图片任务完成，排队中的预生成任务直接取消
+    await image_jobs.adrain(max_priority=PRIORITY_INTERACTIVE)
+    await image_jobs.aclose()
+    await image_generator.aclose()
+    if image_variants is not None:
+        image_variants.close()
+
+@app.before_request
+async def _begin_trace():
+    g.trace = start_trace(request.url_rule.rule if request.url_rule else 'unmatched')
+
+@app.after_request
+async def _trace_status(response):
+    g.status = response.status_code
+    return response
+
+@app.teardown_request
+async def _end_trace(exc):
+    finish_trace(g.pop('trace', None), g.pop('status', 500 if exc else ''))
+
+@app.route('/')
+async def index():
+    """首页：引用的静态资源带版本号，首页本身每次用 ETag 确认"""
+    body, encoding, etag = static_assets.index(request.headers.get('Accept-Encoding'))
+    response = Response(body, mimetype='text/html')
+    response.set_etag(etag)
+    await response.make_conditional(request)
+    return cache_headers(response, REVALIDATE, encoding, negotiated=True)
+
+@app.route('/static/<path:filename>')
+async def static_file(filename):
+    """静态资源：带当前版本号（v 参数）的请求永久缓存，按 Accept-Encoding 返回预压缩版本，支持 ETag 和 Range"""
+    asset = static_assets.resolve(filename, request.headers.get('Accept-Encoding'), 'Range' in request.headers)
+    if asset is None:
+        raise NotFound()
+    path, mimetype, encoding = asset
+    response = await send_file(path, mimetype=mimetype, conditional=True)
+    return cache_headers(response, static_assets.cache_control(filename, request.args.get('v')), encoding,
+                         negotiated=True)
+
+@app.route('/favicon.ico')
+async def favicon():
+    return Response(FAVICON_PNG, mimetype='image/png')
+
+@app.route('/api/start', methods=['POST'])
+async def start_game():
+    """开始游戏，生成性格画像"""
+    try:
+        data = await request.get_json()
+        basic_info = data.get('basic_info', {})
+        answers = data.get('answers', [])
+
+        with span('step', 'personality'):
+            personality = await _ask(personality_prompt(basic_info, answers), use_cache=True, task='personality')
+        speculate_stage(_plan_launcher, 0, basic_info, personality)
+
+        session_id, user_data = await asyncio.to_thread(create_session, basic_info, personality)
+
+        return jsonify({
+            'success': True,
+            'session_id': session_id,
+            'personality': personality,
+            'user_data': user_data
+        })
+
+    except Exception as e:
+        return error_response(e)
+
+@app.route('/api/quiz_questions', methods=['POST'])
+async def quiz_questions():
+    """随机生成性格测试问题"""
+    try:
+        data = await request.get_json() or {}
+        basic_info = data.get('basic_info', {})
+
+        questions = quiz_pool.take(basic_info) if quiz_pool else None
+        if not questions:
+            questions = await _generate_quiz(basic_info)
+        if questions:
+            return jsonify({'success': True, 'questions': questions})
+
+        return jsonify({'success': True, 'questions': fallback_questions()})
+
+    except Exception as e:
+        return error_response(e)
+
+@app.route('/api/generate_stage', methods=['POST'])
+async def generate_stage():
+    """生成某个阶段的故事和图片"""
+    try:
+        data = await request.get_json()
+        stage_index = stage_index_of(data)
+        session_id, session = await _request_session(data)
+
+        saved = saved_stage(session, stage_index)
+        if saved:
+            return jsonify(saved)
+
+        stage = STAGES[stage_index]
+        basic_info = session['basic_info']
+        personality = session['personality']
+
+        speculative = claim_stage(stage_index, basic_info, personality)
+        results, known = await _speculative_results(speculative) if speculative is not None else (None, None)
+        if results is None:
+            results = await _build_graph(stage_plan(stage, basic_info, personality), known=known,
+                                         image_job={'session': player(basic_info, personality)}).arun()
+
+        return jsonify(await _finish_stage(session_id, stage_index, basic_info, personality, results))
+
+    except Exception as e:
+        return error_response(e)
+
+@app.route('/api/generate_stage_stream', methods=['POST'])
+async def generate_stage_stream():
+    """以 Server-Sent Events 流式生成某个阶段"""
+    try:
+        data = await request.get_json()
+        stage_index = stage_index_of(data)
+        session_id, session = await _request_session(data)
+
+        saved = saved_stage(session, stage_index)
+        if saved:
+            return _sse_response(_replay_events(stage_events(saved)))
+
+        stage = STAGES[stage_index]
+        basic_info = session['basic_info']
+        personality = session['personality']
+
+        return _stream_plan(
+            stage_plan(stage, basic_info, personality),
+            stage_response,
+            speculative=claim_stage(stage_index, basic_info, personality),
+            on_done=lambda results: _finish_stage(session_id, stage_index, basic_info, personality, results),
+            image_job={'session': player(basic_info, personality)}
+        )
+
+    except Exception as e:
+        return error_response(e)
+
+@app.route('/api/generate_outcome', methods=['POST'])
+async def generate_outcome():
+    """根据用户选择生成结局图片"""
+    try:
+        data = await request.get_json()
+        stage_index = stage_index_of(data)
+        choice = data.get('choice', '')
+        session_id, session = await _request_session(data)
+
+        saved = saved_outcome(session, stage_index, choice)
+        if saved:
+            return jsonify(saved)
+
+        stage = STAGES[stage_index]
+        story = data.get('story') or (saved_stage(session, stage_index) or {}).get('story', '')
+
+        speculative = claim_outcome(stage_index, story, choice)
+        results, known = await _speculative_results(speculative) if speculative is not None else (None, None)
+
+        results = await _build_graph(outcome_plan(stage, story, choice), known=results or known,
+                                     image_job={'session': player(session['basic_info'],
+                                                                  session['personality'])}).arun()
+
+        return jsonify(await asyncio.to_thread(save_outcome, session_id, stage_index, choice, results))
+
+    except Exception as e:
+        return error_response(e)
+
+@app.route('/api/life_review', methods=['POST'])
+async def life_review():
+    """生成整个人生回顾的简短描述"""
+    try:
+        data = await request.get_json() or {}
+        session_id, session = await _request_session(data)
+
+        stages = review_stages(session) if session_id else data.get('stages', [])
+        basic_info = session['basic_info']
+        personality = session['personality']
+
+        with span('step', 'review'):
+            summary = (await _ask(review_prompt(basic_info, personality, stages), use_cache=True,
+                                  task='review')).strip()
+
+        return jsonify({'success': True, 'summary': summary})
+
+    except Exception as e:
+        return error_response(e)
+
+@app.route('/api/jobs/image', methods=['POST'])
+async def submit_image_job():
+    """提交图片生成任务，立即返回任务ID"""
+    try:
+        payload, session, priority = image_job_request(await request.get_json() or {})
+        job_id = image_jobs.submit(payload, session=session, priority=priority)
+
+        return jsonify({'success': True, 'job': await image_jobs.aget(job_id)}), 202
+
+    except Exception as e:
+        return error_response(e)
+
+@app.route('/api/jobs/<job_id>')
+async def get_job(job_id):
+    """查询任务状态，wait 参数的含义同 app.py"""
+    wait = min(request.args.get('wait', 0, type=float), 30)
+    job = await image_jobs.await_job(job_id, timeout=wait) if wait > 0 else await image_jobs.aget(job_id)
+    if job is None:
+        return job_missing()
+    return jsonify({'success': True, 'job': job})
+
+@app.route('/api/jobs/<job_id>/events')
+async def job_events(job_id):
+    """以 Server-Sent Events 推送任务状态，事件同 app.py"""
+    job = await image_jobs.aget(job_id)
+    if job is None:
+        return job_missing()
+
+    async def generate(job):
+        last = None
+        while job is not None:
+            progress = (job['status'], job.get('queued_ahead'))
+            if progress != last:
+                yield sse_event('status', job)
+                last = progress
+            else:
+                yield ": keepalive\n\n"
+            if job['status'] in FINAL_STATUS:
+                return
+            job = await image_jobs.await_job(job_id, timeout=2)
+
+    return _sse_response(generate(job))
+
+@app.route('/healthz')
+async def healthz():
+    """存活检查：进程能处理请求即返回200，不访问上游"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+async def readyz():
+    """就绪检查，见 GameService.readiness"""
+    return readiness(image_jobs)
+
+@app.route('/metrics')
+async def metrics():
+    """Prometheus 文本格式的指标"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/images/<path:filename>')
+async def serve_image(filename):
+    """
+    提供图片文件服务；w（显示宽度）和 format（avif/webp/jpeg）参数或 Accept 头可选择缩略图和现代格式版本
+
+    图片按提示词的哈希命名，缓存淘汰后同一地址可能重新生成出不同的内容，因此只缓存一天（IMAGE_CACHE）；支持 ETag 和 Range
+    """
+    if image_variants is None:
+        response = await send_from_directory(image_generator.output_dir, filename, conditional=True)
+        return cache_headers(response, IMAGE_CACHE)
+    variant = await image_variants.aget(filename, request.headers.get('Accept'), request.args.get('format'),
+                                        request.args.get('w', type=int))
+    if variant is None:
+        response = await send_from_directory(image_generator.output_dir, filename, conditional=True)
+    else:
+        response = await send_file(variant[0], mimetype=variant[1], conditional=True)
+    # 同一地址按 Accept 头返回不同格式，共享缓存需要区分
+    response.vary.add('Accept')
+    return cache_headers(response, IMAGE_CACHE)
+
+if __name__ == '__main__':
+    app.run(host="0.0.0.0", port=7860)
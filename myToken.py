@@ -1,5 +1,23 @@
 import os
 
+# ModelScope API 地址，可指向兼容的本地服务（如 MockModelScope.py）以离线测试
+MODELSCOPE_BASE_URL = os.getenv("MODELSCOPE_BASE_URL", "https://api-inference.modelscope.cn").rstrip('/')
+
+# 未设置时应用仍可启动并提供静态页面和缓存内容，在首次调用上游时才报错（/readyz 报告未就绪）
 myToken = os.getenv("MODELSCOPE_KEY")
-if not myToken:
-    raise RuntimeError("Missing env var MODELSCOPE_KEY. Please set it before running.")
+
+
+def require_token(api_key=None):
+    """
+    获取调用上游所需的访问令牌
+
+    Args:
+        api_key: 显式传入的令牌，为空时使用环境变量 MODELSCOPE_KEY
+
+    Raises:
+        RuntimeError: 未配置令牌
+    """
+    token = api_key or myToken
+    if not token:
+        raise RuntimeError("Missing env var MODELSCOPE_KEY. Please set it before running.")
+    return token
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+生产环境入口：用 Hypercorn 以多进程方式运行应用（开发时仍可直接运行 app.py）
+
+每个工作进程独立加载应用并在接受请求前创建好客户端和连接池；收到 SIGTERM/SIGINT 后停止接受新连接，
+等待进行中的请求完成，再等待已受理的图片任务完成后退出。
+
+上游调用的准入控制（UPSTREAM_LIMITS）在各进程内存中，每个进程使用 1/WORKERS 的限额，合计不超过配置值。
+
+多进程时会话和补全缓存默认放到共享的SQLite文件中，任一进程都能继续同一局游戏、查询其他进程受理的图片任务；
+预生成结果和测试题池仍在各进程内存中，只在同一进程中复用。
+
+环境变量：
+    SERVER: asgi（默认，异步应用 asgi:app）或 wsgi（Flask 应用 app:app，请求在线程池中执行）
+    HOST: 监听地址，默认 0.0.0.0
+    PORT: 监听端口，默认 7860
+    WORKERS: 工作进程数，默认为CPU核数
+    GRACEFUL_TIMEOUT: 停止时等待进行中请求完成的时间（秒）
+    JOB_DRAIN_TIMEOUT: 停止时等待已受理图片任务完成的时间（秒）
+    DATA_DIR: 多进程共享的SQLite文件目录（未单独设置 SESSION_DB / LLM_CACHE_DB 时使用）
+"""
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing.connection import wait
+from hypercorn.asyncio.run import asyncio_worker
+from hypercorn.config import Config
+
+# 主进程检查停止信号的间隔，也是工作进程意外退出后重新拉起前的等待时间（秒），避免启动即崩溃时反复重启
+_RESTART_DELAY = 1
+
+
+def share_state(workers, data_dir):
+    """
+    多进程时把会话和补全缓存放到共享的SQLite文件中（已单独配置的不覆盖）
+
+    工作进程由 spawn 方式启动，会继承这里设置的环境变量
+    """
+    if workers <= 1:
+        return
+    os.makedirs(data_dir, exist_ok=True)
+    os.environ.setdefault('SESSION_DB', os.path.join(data_dir, 'sessions.db'))
+    os.environ.setdefault('LLM_CACHE_DB', os.path.join(data_dir, 'completions.db'))
+
+
+def run_worker(config, sockets, shutdown_event):
+    """
+    工作进程入口
+
+    Hypercorn 停止服务后，Flask 应用（wsgi）没有关闭阶段的钩子，在这里等待它已受理的图片任务完成；
+    异步应用在 after_serving 中完成同样的工作
+    """
+    asyncio_worker(config, sockets, shutdown_event=shutdown_event)
+    if config.application_path == 'app:app':
+        import app
+        app.shutdown()
+
+
+def build_config():
+    """
+    根据环境变量构建 Hypercorn 配置
+
+    Returns:
+        Config: Hypercorn 配置
+    """
+    server = os.getenv('SERVER', 'asgi').lower()
+    if server not in ('asgi', 'wsgi'):
+        raise ValueError(f"SERVER 只能是 asgi 或 wsgi: {server}")
+
+    config = Config()
+    config.application_path = 'asgi:app' if server == 'asgi' else 'app:app'
+    config.bind = [f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '7860')}"]
+    config.workers = int(os.getenv('WORKERS', os.cpu_count() or 1))
+    config.graceful_timeout = float(os.getenv('GRACEFUL_TIMEOUT', 30))
+    # 关闭阶段（after_serving）要等待图片任务完成，留出比任务等待时间更长的余量
+    config.shutdown_timeout = float(os.getenv('JOB_DRAIN_TIMEOUT', 30)) + 10
+    config.accesslog = '-' if os.getenv('ACCESS_LOG', 'off').lower() == 'on' else None
+    config.errorlog = '-'
+    return config
+
+
+def serve(config):
+    """
+    启动并监管工作进程
+
+    Hypercorn 自带的多进程模式在第一个工作进程退出后会直接终止其余进程，正在等待图片任务的进程会被打断；
+    这里在收到停止信号后通知所有工作进程平滑退出，并等待它们各自完成（超过期限才强制终止）。
+    """
+    sockets = config.create_sockets()
+    context = multiprocessing.get_context('spawn')
+    shutdown_event = context.Event()
+    stopping = False
+
+    def start_worker():
+        process = context.Process(target=run_worker, name="anotheryou-worker",
+                                  kwargs={'config': config, 'sockets': sockets, 'shutdown_event': shutdown_event})
+        process.start()
+        return process
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+        shutdown_event.set()
+
+    # 工作进程忽略 SIGINT（终端的 Ctrl+C 会发给整个进程组），统一由主进程通过 shutdown_event 通知
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    processes = [start_worker() for _ in range(config.workers)]
+    for signal_name in ('SIGINT', 'SIGTERM'):
+        signal.signal(getattr(signal, signal_name), stop)
+
+    while not stopping:
+        for exited in wait([process.sentinel for process in processes], timeout=_RESTART_DELAY):
+            if stopping:
+                break
+            process = next(process for process in processes if process.sentinel == exited)
+            process.join()
+            print(f"工作进程 {process.pid} 意外退出（{process.exitcode}），重新启动", flush=True)
+            time.sleep(_RESTART_DELAY)
+            processes[processes.index(process)] = start_worker()
+
+    # 所有工作进程并行退出，共用同一个截止时间，总等待时间不随进程数增长
+    deadline = time.monotonic() + config.graceful_timeout + config.shutdown_timeout
+    for process in processes:
+        process.join(max(0, deadline - time.monotonic()))
+        if process.is_alive():
+            print(f"工作进程 {process.pid} 未能在期限内退出，强制终止", flush=True)
+            process.terminate()
+            process.join()
+
+    for sock in sockets.secure_sockets + sockets.insecure_sockets:
+        sock.close()
+    return 0
+
+
+def main():
+    config = build_config()
+    share_state(config.workers, os.getenv('DATA_DIR', 'data'))
+    # 工作进程按进程数平分上游调用的限额（见 RateLimiter.limiter_from_env）
+    os.environ['WORKERS'] = str(config.workers)
+    print(f"启动 {config.application_path}，{config.workers} 个工作进程，监听 {config.bind[0]}", flush=True)
+    return serve(config)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,5 +1,6 @@
 // 全局状态
 let userData = null;
+let sessionId = null;
 let currentStage = 0;
 let currentStory = null;
 let currentImages = [];
@@ -28,6 +29,44 @@ function apiFetch(path, options) {
     return fetch(`${API_BASE}${path}`, options);
 }
 
+// 逐条读取 Server-Sent Events 响应，每解析出一条事件就回调 onEvent(事件名, 数据)
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    const dispatch = (raw) => {
+        let event = 'message';
+        const dataLines = [];
+        raw.split('\n').forEach((line) => {
+            if (line.startsWith('event:')) {
+                event = line.slice(6).trim();
+            } else if (line.startsWith('data:')) {
+                dataLines.push(line.slice(5).trim());
+            }
+        });
+        if (dataLines.length) {
+            onEvent(event, JSON.parse(dataLines.join('\n')));
+        }
+    };
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) {
+            break;
+        }
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            dispatch(buffer.slice(0, boundary));
+            buffer = buffer.slice(boundary + 2);
+        }
+    }
+    if (buffer.trim()) {
+        dispatch(buffer);
+    }
+}
+
 const STAGES = [
     { name: "幼儿时期", ageRange: "0-12岁" },
     { name: "少年时期", ageRange: "13-24岁" },
@@ -124,11 +163,37 @@ function showPage(pageId) {
     document.getElementById(pageId).classList.add('active');
 }
 
-// 获取图片URL
-function getImageUrl(path) {
+// 服务端生成的缩略图宽度，浏览器根据显示尺寸和像素密度从中选择
+const IMAGE_WIDTHS = [320, 640, 1024];
+
+// 故事/结局大图和回顾缩略图的显示宽度
+const STORY_IMAGE_SIZES = '(max-width: 800px) 100vw, 800px';
+const REVIEW_IMAGE_SIZES = '(max-width: 768px) 50vw, 240px';
+
+// 获取图片URL，width 为期望的显示宽度（服务端返回不小于该宽度的缩略图）
+function getImageUrl(path, width) {
+    if (!path) return '';
+    const filename = encodeURIComponent(path.split('/').pop());
+    return width ? `/images/${filename}?w=${width}` : `/images/${filename}`;
+}
+
+// 各宽度缩略图的 srcset
+function getImageSrcset(path) {
     if (!path) return '';
-    const filename = path.split('/').pop();
-    return `/images/${filename}`;
+    return IMAGE_WIDTHS.map(width => `${getImageUrl(path, width)} ${width}w`).join(', ');
+}
+
+// 设置 img 元素的响应式图片地址
+function setResponsiveImage(img, path, sizes) {
+    img.src = getImageUrl(path, IMAGE_WIDTHS[IMAGE_WIDTHS.length - 1]);
+    img.srcset = getImageSrcset(path);
+    img.sizes = sizes;
+    img.decoding = 'async';
+}
+
+// 响应式图片的 HTML 属性
+function responsiveImageAttributes(path, sizes) {
+    return `src="${getImageUrl(path, IMAGE_WIDTHS[IMAGE_WIDTHS.length - 1])}" srcset="${getImageSrcset(path)}" sizes="${sizes}" decoding="async"`;
 }
 
 function getBasicInfo() {
@@ -259,6 +324,7 @@ document.getElementById('quiz-form').addEventListener('submit', async (e) => {
         
         if (data.success) {
             userData = data.user_data;
+            sessionId = data.session_id;
             document.getElementById('personality-content').innerHTML = 
                 `<p>${data.personality}</p>`;
             document.getElementById('start-journey-btn').style.display = 'block';
@@ -299,40 +365,106 @@ async function loadStage() {
     document.getElementById('outcome-section').style.display = 'none';
     
     try {
-        const response = await apiFetch('/api/generate_stage', {
+        const response = await apiFetch('/api/generate_stage_stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({
                 stage_index: currentStage,
-                user_data: userData
+                session_id: sessionId
             })
         });
-        const data = await parseJsonResponse(response);
-        
-        if (data.success) {
-            currentStory = data.story;
-            currentImages = data.images;
-            stageHistory[currentStage] = {
-                stage: stage,
-                story: data.story,
-                images: data.images
-            };
-            
-            // 显示故事和图片
-            displayStory(data.story, data.images);
-            
-            // 显示选择题
-            displayChoices(data.question, data.options);
-        } else {
+        const contentType = response.headers.get('content-type') || '';
+        if (!contentType.includes('text/event-stream')) {
+            const data = await parseJsonResponse(response);
             alert('生成故事失败：' + data.error);
+            return;
         }
+
+        // 故事逐段显示，选择题、图片和描述在各自生成完成后立即显示
+        const record = {
+            stage: stage,
+            story: '',
+            images: [{ path: '', description: '' }, { path: '', description: '' }]
+        };
+        stageHistory[currentStage] = record;
+        currentStory = '';
+        currentImages = record.images;
+        let storyStarted = false;
+        let storyText = null;
+
+        const ensureStoryLayout = () => {
+            if (storyStarted) {
+                return;
+            }
+            storyStarted = true;
+            renderStoryLayout();
+            storyText = document.querySelector('#story-content .story-text');
+        };
+
+        await readEventStream(response, (event, data) => {
+            if (event === 'delta' && data.step === 'story') {
+                ensureStoryLayout();
+                storyText.textContent += data.text;
+            } else if (event === 'story') {
+                ensureStoryLayout();
+                storyText.textContent = data.value;
+                currentStory = data.value;
+                record.story = data.value;
+            } else if (event === 'choice') {
+                displayChoices(data.question, data.options);
+            } else if (event === 'image1' || event === 'image2') {
+                const index = event === 'image1' ? 0 : 1;
+                record.images[index].path = data.value;
+                updateStoryImage(index, record.images[index]);
+            } else if (event === 'desc1' || event === 'desc2') {
+                const index = event === 'desc1' ? 0 : 1;
+                record.images[index].description = data.value;
+                updateStoryImage(index, record.images[index]);
+            } else if (event === 'error') {
+                alert('生成故事失败：' + data.error);
+            }
+        });
     } catch (error) {
         alert('请求失败：' + error.message);
     }
 }
 
+// 流式生成时先渲染故事和图片的占位结构
+function renderStoryLayout() {
+    let html = '<div class="story-text"></div>';
+    [0, 1].forEach((index) => {
+        html += `
+            <div class="image-container" data-image-index="${index}">
+                <div class="loading">正在生成图片...</div>
+                <div class="image-description"></div>
+            </div>
+        `;
+    });
+    document.getElementById('story-content').innerHTML = html;
+}
+
+// 更新流式生成中的某张图片或其描述
+function updateStoryImage(index, image) {
+    const container = document.querySelector(`#story-content .image-container[data-image-index="${index}"]`);
+    if (!container) {
+        return;
+    }
+    if (image.path && !container.querySelector('img')) {
+        const img = document.createElement('img');
+        setResponsiveImage(img, image.path, STORY_IMAGE_SIZES);
+        img.alt = `故事图片 ${index + 1}`;
+        const placeholder = container.querySelector('.loading');
+        if (placeholder) {
+            placeholder.replaceWith(img);
+        } else {
+            container.prepend(img);
+        }
+    }
+    container.querySelector('.image-description').textContent = image.description || '';
+}
+
 // 显示故事和图片
 function displayStory(story, images) {
     let html = `<div class="story-text">${story}</div>`;
@@ -340,7 +472,7 @@ function displayStory(story, images) {
     images.forEach((image, index) => {
         html += `
             <div class="image-container">
-                <img src="${getImageUrl(image.path)}" alt="故事图片 ${index + 1}">
+                <img ${responsiveImageAttributes(image.path, STORY_IMAGE_SIZES)} alt="故事图片 ${index + 1}">
                 <div class="image-description">${image.description}</div>
             </div>
         `;
@@ -384,8 +516,7 @@ async function handleChoice(choice) {
             },
             body: JSON.stringify({
                 stage_index: currentStage,
-                user_data: userData,
-                story: currentStory,
+                session_id: sessionId,
                 choice: choice
             })
         });
@@ -395,7 +526,7 @@ async function handleChoice(choice) {
             let html = `<div class="outcome-text">${data.outcome}</div>`;
             html += `
                 <div class="image-container">
-                    <img src="${getImageUrl(data.image.path)}" alt="结局图片">
+                    <img ${responsiveImageAttributes(data.image.path, STORY_IMAGE_SIZES)} alt="结局图片">
                     <div class="image-description">${data.image.description}</div>
                 </div>
             `;
@@ -467,7 +598,8 @@ function renderReviewComic() {
         frameDiv.style.setProperty('--delay', `${index * 0.08}s`);
 
         const img = document.createElement('img');
-        img.src = getImageUrl(frame.image.path);
+        setResponsiveImage(img, frame.image.path, REVIEW_IMAGE_SIZES);
+        img.loading = 'lazy';
         img.alt = `回顾图片 ${index + 1}`;
 
         const caption = document.createElement('div');
@@ -494,8 +626,7 @@ async function showReview() {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({
-                user_data: userData,
-                stages: stageHistory
+                session_id: sessionId
             })
         });
         const data = await parseJsonResponse(response);
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+import ChatBot as chat_bot_module
+from ChatBot import AsyncChatBot, ChatBot
+from Hedging import HedgePolicy
+from RateLimiter import Limiter
+
+_MESSAGES = [{'role': 'user', 'content': 'hi'}]
+
+
+def _policy():
+    policy = HedgePolicy(min_samples=1, min_delay=0.05)
+    policy.observe('task', 0.01)
+    return policy
+
+
+def test_slow_call_is_hedged_with_fallback_model():
+    bot = ChatBot(api_key='x', hedging=_policy())
+    release = threading.Event()
+
+    def request(model, params, messages, task, deadline, hedge=False):
+        if model == 'primary':
+            release.wait(5)
+        return model
+
+    bot._request = request
+    started = time.monotonic()
+    assert bot._hedged('primary', {}, _MESSAGES, 'task', time.monotonic() + 5, hedge_model='fallback') == 'fallback'
+    assert time.monotonic() - started < 1
+    release.set()
+    assert bot.hedging.stats()['task']['hedge_wins'] == 1
+
+
+def test_early_wakeup_without_hedging_keeps_waiting(monkeypatch):
+    bot = ChatBot(api_key='x', hedging=None)
+    bot._request = lambda model, *args, **kwargs: time.sleep(0.05) or model
+    real_wait = chat_bot_module.wait
+    calls = []
+
+    def wait(futures, timeout=None, return_when=None):
+        # 第一次等待在期限之前空手返回
+        calls.append(timeout)
+        if len(calls) == 1:
+            return set(), set(futures)
+        return real_wait(futures, timeout=timeout, return_when=return_when)
+
+    monkeypatch.setattr(chat_bot_module, 'wait', wait)
+    assert bot._hedged('primary', {}, _MESSAGES, 'task', time.monotonic() + 5) == 'primary'
+    assert len(calls) == 2
+
+
+def test_async_early_wakeup_without_hedging_keeps_waiting(monkeypatch):
+    bot = AsyncChatBot(api_key='x', hedging=None)
+
+    async def request(model, *args, **kwargs):
+        await asyncio.sleep(0.05)
+        return model
+
+    bot._request = request
+    real_wait = asyncio.wait
+    calls = []
+
+    async def wait(futures, timeout=None, return_when=None):
+        calls.append(timeout)
+        if len(calls) == 1:
+            return set(), set(futures)
+        return await real_wait(futures, timeout=timeout, return_when=return_when)
+
+    monkeypatch.setattr(asyncio, 'wait', wait)
+    result = asyncio.run(bot._hedged('primary', {}, _MESSAGES, 'task', time.monotonic() + 5))
+    assert result == 'primary' and len(calls) == 2
+
+
+def _failing_client(create):
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+def test_primary_error_wins_over_hedge_that_was_not_admitted():
+    bot = ChatBot(api_key='x', hedging=_policy(), limiter=Limiter({'default': {'concurrency': 1}}))
+
+    def create(**kwargs):
+        time.sleep(0.3)
+        raise RuntimeError('upstream 500')
+
+    bot._client = _failing_client(create)
+    with pytest.raises(RuntimeError, match='upstream 500'):
+        bot._hedged('primary', {}, _MESSAGES, 'task', time.monotonic() + 5)
+    assert bot.limiter.stats()['primary']['shed'] == 0
+    assert bot.hedging.stats()['task']['hedged'] == 0
+
+
+def test_async_primary_error_wins_over_hedge_that_was_not_admitted():
+    bot = AsyncChatBot(api_key='x', hedging=_policy(), limiter=Limiter({'default': {'concurrency': 1}}))
+
+    async def create(**kwargs):
+        await asyncio.sleep(0.3)
+        raise RuntimeError('upstream 500')
+
+    bot._client = _failing_client(create)
+    with pytest.raises(RuntimeError, match='upstream 500'):
+        asyncio.run(bot._hedged('primary', {}, _MESSAGES, 'task', time.monotonic() + 5))
+    assert bot.limiter.stats()['primary']['shed'] == 0
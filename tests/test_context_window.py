@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from ChatBot import AsyncChatBot, ChatBot
+from ContextWindow import ContextWindow
+from Metrics import SPAN_ERRORS
+
+
+def _history(turns):
+    messages = [{'role': 'system', 'content': '系统'}]
+    for index in range(turns):
+        messages.append({'role': 'user', 'content': f'问题{index}' * 20})
+        messages.append({'role': 'assistant', 'content': f'回答{index}' * 20})
+    return messages
+
+
+def _summary_errors():
+    return dict(((labels, value) for _, labels, value in SPAN_ERRORS.samples())).get(
+        (('span', 'context.summary'), ('detail', '')), 0)
+
+
+def test_plan_keeps_system_message_and_recent_turns():
+    window = ContextWindow(max_tokens=200, keep_messages=2)
+    messages = _history(4)
+    start, end = window.plan(messages, [window.count(message) for message in messages])
+    assert start == 1
+    assert messages[end]['role'] == 'user'
+    assert end <= len(messages) - 2
+
+
+def test_plan_within_budget_does_nothing():
+    window = ContextWindow(max_tokens=10000)
+    messages = _history(2)
+    assert window.plan(messages, [window.count(message) for message in messages]) is None
+
+
+def test_summary_request_includes_existing_summary():
+    window = ContextWindow()
+    request = window.summary_request([window.summary_message('旧摘要'), {'role': 'user', 'content': '你好'}])
+    assert request[1]['content'] == window.summary_message('旧摘要')['content'] + '\n用户: 你好'
+
+
+def test_compaction_replaces_old_turns_with_summary():
+    bot = ChatBot(api_key='x', context_window=ContextWindow(max_tokens=200, keep_messages=2))
+    bot.complete = lambda messages, task=None, **kwargs: '摘要' if task == 'summary' else '好的'
+    conversation = bot.conversation()
+    conversation.messages = _history(4)
+    assert conversation.chat('继续', print_response=False) == '好的'
+    assert ContextWindow.is_summary(conversation.messages[1])
+    assert conversation.messages[1]['content'].endswith('摘要')
+
+
+def test_failed_summary_drops_old_turns_and_is_counted(capsys):
+    bot = ChatBot(api_key='x', context_window=ContextWindow(max_tokens=200, keep_messages=2))
+
+    def complete(messages, task=None, **kwargs):
+        if task == 'summary':
+            raise RuntimeError('upstream down')
+        return '好的'
+
+    bot.complete = complete
+    conversation = bot.conversation()
+    conversation.messages = _history(4)
+    errors = _summary_errors()
+    conversation.chat('继续', print_response=False)
+    assert _summary_errors() == errors + 1
+    assert 'upstream down' in capsys.readouterr().out
+    assert not any(ContextWindow.is_summary(message) for message in conversation.messages)
+    assert len(conversation.messages) < len(_history(4)) + 2
+
+
+def test_async_failed_summary_is_counted(capsys):
+    bot = AsyncChatBot(api_key='x', context_window=ContextWindow(max_tokens=200, keep_messages=2))
+
+    async def complete(messages, task=None, **kwargs):
+        if task == 'summary':
+            raise RuntimeError('upstream down')
+        return '好的'
+
+    bot.complete = complete
+    conversation = bot.conversation()
+    conversation.messages = _history(4)
+    errors = _summary_errors()
+    assert asyncio.run(conversation.chat('继续', print_response=False)) == '好的'
+    assert _summary_errors() == errors + 1
+    assert 'upstream down' in capsys.readouterr().out
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import stat
+import subprocess
+import sys
+import pytest
+from PIL import Image
+from GenPic import ImageGenerator, sniff_image_format
+
+
+class _Response:
+    """只提供 _download_to_file 用到的接口的下载响应"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start:start + chunk_size]
+
+
+def _image_bytes(image_format, mode='RGB'):
+    buffer = io.BytesIO()
+    Image.new(mode, (8, 8), 'red' if mode == 'RGB' else (255, 0, 0, 128)).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def _download(tmp_path, monkeypatch, data):
+    generator = ImageGenerator(api_key='x', output_dir=str(tmp_path), cache=False)
+    monkeypatch.setattr(generator, '_request', lambda *args, **kwargs: _Response(data))
+    file_path = generator._file_path('prompt')
+    generator._download_to_file('http://example.invalid/image', file_path)
+    with open(file_path, 'rb') as f:
+        return f.read()
+
+
+def test_png_download_is_saved_as_jpeg(tmp_path, monkeypatch):
+    saved = _download(tmp_path, monkeypatch, _image_bytes('PNG', mode='RGBA'))
+    assert sniff_image_format(saved) == 'JPEG'
+    assert not [name for name in tmp_path.iterdir() if name.suffix == '.part']
+
+
+def test_jpeg_download_is_kept_byte_for_byte(tmp_path, monkeypatch):
+    data = _image_bytes('JPEG')
+    assert _download(tmp_path, monkeypatch, data) == data
+
+
+def test_saved_image_is_readable_by_others(tmp_path, monkeypatch):
+    _download(tmp_path, monkeypatch, _image_bytes('PNG'))
+    saved = ImageGenerator(api_key='x', output_dir=str(tmp_path), cache=False)._file_path('prompt')
+    assert stat.S_IMODE(os.stat(saved).st_mode) == 0o644
+
+
+def test_failed_conversion_leaves_no_temp_file(tmp_path, monkeypatch):
+    generator = ImageGenerator(api_key='x', output_dir=str(tmp_path), cache=False)
+    file_path = generator._file_path('prompt')
+    with open(file_path, 'wb') as f:
+        f.write(_image_bytes('PNG'))
+
+    def fail(self, *args, **kwargs):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(Image.Image, 'save', fail)
+    with pytest.raises(OSError, match='disk full'):
+        generator._convert_image(file_path)
+    assert not [name for name in tmp_path.iterdir() if name.suffix == '.part']
+
+def test_import_does_not_load_http_clients(tmp_path):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = ("import sys, GenPic; GenPic.ImageGenerator(api_key='x', cache=False, output_dir=sys.argv[1]); "
+            "print(sorted({'requests', 'httpx', 'PIL'} & set(sys.modules)))")
+    output = subprocess.run([sys.executable, '-c', code, str(tmp_path)], cwd=root, capture_output=True,
+                            text=True, check=True).stdout
+    assert output.strip() == '[]'
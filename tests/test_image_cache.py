@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+from ImageCache import ImageCache
+from ImageVariants import ImageVariants
+
+
+def _write(cache, key, size=100, age=0):
+    path = cache.path(key)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    if age:
+        past = time.time() - age
+        os.utime(path, (past, past))
+    return path
+
+
+def test_hit_keeps_modification_time(tmp_path):
+    cache = ImageCache(str(tmp_path))
+    key = cache.key('model', 'prompt')
+    path = _write(cache, key, age=100)
+    mtime = os.stat(path).st_mtime
+
+    assert cache.get(key) == path
+    stat = os.stat(path)
+    assert stat.st_mtime == mtime
+    assert stat.st_atime > mtime + 50
+
+
+def test_variants_stay_fresh_after_hit(tmp_path):
+    from PIL import Image
+    cache = ImageCache(str(tmp_path))
+    key = cache.key('model', 'prompt')
+    source = cache.path(key)
+    Image.new('RGB', (64, 48), 'red').save(source, format='JPEG')
+    past = time.time() - 100
+    os.utime(source, (past, past))
+
+    variants = ImageVariants(str(tmp_path), widths=(32,), formats=('webp',))
+    try:
+        variants.get(os.path.basename(source), image_format='webp')
+        assert variants.misses == 1
+        cache.get(key)
+        variants.get(os.path.basename(source), image_format='webp')
+        assert variants.hits == 1 and variants.misses == 1
+    finally:
+        variants.close()
+
+
+def test_evict_removes_least_recently_used(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=250, max_age=None)
+    keys = [cache.key('model', str(index)) for index in range(3)]
+    for index, key in enumerate(keys):
+        _write(cache, key, age=300 - index * 100)
+    # 最早生成的文件刚被使用过，应保留
+    cache.get(keys[0])
+
+    assert cache.evict() == 1
+    assert os.path.exists(cache.path(keys[0]))
+    assert not os.path.exists(cache.path(keys[1]))
+    assert os.path.exists(cache.path(keys[2]))
+
+
+def test_evict_removes_expired_and_ignores_other_files(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=None, max_age=60)
+    old = _write(cache, cache.key('model', 'old'), age=120)
+    new = _write(cache, cache.key('model', 'new'))
+    other = tmp_path / 'example.jpg'
+    other.write_bytes(b'x')
+    os.utime(other, (0, 0))
+
+    assert cache.evict() == 1
+    assert not os.path.exists(old)
+    assert os.path.exists(new)
+    assert other.exists()
+
+
+def test_expired_entry_is_a_miss(tmp_path):
+    cache = ImageCache(str(tmp_path), max_age=60)
+    key = cache.key('model', 'prompt')
+    path = _write(cache, key, age=120)
+
+    assert cache.get(key) is None
+    assert not os.path.exists(path)
+    assert cache.stats()['misses'] == 1
+
+
+def test_evict_keeps_tracked_files_with_md5_names(tmp_path):
+    cache = ImageCache(str(tmp_path), max_bytes=1, max_age=60)
+    cached = _write(cache, cache.key('model', 'prompt'), size=10, age=120)
+    # 仓库中的示例图片同样以MD5命名
+    tracked = tmp_path / '85ca817460d1cfe470de01fad7fde2f8.jpg'
+    tracked.write_bytes(b'x' * 10)
+    os.utime(tracked, (0, 0))
+
+    assert cache.evict() == 1
+    assert not os.path.exists(cached)
+    assert tracked.exists()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import threading
+from JobQueue import JobQueue
+
+
+def _blocked_queue():
+    """单个worker的队列：第一个任务阻塞worker，之后提交的任务都在排队"""
+    order = []
+    started, release = threading.Event(), threading.Event()
+
+    def run(payload):
+        if payload == 'block':
+            started.set()
+            release.wait(5)
+        order.append(payload)
+        return payload
+
+    queue = JobQueue(run, workers=1)
+    blocker = queue.submit('block', session='blocker')
+    assert started.wait(5)
+    return queue, order, release, blocker
+
+
+def test_sessions_take_turns_within_a_priority():
+    queue, order, release, blocker = _blocked_queue()
+    jobs = [queue.submit(f'a{index}', session='a') for index in range(3)]
+    jobs.append(queue.submit('b0', session='b'))
+    release.set()
+    for job_id in [blocker] + jobs:
+        assert queue.result(job_id, timeout=5)
+    assert order == ['block', 'a0', 'b0', 'a1', 'a2']
+
+
+def test_lower_priority_value_runs_first():
+    queue, order, release, blocker = _blocked_queue()
+    low = queue.submit('low', priority=1)
+    high = queue.submit('high', priority=0)
+    release.set()
+    for job_id in (blocker, low, high):
+        queue.result(job_id, timeout=5)
+    assert order == ['block', 'high', 'low']
+
+
+def test_promote_moves_queued_job_ahead():
+    queue, order, release, blocker = _blocked_queue()
+    speculative = queue.submit('speculative', session='p', priority=1)
+    other = queue.submit('other', session='q', priority=0)
+    assert queue.get(speculative)['queued_ahead'] == 1
+
+    assert queue.promote(speculative, 0)
+    assert queue.get(speculative)['queued_ahead'] == 0
+    assert queue.get(other)['queued_ahead'] == 1
+    # 已是该优先级时不再调整
+    assert not queue.promote(speculative, 0)
+
+    release.set()
+    for job_id in (blocker, speculative, other):
+        queue.result(job_id, timeout=5)
+    assert order == ['block', 'speculative', 'other']
+    assert not queue.promote(other, 0)
+
+
+def test_drain_cancels_queued_low_priority_jobs():
+    queue, order, release, blocker = _blocked_queue()
+    interactive = queue.submit('interactive', priority=0)
+    speculative = queue.submit('speculative', priority=1)
+    release.set()
+
+    assert queue.drain(timeout=5, max_priority=0)
+    assert queue.get(interactive)['status'] == 'succeeded'
+    assert queue.get(speculative)['status'] == 'cancelled'
+    assert 'speculative' not in order
+
+
+def test_result_times_out_while_job_is_queued():
+    queue, order, release, blocker = _blocked_queue()
+    waiting = queue.submit('waiting')
+    try:
+        queue.result(waiting, timeout=0.05)
+    except TimeoutError:
+        pass
+    else:
+        raise AssertionError('expected TimeoutError')
+    assert queue.cancel(waiting)
+    release.set()
+    queue.result(blocker, timeout=5)
+    assert order == ['block']
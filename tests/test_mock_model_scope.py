@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import pytest
+import requests
+from MockModelScope import MockModelScope
+
+
+@pytest.fixture
+def mock_url():
+    mock = MockModelScope(port=0, chat_latency='0', token_interval=0)
+    url = mock.start()
+    yield url
+    mock.stop()
+
+
+@pytest.mark.parametrize('body', [b'not json', b'[1]', b'{}', b'{"messages": []}', b'{"messages": ["hi"]}'])
+def test_bad_chat_body_is_rejected(mock_url, body):
+    response = requests.post(mock_url + '/v1/chat/completions', data=body, timeout=5)
+    assert response.status_code == 400
+    assert 'error' in response.json()
+
+
+def test_chat_completion(mock_url):
+    response = requests.post(mock_url + '/v1/chat/completions', timeout=5,
+                             json={'model': 'm', 'messages': [{'role': 'user', 'content': '你好'}]})
+    assert response.status_code == 200
+    assert response.json()['choices'][0]['message']['content']
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from QuizPool import QuizPool
+
+_INFO = {'gender': '女', 'mbti': 'INFP', 'zodiac': '双鱼座', 'background': '普通家庭'}
+
+
+class _Generator:
+    def __init__(self):
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, basic_info):
+        with self.lock:
+            self.calls += 1
+            return [{'question': f"{basic_info['mbti']}-{self.calls}"}]
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_first_request_does_not_refill():
+    generate = _Generator()
+    pool = QuizPool(generate, target=3, hot_after=2)
+    assert pool.take(_INFO) is None
+    time.sleep(0.05)
+    assert generate.calls == 0
+    assert pool.stats()['pending'] == 0
+
+
+def test_hot_bucket_is_refilled_to_target():
+    generate = _Generator()
+    pool = QuizPool(generate, target=3, hot_after=2)
+    pool.take(_INFO)
+    assert pool.take(_INFO) is None
+    _wait_for(lambda: pool.stats()['sets'] == 3 and pool.stats()['pending'] == 0)
+    assert pool.take(_INFO) is not None
+    assert pool.stats()['hits'] == 1 and pool.stats()['misses'] == 2
+
+
+def test_warm_bypasses_hot_after():
+    generate = _Generator()
+    pool = QuizPool(generate, target=2, hot_after=5)
+    pool.warm([_INFO])
+    _wait_for(lambda: pool.stats()['sets'] == 2)
+    assert pool.take(_INFO) is not None
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import pytest
+from RateLimiter import Limiter, Overloaded, TokenBucket, limiter_from_env, per_worker
+
+
+def test_token_bucket_refills_at_rate():
+    bucket = TokenBucket(60)
+    assert bucket.wait_time(60, now=bucket.updated) == 0
+    bucket.take(60)
+    assert bucket.wait_time(1, now=bucket.updated) == pytest.approx(1.0)
+    assert bucket.wait_time(1, now=bucket.updated + 1) == 0
+
+
+def test_request_larger_than_capacity_waits_for_full_bucket():
+    bucket = TokenBucket(60)
+    bucket.take(60)
+    assert bucket.wait_time(1000, now=bucket.updated) == pytest.approx(60.0)
+
+
+def test_concurrency_limit_sheds_after_deadline():
+    limiter = Limiter({'default': {'concurrency': 1}})
+    with limiter.acquire('model'):
+        with pytest.raises(Overloaded):
+            with limiter.acquire('model', timeout=0.05):
+                pass
+    with limiter.acquire('model', timeout=0):
+        pass
+    assert limiter.stats()['model'] == {'in_flight': 0, 'admitted': 2, 'shed': 1}
+
+
+def test_rpm_wait_beyond_deadline_sheds_immediately():
+    limiter = Limiter({'model': {'rpm': 1}})
+    with limiter.acquire('model'):
+        pass
+    with pytest.raises(Overloaded) as error:
+        with limiter.acquire('model', timeout=1):
+            pass
+    assert error.value.retry_after == 60
+
+
+def test_limits_are_split_across_workers():
+    limits = {'default': {'concurrency': 8, 'rpm': 100}, 'small': {'concurrency': 2}}
+    assert per_worker(limits, 1) == limits
+    assert per_worker(limits, 4) == {'default': {'concurrency': 2, 'rpm': 25}, 'small': {'concurrency': 1}}
+
+
+def test_limiter_from_env_divides_by_workers(monkeypatch):
+    monkeypatch.setenv('UPSTREAM_LIMITS', '{"default": {"concurrency": 8, "tpm": 90000}}')
+    monkeypatch.setenv('WORKERS', '3')
+    assert limiter_from_env().limits == {'default': {'concurrency': 2, 'tpm': 30000}}
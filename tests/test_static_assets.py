@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import gzip
+import os
+import stat
+from StaticAssets import IMMUTABLE, REVALIDATE, StaticAssets, _accepted_encodings, precompress
+
+_SCRIPT = 'console.log("anotheryou");\n' * 40
+
+
+def _assets(tmp_path):
+    (tmp_path / 'script.js').write_text(_SCRIPT)
+    (tmp_path / 'index.html').write_text('<script src="/static/script.js"></script>')
+    return StaticAssets(str(tmp_path))
+
+
+def test_accept_encoding_respects_zero_quality():
+    assert _accepted_encodings('gzip, br;q=0, deflate;q=0.5') == {'gzip', 'deflate'}
+    assert _accepted_encodings(None) == set()
+
+
+def test_precompressed_file_is_readable_by_others(tmp_path):
+    _assets(tmp_path)
+    compressed = tmp_path / 'script.js.gz'
+    assert gzip.decompress(compressed.read_bytes()).decode() == _SCRIPT
+    assert stat.S_IMODE(os.stat(compressed).st_mode) == 0o644
+    assert precompress(str(tmp_path)) == 0
+
+
+def test_resolve_picks_encoding_from_accept_header(tmp_path):
+    assets = _assets(tmp_path)
+    path, mimetype, encoding = assets.resolve('script.js', 'gzip')
+    assert path.endswith('script.js.gz') and encoding == 'gzip'
+    assert mimetype in ('application/javascript', 'text/javascript')
+    assert assets.resolve('script.js', 'identity')[2] is None
+    assert assets.resolve('script.js', 'gzip', ranged=True)[2] is None
+    assert assets.resolve('../secret', 'gzip') is None
+
+
+def test_stale_precompressed_file_is_ignored(tmp_path):
+    assets = _assets(tmp_path)
+    source = tmp_path / 'script.js'
+    compressed_mtime = os.path.getmtime(tmp_path / 'script.js.gz')
+    os.utime(source, (compressed_mtime + 10, compressed_mtime + 10))
+    assert assets.resolve('script.js', 'gzip')[2] is None
+
+
+def test_index_links_versioned_assets_and_etag_follows_content(tmp_path):
+    assets = _assets(tmp_path)
+    version = assets.version('script.js')
+    body, encoding, etag = assets.index()
+    assert encoding is None
+    assert f'/static/script.js?v={version}'.encode() in body
+    compressed, encoding, gzip_etag = assets.index('gzip')
+    assert encoding == 'gzip' and gzip.decompress(compressed) == body and gzip_etag == etag + '-gzip'
+
+    assert assets.cache_control('script.js', version) == IMMUTABLE
+    assert assets.cache_control('script.js', 'stale') == REVALIDATE
+
+    (tmp_path / 'script.js').write_text(_SCRIPT + '// changed\n')
+    os.utime(tmp_path / 'script.js', (1, 1))
+    assert assets.version('script.js') != version
+    assert assets.index()[2] != etag
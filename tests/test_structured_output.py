@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import pytest
+from Pipeline import QUIZ_SCHEMA, normalize_questions
+from StructuredOutput import extract_json, parse_structured, repair_prompt, validate
+
+
+def test_extracts_json_from_fenced_block_with_trailing_comma():
+    text = '好的，题目如下：\n```json\n{"questions": [{"question": "你喜欢？", "options": ["A", "B",]},]}\n```\n祝愉快'
+    assert extract_json(text) == {'questions': [{'question': '你喜欢？', 'options': ['A', 'B']}]}
+
+
+def test_extracts_outermost_object_from_surrounding_text():
+    assert extract_json('结果：{"a": [1, 2]} 完') == {'a': [1, 2]}
+
+
+def test_unparseable_reply_raises():
+    with pytest.raises(ValueError):
+        extract_json('没有JSON')
+    with pytest.raises(ValueError):
+        extract_json(None)
+
+
+@pytest.mark.parametrize('value, message', [
+    ({}, '$ 缺少字段 questions'),
+    ({'questions': []}, '$.questions 至少需要 1 项'),
+    ({'questions': [{'question': '问', 'options': ['唯一']}]}, '$.questions[0].options 至少需要 2 项'),
+    ({'questions': [{'question': 1, 'options': ['A', 'B']}]}, '$.questions[0].question 应为 string'),
+])
+def test_validation_errors_name_the_location(value, message):
+    with pytest.raises(ValueError, match=message.replace('[', r'\[').replace(']', r'\]').replace('$', r'\$')):
+        validate(value, QUIZ_SCHEMA)
+
+
+def test_boolean_is_not_an_integer():
+    with pytest.raises(ValueError):
+        validate(True, {'type': 'integer'})
+    validate(3, {'type': 'integer', 'enum': [1, 3]})
+
+
+def test_parsed_quiz_is_normalized():
+    value = parse_structured('{"questions": [{"question": " 问题 ", "options": [" A ", "B "]}]}', QUIZ_SCHEMA)
+    assert normalize_questions(value) == [{'question': '问题', 'options': ['A', 'B']}]
+
+
+def test_repair_prompt_carries_error_and_schema():
+    prompt = repair_prompt(ValueError('$ 缺少字段 questions'), QUIZ_SCHEMA)
+    assert '$ 缺少字段 questions' in prompt and '"required": ["questions"]' in prompt
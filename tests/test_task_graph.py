@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+import time
+import pytest
+from TaskGraph import TaskGraph
+
+
+def test_steps_receive_dependency_results_and_report_progress():
+    finished = []
+    graph = TaskGraph()
+    graph.add('a', lambda: 1)
+    graph.add('b', lambda: 2)
+    graph.add('sum', lambda a, b: a + b, deps=('a', 'b'))
+    results = graph.run(on_result=lambda name, result: finished.append(name))
+    assert results == {'a': 1, 'b': 2, 'sum': 3}
+    assert finished[-1] == 'sum' and sorted(finished) == ['a', 'b', 'sum']
+
+
+def test_independent_steps_run_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+    graph = TaskGraph()
+    graph.add('left', barrier.wait)
+    graph.add('right', barrier.wait)
+    assert set(graph.run()) == {'left', 'right'}
+
+
+def test_invalid_definitions_are_rejected():
+    graph = TaskGraph().add('a', lambda: 1)
+    with pytest.raises(ValueError):
+        graph.add('a', lambda: 2)
+    with pytest.raises(ValueError):
+        graph.add('b', lambda c: c, deps=('c',))
+
+
+def test_failure_is_raised_without_waiting_for_running_siblings():
+    release = threading.Event()
+
+    def fail():
+        raise RuntimeError('boom')
+
+    graph = TaskGraph()
+    graph.add('slow', lambda: release.wait(5))
+    graph.add('fail', fail)
+    graph.add('after', lambda fail: fail, deps=('fail',))
+    started = time.monotonic()
+    with pytest.raises(RuntimeError):
+        graph.run()
+    assert time.monotonic() - started < 1
+    release.set()
+
+
+def test_async_failure_cancels_other_steps():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append('slow')
+            raise
+
+    async def fail():
+        raise RuntimeError('boom')
+
+    graph = TaskGraph().add('slow', slow).add('fail', fail)
+
+    async def main():
+        with pytest.raises(RuntimeError):
+            await graph.arun()
+        await asyncio.sleep(0)
+
+    asyncio.run(main())
+    assert cancelled == ['slow']